@@ -64,6 +64,10 @@ env = params.get('environment')
 ## Workspace
 ws = he.get_aml_ws()
 
+## Datastore, the feature cache is shared by runs on a mounted path
+ds = ws.get_default_datastore()
+cache_dir = ds.path(f'{args.project_name}/cache').as_mount()
+
 ## Compute target   
 try:
     compute_target = ComputeTarget(workspace=ws, name=args.compute_name)
@@ -85,6 +89,11 @@ shutil.copy(f'./project/{args.project_name}.config.json', f'./src/{fn_config_inf
 script_folder = "./"
 tasks = params.get("tasks")
 
+def get_precision_params(config):
+    """Gradient accumulation & mixed precision (O1/O2/O3), if set in the task config"""
+    return {f'--{p}': config.get(p) for p in ['grad_accumulation_steps', 'amp'] 
+                if config.get(p) is not None}
+
 ############################################
 #####  PREPARE
 ############################################
@@ -125,8 +134,9 @@ if args.do_train:
             script_params = {
                 '--task'            : int(task),
                 '--use_cuda'        : '',
-                
-                '--register_model'  : ''
+                '--cache_dir'       : cache_dir,
+                '--register_model'  : '',
+                **get_precision_params(config)
             }
             est = PyTorch(source_directory = script_folder,
                         compute_target = compute_target,
@@ -63,6 +63,10 @@ env = params.get('environment')
 ## Workspace
 ws = he.get_aml_ws()
 
+## Datastore, the feature cache is shared by runs on a mounted path
+ds = ws.get_default_datastore()
+cache_dir = ds.path(f'{args.project_name}/cache').as_mount()
+
 ## Compute target   
 try:
     compute_target = ComputeTarget(workspace=ws, name=args.compute_name)
@@ -84,6 +88,20 @@ shutil.copy(f'./project/{args.project_name}.config.json', f'./src/{fn_config_inf
 script_folder = "./"
 tasks = params.get("tasks")
 
+def get_featurize_params(config):
+    """Featurization (tokenization) workers & chunk size, if set in the task config"""
+    return {f'--{p}': config.get(p) for p in ['featurize_workers', 'featurize_chunksize'] 
+                if config.get(p) is not None}
+
+def get_precision_params(config):
+    """Gradient accumulation & mixed precision (O1/O2/O3), if set in the task config"""
+    return {f'--{p}': config.get(p) for p in ['grad_accumulation_steps', 'amp'] 
+                if config.get(p) is not None}
+
+def get_checkpoint_dir(task):
+    """Mounted checkpoint directory of a task, kept when a run is restarted on another node"""
+    return ds.path(f'{args.project_name}/checkpoints/t{task}').as_mount()
+
 ############################################
 #####  PREPARE
 ############################################
@@ -129,7 +147,12 @@ if args.do_train:
                 '--model_type'      : config.get('model_type'),
                 '--max_seq_len'     : config.get('max_seq_len'),
                 '--embeds_dropout'  : config.get('embeds_dropout'),
-                '--register_model'  : ''
+                '--register_model'  : '',
+                '--resume'          : '',
+                '--checkpoint_dir'  : get_checkpoint_dir(task),
+                '--cache_dir'       : cache_dir,
+                **get_featurize_params(config),
+                **get_precision_params(config)
             }
             est = PyTorch(source_directory = script_folder,
                         compute_target = compute_target,
@@ -147,7 +170,12 @@ if args.do_train:
                 '--model_type'      : config.get('model_type'),
                 '--max_seq_len'     : config.get('max_seq_len'),
                 '--embeds_dropout'  : config.get('embeds_dropout'),
-                '--register_model'  : ''
+                '--register_model'  : '',
+                '--resume'          : '',
+                '--checkpoint_dir'  : get_checkpoint_dir(task),
+                '--cache_dir'       : cache_dir,
+                **get_featurize_params(config),
+                **get_precision_params(config)
             }
             est = PyTorch(source_directory = script_folder,
                         compute_target = compute_target,
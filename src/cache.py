@@ -0,0 +1,257 @@
+"""
+Local artifact cache for datasets and models
+
+Artifacts are keyed by name and version, their files are stored content
+addressed (sha256), so identical files are only kept once across tasks and
+versions. Entries are evicted least recently used, once the disk quota is exceeded.
+
+cache_dir/
+    objects/<hash[:2]>/<hash>       <- file content
+    entries/<key>/<version>.json    <- manifest, relative path -> hash
+    .lock                           <- lock file, shared by all processes
+
+Adding, restoring and evicting entries hold an exclusive file lock, so the
+cache can be shared by concurrent processes (e.g. the tasks of a pipeline).
+
+The LocalStore is a filesystem-backed stand-in for the remote stores
+(AML datasets & models, blob storage), for local development and testing.
+"""
+import logging
+log = logging.getLogger(__name__)
+
+import os
+import re
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+from pathlib import Path
+
+def get_hash(fp, block_size=1 << 20):
+    """Get sha256 hash of file content"""
+    h = hashlib.sha256()
+    with open(fp, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def list_files(paths):
+    """Resolve files and directories to a flat list of files"""
+    files = []
+    for p in paths:
+        if os.path.isdir(p):
+            files.extend(str(f) for f in sorted(Path(p).rglob('*')) if f.is_file())
+        elif os.path.isfile(p):
+            files.append(str(p))
+    return files
+
+def _safe_name(name):
+    """Make keys and versions (e.g. etags) safe for file names"""
+    return re.sub(r'[^\w\-.]', '_', str(name))
+
+def _atomic_write(fp, content):
+    """Write text to file via temporary file, safe for concurrent readers"""
+    os.makedirs(os.path.dirname(fp), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fp))
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        f.write(content)
+    os.replace(tmp, fp)
+
+class FileLock():
+    """Exclusive lock across processes (and threads), on a lock file"""
+    def __init__(self, fp):
+        self.fp = fp
+        self._local = threading.local()
+
+    def __enter__(self):
+        f = open(self.fp, 'a+')
+        if os.name == 'nt':
+            import msvcrt
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        self._local.f = f
+        return self
+
+    def __exit__(self, *args):
+        f = self._local.f
+        if os.name == 'nt':
+            import msvcrt
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        f.close()
+
+############################################
+#####   Artifact Cache
+############################################
+
+class ArtifactCache():
+    def __init__(self, cache_dir, quota_mb=10000, verify=True):
+        self.cache_dir = cache_dir
+        self.object_dir = os.path.join(cache_dir, 'objects')
+        self.entry_dir = os.path.join(cache_dir, 'entries')
+        self.quota = quota_mb * 1e6
+        self.verify = verify
+        os.makedirs(self.object_dir, exist_ok=True)
+        os.makedirs(self.entry_dir, exist_ok=True)
+        self.lock = FileLock(os.path.join(cache_dir, '.lock'))
+
+    def _object_path(self, h):
+        return os.path.join(self.object_dir, h[:2], h)
+
+    def _entry_path(self, key, version):
+        return os.path.join(self.entry_dir, _safe_name(key), f'{_safe_name(version)}.json')
+
+    def _entries(self):
+        """Iterate over (path, manifest) of all entries"""
+        for fp in Path(self.entry_dir).glob('*/*.json'):
+            try:
+                with open(fp, encoding='utf-8') as f:
+                    yield str(fp), json.load(f)
+            except (OSError, ValueError):
+                continue
+
+    def has(self, key, version):
+        return os.path.isfile(self._entry_path(key, version))
+
+    def get(self, key, version, target):
+        """Restore cached artifact into target directory
+
+        Returns False if the artifact is not cached, or an object is missing or corrupted.
+        """
+        fp = self._entry_path(key, version)
+        if not os.path.isfile(fp):
+            return False
+        with self.lock:
+            if not os.path.isfile(fp):
+                return False
+            with open(fp, encoding='utf-8') as f:
+                manifest = json.load(f)
+            for rel, h in manifest['files'].items():
+                obj = self._object_path(h)
+                if not os.path.isfile(obj) or (self.verify and get_hash(obj) != h):
+                    log.warning(f'[WARNING] Cached object for {key} ({version}) is missing or corrupted, removing entry.')
+                    if os.path.isfile(obj):
+                        os.remove(obj)
+                    os.remove(fp)
+                    return False
+            for rel, h in manifest['files'].items():
+                dest = os.path.join(target, rel)
+                if os.path.isfile(dest) and os.path.getsize(dest) == os.path.getsize(self._object_path(h)) \
+                        and get_hash(dest) == h:
+                    continue
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                shutil.copyfile(self._object_path(h), dest)
+            # Update last access, for LRU eviction
+            manifest['last_access'] = time.time()
+            _atomic_write(fp, json.dumps(manifest))
+        log.info(f'[INFO] Restored {key} ({version}) from cache -> {target}')
+        return True
+
+    def put(self, key, version, target, paths):
+        """Add downloaded files (or directories) below target directory to the cache"""
+        # Hash outside of the lock
+        files = {os.path.relpath(fn, target): (fn, get_hash(fn)) for fn in list_files(paths)}
+        size = sum(os.path.getsize(fn) for fn, __ in files.values())
+        if size > self.quota:
+            log.warning(f'[WARNING] {key} ({version}) is larger than the cache quota, not cached.')
+            return
+        with self.lock:
+            ## Objects & manifest are written under the lock, so they are not collected in between
+            for fn, h in files.values():
+                obj = self._object_path(h)
+                if not os.path.isfile(obj):
+                    os.makedirs(os.path.dirname(obj), exist_ok=True)
+                    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(obj))
+                    os.close(fd)
+                    shutil.copyfile(fn, tmp)
+                    os.replace(tmp, obj)
+            manifest = dict(key=key, version=str(version), files={rel: h for rel, (__, h) in files.items()},
+                            size=size, last_access=time.time())
+            _atomic_write(self._entry_path(key, version), json.dumps(manifest))
+            log.info(f'[INFO] Cached {key} ({version}), {len(files)} files, {size / 1e6:.1f} MB')
+            self._evict()
+
+    def size(self):
+        """Disk usage of all cached objects"""
+        return sum(f.stat().st_size for f in Path(self.object_dir).rglob('*') if f.is_file())
+
+    def evict(self):
+        """Remove least recently used entries, until the cache fits into the quota"""
+        with self.lock:
+            self._evict()
+
+    def _evict(self):
+        entries = sorted(self._entries(), key=lambda e: e[1].get('last_access', 0))
+        total = self.size()
+        while total > self.quota and len(entries) > 0:
+            fp, manifest = entries.pop(0)
+            os.remove(fp)
+            log.info(f'[INFO] Evicted {manifest.get("key")} ({manifest.get("version")}) from cache')
+            total -= self._gc(entries)
+
+    def _gc(self, entries):
+        """Remove objects not referenced by any entry, returns freed bytes (call under the lock)"""
+        referenced = {h for __, m in entries for h in m['files'].values()}
+        freed = 0
+        for f in Path(self.object_dir).rglob('*'):
+            if f.is_file() and len(f.name) == 64 and f.name not in referenced:
+                freed += f.stat().st_size
+                f.unlink()
+        return freed
+
+############################################
+#####   Local Store
+############################################
+
+class LocalStore():
+    """Filesystem-backed stand-in for remote stores
+
+    root/<source>/<name>/<version>/<files>
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def _dir(self, source, name):
+        return os.path.join(self.root, source, name.replace('/', '_'))
+
+    def get_version(self, source, name):
+        """Get latest version of artifact"""
+        versions = [int(v) for v in os.listdir(self._dir(source, name)) if v.isdigit()] \
+                        if os.path.isdir(self._dir(source, name)) else []
+        if len(versions) == 0:
+            raise FileNotFoundError(f'{name} not found in local store <{source}>.')
+        return max(versions)
+
+    def download(self, source, name, target, version=None):
+        """Copy artifact into target directory, returns downloaded paths"""
+        if version is None:
+            version = self.get_version(source, name)
+        src = os.path.join(self._dir(source, name), str(version))
+        paths = []
+        for fn in list_files([src]):
+            dest = os.path.join(target, os.path.relpath(fn, src))
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            shutil.copyfile(fn, dest)
+            paths.append(dest)
+        return paths
+
+    def upload(self, source, name, fp):
+        """Store file or directory as new version of artifact, returns the version"""
+        try:
+            version = self.get_version(source, name) + 1
+        except FileNotFoundError:
+            version = 1
+        dest = os.path.join(self._dir(source, name), str(version))
+        if os.path.isdir(fp):
+            shutil.copytree(fp, dest)
+        else:
+            os.makedirs(dest, exist_ok=True)
+            shutil.copyfile(fp, os.path.join(dest, os.path.basename(fp)))
+        return version
@@ -0,0 +1,192 @@
+"""
+Checkpoints of long training runs
+
+Model, optimizer, LR schedule, RNG states and the position in the train data
+are saved periodically, so a preempted run continues from the last checkpoint.
+
+checkpoint_dir/<run key>/epoch_<epoch>_step_<step>/    <- model & trainer state
+
+The run key is a hash of the features and hyperparameters, so only checkpoints
+of the same training are resumed.
+
+The trainer also runs mixed precision (fp16 with apex) and logs the training 
+throughput in examples/sec.
+"""
+import logging
+log = logging.getLogger(__name__)
+
+import time
+import json
+import shutil
+import hashlib
+from pathlib import Path
+
+import dill
+import numpy as np
+import torch
+from farm.train import Trainer
+from farm.modeling.optimization import get_scheduler
+from farm.utils import MLFlowLogger as MlLogger
+
+amp_levels = ['O1', 'O2', 'O3']
+
+def get_amp_level(amp):
+    """Apex opt level, from an AMP mode (None or O1/O2/O3)
+    
+    NOTE: native bf16 (torch.autocast) requires torch >= 1.10, torch 1.5.1 is pinned
+    """
+    if amp is None or amp in amp_levels:
+        return amp
+    raise ValueError(f'UNKNOWN AMP MODE {amp}, USE ONE OF {amp_levels}')
+
+def get_run_dir(checkpoint_dir, data_silo, params):
+    """Checkpoint directory of a training run, by features & hyperparameters"""
+    payload = {
+        'features'  : data_silo._get_checksum() if hasattr(data_silo, '_get_checksum') else None,
+        'params'    : params
+    }
+    key = hashlib.sha256(json.dumps(payload, sort_keys = True, default = str).encode()).hexdigest()[:16]
+    return Path(checkpoint_dir) / key
+
+class CheckpointTrainer(Trainer):
+    """FARM Trainer, with checkpoints on CPU & GPU
+
+    On resume, the batch order of the train epoch is restored (see LengthBucketSampler),
+    and the batches up to the checkpoint are skipped.
+
+    With gradient accumulation, checkpoints are rounded up to a multiple of grad_acc_steps,
+    so they are always taken right after an optimizer step.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.checkpoint_every and self.grad_acc_steps > 1:
+            self.checkpoint_every = -(-self.checkpoint_every // self.grad_acc_steps) * self.grad_acc_steps
+        self.throughput = {'examples': 0, 'seconds': 0.0, 'examples_per_sec': 0.0}
+        self._train_start = None
+
+    @classmethod
+    def create(cls, data_silo, model, optimizer, checkpoint_root_dir, resume=False, **kwargs):
+        """Trainer from the latest checkpoint of the run, if resume, else a new one"""
+        checkpoint_root_dir = Path(checkpoint_root_dir)
+        if not resume:
+            shutil.rmtree(checkpoint_root_dir, ignore_errors = True)
+        checkpoints = cls._get_checkpoints(checkpoint_root_dir)
+        if len(checkpoints) > 0:
+            return cls._load_checkpoint(checkpoints[0], data_silo, model, optimizer)
+        log.warning(f'[INFO] No checkpoint found, starting a new training -> {checkpoint_root_dir}')
+        return cls(data_silo = data_silo,
+                    model = model,
+                    optimizer = optimizer,
+                    checkpoint_root_dir = checkpoint_root_dir,
+                    **kwargs)
+
+    @classmethod
+    def _get_checkpoints(cls, checkpoint_root_dir):
+        """Checkpoint directories, latest first"""
+        if not Path(checkpoint_root_dir).exists():
+            return []
+        checkpoints = []
+        for d in Path(checkpoint_root_dir).iterdir():
+            parts = d.name.split('_')
+            if d.is_dir() and len(parts) == 4 and parts[0] == 'epoch' and parts[2] == 'step':
+                checkpoints.append((d, int(parts[1]), int(parts[3])))
+        return [d for d, __, __ in sorted(checkpoints, key = lambda c: (c[1], c[2]), reverse = True)]
+
+    def train(self):
+        """Train and log the examples/sec"""
+        self._train_start = time.perf_counter()
+        try:
+            return super().train()
+        finally:
+            self._update_throughput()
+            log.warning(f'[INFO] Trained on {self.throughput["examples"]} examples in '
+                        f'{self.throughput["seconds"]:.1f}s -> {self.throughput["examples_per_sec"]:.1f} examples/sec')
+
+    def backward_propagate(self, loss, step):
+        """Backward pass (and optimizer step every grad_acc_steps), counting the examples"""
+        self.throughput['examples'] += loss.numel()
+        loss = super().backward_propagate(loss, step)
+        if self.global_step % self.log_loss_every == 0 and self.local_rank in [-1, 0]:
+            MlLogger.log_metrics({'Train_examples_per_sec': self._update_throughput()}, step = self.global_step)
+        return loss
+
+    def _update_throughput(self):
+        """Examples/sec since the start of train, including evaluations"""
+        if self._train_start is not None:
+            self.throughput['seconds'] = time.perf_counter() - self._train_start
+            self.throughput['examples_per_sec'] = self.throughput['examples'] / max(self.throughput['seconds'], 1e-9)
+        return self.throughput['examples_per_sec']
+
+    def _get_state_dict(self):
+        """Trainer state, with the mixed precision settings"""
+        state = super()._get_state_dict()
+        state['use_amp'] = self.use_amp
+        return state
+
+    def _save(self):
+        """Save a checkpoint, via a temporary directory"""
+        checkpoint_path = self.checkpoint_root_dir / 'checkpoint_in_progress'
+        shutil.rmtree(checkpoint_path, ignore_errors = True)
+        checkpoint_path.mkdir(parents = True, exist_ok = True)
+
+        self.model.save(checkpoint_path)
+        torch.save(
+            {
+                'trainer_state'     : self._get_state_dict(),
+                'model_state'       : self.model.state_dict(),
+                'optimizer_state'   : self.optimizer.state_dict(),
+                'scheduler_opts'    : self.lr_schedule.opts,
+                'scheduler_state'   : self.lr_schedule.state_dict(),
+                'numpy_rng_state'   : np.random.get_state(),
+                'rng_state'         : torch.get_rng_state(),
+                'cuda_rng_state'    : torch.cuda.get_rng_state() if torch.cuda.is_available() else None,
+            },
+            checkpoint_path / 'trainer',
+            pickle_module = dill,
+        )
+
+        checkpoint_name = f'epoch_{self.from_epoch}_step_{self.from_step - 1}'
+        target = self.checkpoint_root_dir / checkpoint_name
+        shutil.rmtree(target, ignore_errors = True)
+        checkpoint_path.replace(target)
+
+        for cp in self._get_checkpoints(self.checkpoint_root_dir)[self.checkpoints_to_keep:]:
+            shutil.rmtree(cp, ignore_errors = True)
+        log.info(f'[INFO] Saved checkpoint {checkpoint_name}')
+
+    @classmethod
+    def _load_checkpoint(cls, path, data_silo, model, optimizer, local_rank=-1):
+        """Restore trainer, model, optimizer, LR schedule, RNG states and train data position"""
+        if not path.exists():
+            raise Exception(f'CHECKPOINT NOT FOUND -> {path}')
+        checkpoint = torch.load(path / 'trainer', map_location = None if torch.cuda.is_available() else 'cpu')
+        state = checkpoint['trainer_state']
+        state['device'] = getattr(model, 'device', state['device'])
+        state['checkpoint_root_dir'] = path.parent
+
+        np.random.set_state(checkpoint['numpy_rng_state'])
+        torch.set_rng_state(checkpoint['rng_state'])
+        if checkpoint['cuda_rng_state'] is not None and torch.cuda.is_available():
+            torch.cuda.set_rng_state(checkpoint['cuda_rng_state'])
+
+        model.load_state_dict(checkpoint['model_state'], strict = True)
+        optimizer.load_state_dict(checkpoint['optimizer_state'])
+        scheduler = get_scheduler(optimizer, checkpoint['scheduler_opts'])
+        scheduler.load_state_dict(checkpoint['scheduler_state'])
+
+        trainer = cls(data_silo = data_silo,
+                    model = model,
+                    optimizer = optimizer,
+                    lr_schedule = scheduler,
+                    **state)
+        # Same batch order as the interrupted epoch
+        if hasattr(data_silo, 'set_epoch'):
+            data_silo.set_epoch(trainer.from_epoch)
+        log.warning(f'[INFO] Loaded checkpoint {path.name}, epoch = {trainer.from_epoch}, '
+                        f'step = {trainer.from_step}, global step = {trainer.global_step}')
+        return trainer
+
+    @staticmethod
+    def clear(checkpoint_root_dir):
+        """Remove the checkpoints of a completed run"""
+        shutil.rmtree(checkpoint_root_dir, ignore_errors = True)
@@ -1,12 +1,20 @@
 """
 TRAIN CLASSIFICATION MODEL
 
-Before running train, you need to run prepare.py with the respective task.
+Training engine for single label (classification) and multi label
+(multi_classification) tasks, the prediction head is chosen by the task type.
+Several tasks can be trained jointly, with one head each on a shared language
+model (multi-task). The texts labelled in all tasks are used for training.
+The multi-task model is saved once, with the model of the first task, and
+serves all its tasks from one forward pass.
+
+Before running train, you need to run prepare.py with the respective task(s).
 
 Example (in the command line):
 > cd to root dir
 > conda activate nlp
 > python src/classification.py --task 1 --model_type bert --use_cuda
+> python src/classification.py --task 1 --multitask 2 --model_type roberta --use_cuda
 
 """
 import os
@@ -14,14 +22,13 @@ from pathlib import Path
 import json
 import argparse
 
-from farm.data_handler.data_silo import DataSilo
 from farm.data_handler.processor import TextClassificationProcessor
 from farm.modeling.optimization import initialize_optimizer
 from farm.infer import Inferencer
 from farm.modeling.adaptive_model import AdaptiveModel
-from farm.modeling.language_model import LanguageModel, Roberta, Albert, DistilBert
+from farm.modeling.language_model import LanguageModel
 from farm.modeling.prediction_head import TextClassificationHead, MultiLabelTextClassificationHead
-from farm.modeling.tokenization import Tokenizer, RobertaTokenizer, AlbertTokenizer
+from farm.modeling.tokenization import Tokenizer
 from farm.train import Trainer, EarlyStopping
 from farm.utils import set_all_seeds, initialize_device_settings
 from farm.eval import Evaluator
@@ -35,38 +42,159 @@ sys.path.append('./src')
 import helper as he
 import data as dt
 import custom as cu
+import features as fe
+import export as ex
+import checkpoint as ck
 
 # Logger
 logger = he.get_logger(location=__name__)
 aml_run = he.get_context()
 
+############################################
+#####   Heads & Tasks
+############################################
+
+# Prediction head & processor settings, by task type
+head_lookup = {
+    'classification'        : TextClassificationHead,
+    'multi_classification'  : MultiLabelTextClassificationHead
+}
+processor_lookup = {
+    'classification'        : dict(),
+    'multi_classification'  : dict(quote_char='"', multilabel=True, dev_split=0.3)
+}
+# Run argument defaults, by task type
+default_lookup = {
+    'classification'        : dict(task=1, model_type='bert', embeds_dropout=0.2),
+    'multi_classification'  : dict(task=2, model_type='roberta', embeds_dropout=0.1)
+}
+
+# Error, if a task is not of the type of the entry point
+task_type_errors = {
+    'classification'        : 'NOT A CLASSIFICATION TASK',
+    'multi_classification'  : 'NOT A MULTI CLASSIFICATION TASK'
+}
+
+def get_task_type(task, expected=None):
+    """Task type, if trained by this engine (and of the expected type, if given)"""
+    task_type = cu.tasks.get(str(task)).get('type')
+    if task_type not in head_lookup:
+        raise Exception(f'NOT A CLASSIFICATION TASK -> {task}')
+    if expected is not None and task_type != expected:
+        raise Exception(f'{task_type_errors[expected]} -> {task}')
+    return task_type
+
+def get_task_name(i, task):
+    """Processor task & head name, the first task keeps the FARM default"""
+    return 'text_classification' if i == 0 else f'text_classification_t{task}'
+
+def register_metric(suffix=''):
+    """Register accuracy & F1 (macro/micro) as evaluation metric, logged to AML with the suffix"""
+    # The evaluation on the dev-set can be done with one of the predefined metrics or with a
+    # metric defined as a function from (preds, labels) to a dict that contains all the actual
+    # metrics values. The function must get registered under a string name and the string name must
+    # be used.
+    def mymetrics(preds, labels):
+        acc = simple_accuracy(preds, labels)
+        f1macro = f1_score(y_true=labels, y_pred=preds, average="macro")
+        f1micro = f1_score(y_true=labels, y_pred=preds, average="micro")
+        # AML log
+        try:
+            aml_run.log(f'acc{suffix}', acc.get('acc'))
+            aml_run.log(f'f1macro{suffix}', f1macro)
+            aml_run.log(f'f1micro{suffix}', f1micro)
+        except:
+            pass
+        return {"acc": acc, "f1_macro": f1macro, "f1_micro": f1micro}
+    register_metrics(f'mymetrics{suffix}', mymetrics)
+    return f'mymetrics{suffix}'
+
+def get_processor_params(dt_task, task_type, tokenizer, max_seq_len, label_list, metric):
+    """Text classification processor arguments of a single task"""
+    return dict(tokenizer=tokenizer,
+                max_seq_len=max_seq_len,
+                data_dir=dt_task.data_dir,
+                label_list=label_list,
+                metric=metric,
+                label_column_name="label",
+                train_filename=dt_task.get_path('fn_train', dir ='data_dir'),
+                test_filename=dt_task.get_path('fn_test', dir = 'data_dir'),
+                **processor_lookup[task_type])
+
+def merge_task_files(dt_tasks):
+    """Train & test files with a label column per task, for the texts labelled in all tasks
+
+    Texts in the train set of one task and the test set of another are dropped.
+    Returns the train & test file names, in the data directory of the first task.
+    """
+    key = '+'.join(str(d.task) for d in dt_tasks)
+    fns = []
+    for fn in ['fn_train', 'fn_test']:
+        merged = None
+        for d in dt_tasks:
+            data = d.load(fn, dir = 'data_dir')[['text', 'label']].drop_duplicates('text')
+            data = data.rename(columns = {'label': f'label_t{d.task}'})
+            merged = data if merged is None else merged.merge(data, on = 'text', how = 'inner')
+        if len(merged) == 0:
+            raise Exception(f'NO TEXTS LABELLED IN ALL TASKS -> {key}')
+        fn_merged = f"{fn.split('_')[1]}-l{dt_tasks[0].language}-t{key}.txt"
+        dt_tasks[0].save(merged, fn = fn_merged, dir = 'data_dir')
+        logger.warning(f'[INFO] Merged {fn} of tasks {key}: {len(merged)} texts')
+        fns.append(dt_tasks[0].get_path(fn_merged, dir = 'data_dir'))
+    return fns
+
+def export_variants(model, processor, test_loader, save_dir, device, quantize=True, 
+                    max_quantization_delta=0.01, export_onnx=False, suffix=''):
+    """Export variants for CPU inference (int8 quantized, ONNX), if accurate enough on the test set"""
+    if not (quantize or export_onnx) or test_loader is None:
+        return
+    reference = ex.get_predictions(model, test_loader, device)
+    if quantize:
+        report = ex.export_quantized(model, processor, test_loader, save_dir, device, 
+                                    max_delta=max_quantization_delta, reference=reference)
+        ex.log_report(report, aml_run, prefix=f'quantized{suffix}')
+    if export_onnx:
+        report = ex.export_onnx(model, processor, test_loader, save_dir, device, reference=reference)
+        ex.log_report(report, aml_run, prefix=f'onnx{suffix}')
+
+############################################
+#####   Training
+############################################
+
 def doc_classification(task, model_type, n_epochs, batch_size, embeds_dropout, evaluate_every, 
                         use_cuda, max_seq_len, learning_rate, do_lower_case, 
-                        register_model, save_model=True, early_stopping=False):
+                        register_model, save_model=True, early_stopping=False,
+                        featurize_workers=128, featurize_chunksize=2000, bucketing=True,
+                        quantize=True, max_quantization_delta=0.01, export_onnx=False,
+                        checkpoint_every=1000, checkpoint_dir=None, resume=False,
+                        grad_accumulation_steps=1, amp=None, multitask=None, task_type=None,
+                        cache_dir=None):
     
     language = cu.params.get('language')
 
-    # Check task
-    if cu.tasks.get(str(task)).get('type') != 'classification':
-        raise Exception('NOT A CLASSIFICATION TASK') 
+    # Check task(s), the first one is the main task (of the task type, if given)
+    tasks = [task] + [t for t in (multitask or []) if t != task]
+    task_types = [get_task_type(task, task_type)] + [get_task_type(t) for t in tasks[1:]]
     
     # Data
-    dt_task = dt.Data(task=task)
+    dt_tasks = [dt.Data(task=t) for t in tasks]
+    dt_task = dt_tasks[0]
     ## Download training files
-    if not os.path.isfile(dt_task.get_path('fn_train', dir='data_dir')):
-        dt_task.download('data_dir', dir = 'data_dir', source = 'datastore')
+    for d in dt_tasks:
+        if not os.path.isfile(d.get_path('fn_train', dir='data_dir')):
+            d.download('data_dir', dir = 'data_dir', source = 'datastore')
 
     # Settings
     set_all_seeds(seed=42)
-    use_amp = None
+    use_amp = ck.get_amp_level(amp)
     device, n_gpu = initialize_device_settings(use_cuda = use_cuda, use_amp = use_amp)
     lang_model = he.get_farm_model(model_type, language)
-    save_dir = dt_task.get_path('model_dir')
-    label_list = dt_task.load('fn_label', dir = 'data_dir', header = None)[0].to_list()
+    label_lists = [d.load('fn_label', dir = 'data_dir', header = None)[0].to_list() for d in dt_tasks]
     
     # AML log
     try:
         aml_run.log('task', task)
+        aml_run.log_list('tasks', tasks)
         aml_run.log('language', language)
         aml_run.log('n_epochs', n_epochs)
         aml_run.log('batch_size', batch_size)
@@ -74,7 +202,9 @@ def doc_classification(task, model_type, n_epochs, batch_size, embeds_dropout, e
         aml_run.log('embeds_dropout', embeds_dropout)
         aml_run.log('max_seq_len', max_seq_len)
         aml_run.log('lang_model', lang_model)
-        aml_run.log_list('label_list', label_list)
+        aml_run.log('grad_accumulation_steps', grad_accumulation_steps)
+        aml_run.log('amp', str(amp))
+        aml_run.log_list('label_list', label_lists[0])
     except:
         pass
 
@@ -84,56 +214,56 @@ def doc_classification(task, model_type, n_epochs, batch_size, embeds_dropout, e
         do_lower_case = do_lower_case
     )
 
-    # The evaluation on the dev-set can be done with one of the predefined metrics or with a
-    # metric defined as a function from (preds, labels) to a dict that contains all the actual
-    # metrics values. The function must get registered under a string name and the string name must
-    # be used.
-    def mymetrics(preds, labels):
-        acc = simple_accuracy(preds, labels)
-        f1macro = f1_score(y_true=labels, y_pred=preds, average="macro")
-        f1micro = f1_score(y_true=labels, y_pred=preds, average="micro")
-        # AML log
-        try:
-            aml_run.log('acc', acc.get('acc'))
-            aml_run.log('f1macro', f1macro)
-            aml_run.log('f1micro', f1micro)
-        except:
-            pass
-        return {"acc": acc, "f1_macro": f1macro, "f1_micro": f1micro}
-    register_metrics('mymetrics', mymetrics)
-    metric = 'mymetrics'
-
-    processor = TextClassificationProcessor(tokenizer=tokenizer,
-                                            max_seq_len=max_seq_len,
-                                            data_dir=dt_task.data_dir,
-                                            label_list=label_list,
-                                            metric=metric,
-                                            label_column_name="label",
-                                            train_filename=dt_task.get_path('fn_train', dir ='data_dir'),
-                                            test_filename=dt_task.get_path('fn_test', dir = 'data_dir')
-                                            )
-
-
+    # 2. Create a processor, with a task per head
+    ## Metrics of additional tasks are logged with the task as suffix
+    metrics = [register_metric('' if i == 0 else f'_t{t}') for i, t in enumerate(tasks)]
+    processor_params = get_processor_params(dt_task, task_types[0], tokenizer, max_seq_len, label_lists[0], metrics[0])
+    if len(tasks) > 1:
+        ## Joint labels, a label column per task
+        train_filename, test_filename = merge_task_files(dt_tasks)
+        processor_params.update(train_filename=train_filename, test_filename=test_filename, 
+                                label_column_name=f'label_t{task}', quote_char='"')
+    processor = TextClassificationProcessor(**processor_params)
+    for i, t in enumerate(tasks[1:], 1):
+        processor.add_task(name=get_task_name(i, t),
+                            metric=metrics[i],
+                            label_list=label_lists[i],
+                            label_column_name=f'label_t{t}',
+                            text_column_name='text',
+                            task_type='multilabel_classification' if task_types[i] == 'multi_classification' else 'classification')
 
     # 3. Create a DataSilo that loads several datasets (train/dev/test), provides DataLoaders for them and calculates a few descriptive statistics of our datasets
-    data_silo = DataSilo(
+    ## Tokenized datasets are cached, and reused by repeated runs
+    data_silo = fe.CachedDataSilo(
         processor=processor,
-        batch_size=batch_size
+        batch_size=batch_size,
+        lang_model=lang_model,
+        do_lower_case=do_lower_case,
+        cache_path=fe.get_cache_path(dt_task, cache_dir),
+        max_processes=featurize_workers,
+        max_chunksize=featurize_chunksize,
+        bucketing=bucketing
     )
+    data_silo.log_stats(aml_run)
 
     # 4. Create an AdaptiveModel
     ## Pretrained language model as a basis
     language_model = LanguageModel.load(lang_model)
 
-    ## Prediction head on top that is suited for our task => Text classification
-    prediction_head = TextClassificationHead(num_labels=len(processor.tasks["text_classification"]["label_list"]),
-                                            class_weights=data_silo.calculate_class_weights(task_name="text_classification"))
+    ## Prediction heads on top that are suited for our tasks => Text classification (single or multi label)
+    prediction_heads = []
+    for i, (t, task_type) in enumerate(zip(tasks, task_types)):
+        task_name = get_task_name(i, t)
+        head_params = dict(num_labels=len(processor.tasks[task_name]["label_list"]), task_name=task_name)
+        if task_type == 'classification':
+            head_params['class_weights'] = data_silo.calculate_class_weights(task_name=task_name)
+        prediction_heads.append(head_lookup[task_type](**head_params))
 
     model = AdaptiveModel(
         language_model=language_model,
-        prediction_heads=[prediction_head],
+        prediction_heads=prediction_heads,
         embeds_dropout_prob=embeds_dropout, 
-        lm_output_types=["per_sequence"],
+        lm_output_types=["per_sequence"] * len(prediction_heads),
         device=device
     )
 
@@ -144,6 +274,7 @@ def doc_classification(task, model_type, n_epochs, batch_size, embeds_dropout, e
         n_epochs=n_epochs,
         device=device,
         learning_rate=learning_rate,
+        grad_acc_steps=grad_accumulation_steps,
         use_amp=use_amp
     )
 
@@ -156,44 +287,77 @@ def doc_classification(task, model_type, n_epochs, batch_size, embeds_dropout, e
         earlystopping = EarlyStopping(
             metric="f1_macro", mode="max",  # use f1_macro from the dev evaluator of the trainer
             # metric="loss", mode="min",   # use loss from the dev evaluator of the trainer
-            save_dir=save_dir,  # where to save the best model
+            save_dir=dt_task.get_path('model_dir'),  # where to save the best model
             patience=2    # number of evaluations to wait for improvement before terminating the training
         )
     else:
         earlystopping = None
 
-    trainer = Trainer(
+    ## Checkpoints are kept per run (features & hyperparameters), a restarted run resumes from the latest
+    checkpoint_root_dir = ck.get_run_dir(checkpoint_dir or f'{dt_task.root_dir}checkpoints/t{task}', data_silo,
+                                        dict(lang_model=lang_model, n_epochs=n_epochs, batch_size=batch_size,
+                                            embeds_dropout=embeds_dropout, learning_rate=learning_rate,
+                                            grad_accumulation_steps=grad_accumulation_steps, amp=amp,
+                                            tasks=tasks))
+    trainer = ck.CheckpointTrainer.create(
         model=model,
         optimizer=optimizer,
         data_silo=data_silo,
+        checkpoint_root_dir=checkpoint_root_dir,
+        resume=resume,
         epochs=n_epochs,
         n_gpu=n_gpu,
         lr_schedule=lr_schedule,
         evaluate_every=evaluate_every,
         device=device,
-        early_stopping=earlystopping
+        early_stopping=earlystopping,
+        checkpoint_every=checkpoint_every if checkpoint_every > 0 else None,
+        checkpoint_on_sigterm=checkpoint_every > 0,
+        grad_acc_steps=grad_accumulation_steps,
+        use_amp=use_amp
     )
 
     # 7. Let it grow
     trainer.train()
+    try:
+        aml_run.log('examples_per_sec', trainer.throughput.get('examples_per_sec'))
+    except:
+        pass
 
     # 8. Store it:
     # NOTE: if early stopping is used, the best model has been stored already in the directory
     # defined with the EarlyStopping instance
     # The model we have at this moment is the model from the last training epoch that was carried
     # out before early stopping terminated the training
+    ## With multi-task, the model (shared language model, a head per task) is saved once with the
+    ## main task, the model directories of the other tasks refer to their head
     if save_model:
+        save_dir = dt_task.get_path('model_dir')
         model.save(save_dir)
         processor.save(save_dir)
+        for i, d in enumerate(dt_tasks[1:], 1):
+            ex.save_shared(d.get_path('model_dir'), task, i)
+
+        # 9. Export variants for CPU inference (int8 quantized, ONNX), if accurate enough on the test set
+        ## NOTE: the ONNX graph has a single logits output, multi-task models are not exported
+        if export_onnx and len(tasks) > 1:
+            logger.warning('[WARNING] ONNX export of multi-task models is not supported, skipped')
+        export_variants(model, processor, data_silo.get_data_loader("test"), save_dir, device, quantize=quantize,
+                        max_quantization_delta=max_quantization_delta, export_onnx=export_onnx and len(tasks) == 1)
 
         if register_model:
-            dt_task.upload('model_dir', destination='model')
+            for d in dt_tasks:
+                d.upload('model_dir', destination='model')
+
+    # Training is complete, checkpoints are not needed anymore
+    ck.CheckpointTrainer.clear(checkpoint_root_dir)
 
-def run():
-    # Run arguments
+def run(task_type='classification'):
+    # Run arguments, defaults by task type
+    defaults = default_lookup[task_type]
     parser = argparse.ArgumentParser()
     parser.add_argument("--task", 
-                    default=1,
+                    default=defaults['task'],
                     type=int,
                     help="Task where: \
                             -task 1 : classification subcat \
@@ -201,7 +365,7 @@ def run():
                             -task 3 : ner \
                             -task 4 : qa")
     parser.add_argument("--model_type", 
-                    default='bert',
+                    default=defaults['model_type'],
                     type=str,
                     help="Available model types: \
                             -bert: en/de/... \
@@ -220,7 +384,7 @@ def run():
                     type=int,
                     help='')  
     parser.add_argument('--embeds_dropout',
-                    default=0.2,
+                    default=defaults['embeds_dropout'],
                     type=float,
                     help='')
     parser.add_argument('--evaluate_every',
@@ -241,12 +405,75 @@ def run():
     parser.add_argument('--register_model',
                         action='store_true',
                         help="Register model in AML")
+    parser.add_argument('--featurize_workers',
+                    default=128,
+                    type=int,
+                    help="Max number of processes for featurization (tokenization), 1 disables multiprocessing")
+    parser.add_argument('--featurize_chunksize',
+                    default=2000,
+                    type=int,
+                    help="Max number of samples per featurization chunk")
+    parser.add_argument('--no_bucketing',
+                        action='store_true',
+                        help="Pad all batches to max_seq_len, instead of batching by length with dynamic padding")
+    parser.add_argument('--no_quantize',
+                        action='store_true',
+                        help="Do not export an int8 quantized model for CPU inference")
+    parser.add_argument('--max_quantization_delta',
+                    default=0.01,
+                    type=float,
+                    help="Max accuracy loss on the test set, for the quantized model to be exported")
+    parser.add_argument('--export_onnx',
+                        action='store_true',
+                        help="Export an ONNX model, served with ONNX Runtime on CPU")
+    parser.add_argument('--checkpoint_every',
+                    default=1000,
+                    type=int,
+                    help="Save a checkpoint every n steps (and on SIGTERM), 0 disables checkpoints")
+    parser.add_argument('--checkpoint_dir',
+                    default=None,
+                    type=str,
+                    help="Checkpoint directory, default is <root_dir>/checkpoints. Use a persistent one (e.g. a mounted datastore) to resume on AML")
+    parser.add_argument('--resume',
+                        action='store_true',
+                        help="Resume from the latest checkpoint of the same run, if any")
+    parser.add_argument('--grad_accumulation_steps',
+                    default=1,
+                    type=int,
+                    help="Accumulate gradients over n batches per optimizer step (effective batch size = n * batch_size)")
+    parser.add_argument('--amp',
+                    default=None,
+                    choices=ck.amp_levels,
+                    help="Mixed precision: apex fp16 opt level (O1/O2/O3)")
+    parser.add_argument('--cache_dir',
+                    default=None,
+                    type=str,
+                    help="Feature cache directory, e.g. a mounted datastore shared by runs, default is the [data] cache_dir of config.ini")
+    parser.add_argument('--multitask',
+                    default=None,
+                    nargs='+',
+                    type=int,
+                    help="Classification tasks trained jointly with --task, one head each on a shared language model")
     args = parser.parse_args()
 
     doc_classification(args.task, args.model_type, args.n_epochs, 
                     args.batch_size, args.embeds_dropout, args.evaluate_every, 
                     args.use_cuda, args.max_seq_len, args.learning_rate, 
-                    args.do_lower_case, args.register_model)
+                    args.do_lower_case, args.register_model,
+                    featurize_workers=args.featurize_workers,
+                    featurize_chunksize=args.featurize_chunksize,
+                    bucketing=not args.no_bucketing,
+                    quantize=not args.no_quantize,
+                    max_quantization_delta=args.max_quantization_delta,
+                    export_onnx=args.export_onnx,
+                    checkpoint_every=args.checkpoint_every,
+                    checkpoint_dir=args.checkpoint_dir,
+                    resume=args.resume,
+                    grad_accumulation_steps=args.grad_accumulation_steps,
+                    amp=args.amp,
+                    multitask=args.multitask,
+                    task_type=task_type,
+                    cache_dir=args.cache_dir)
 
 if __name__ == "__main__":
     run()
\ No newline at end of file
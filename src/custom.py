@@ -26,10 +26,20 @@ logger.warning(f'[INFO] *** Project target env \t-> {params.get("environment")}
 ############################################
 
 def prepare_source(data):
-    """Normalize source data for use in downstram tasks. 
-    NOTE: should be task agnostic"""
-    data_norm = pd.json_normalize(data, sep='_').to_dict(orient='records')
-    return pd.read_json(json.dumps(data_norm))
+    """Normalize (a batch of) source data for use in downstram tasks. 
+    NOTE: should be task agnostic
+    NOTE: values keep their JSON types. Numbers or dates in strings are not 
+        inferred (as pd.read_json would), so that all batches of a pull get 
+        the same dtypes and ids like '007' are kept as is."""
+    return pd.json_normalize(data, sep='_')
+
+# Columns of the formatted source data, required by the prepare step of each task type
+prepare_columns = {
+    'classification'        : ['id', '_ts', 'subject', 'body', 'label_classification_simple', 'label_classification_multi'],
+    'multi_classification'  : ['id', '_ts', 'subject', 'body', 'label_classification_simple', 'label_classification_multi'],
+    'qa'                    : ['id', '_ts', 'subject', 'body', 'label_classification_simple', 'label_classification_multi',
+                                'label_answer_body', 'label_answer_markedAsAnswer', 'label_answer_upvotes']
+}
 
 def remove(line): 
     line = re.sub(r'Original Title\:', '', line)
@@ -16,29 +16,21 @@ import numpy as np
 import pickle
 import json
 import os
+import threading
 from pathlib import Path
-from azure.cosmos import cosmos_client
 
 # Custom functions
 import sys
 sys.path.append('../src')
 import helper as he
 import custom as cu
+import cache
+import transfer
 
-try:
-    from azureml.core import Run, Dataset, Model, Workspace
-    from azureml.core.authentication import InteractiveLoginAuthentication
-except Exception as e:
-    log.warning(f'Azure Machine Learning is not installed, \
-        but may not be needed for local development or endpoint deployment. Details: {e}')
-
-try:
-    from azure.storage.blob import BlockBlobService
-except Exception as e:
-    log.warning(f'Azure Storage Account (2.1.0) not installed, \
-        but may not be needed for local development or endpoint deployment. Details: {e}')
-    #TODO:  Azure Storage Account package needs to be upgraded to v12. This will break the 
-    #       current implementation.
+#NOTE: the Azure SDKs (Machine Learning, Storage Account, Cosmos DB) are imported
+#       by the methods needing them, to keep imports fast.
+#TODO:  Azure Storage Account package needs to be upgraded to v12. This will break the 
+#       current implementation.
 
 def get_repo_dir():
     """Get repository root directory"""
@@ -76,6 +68,284 @@ def get_local_dir():
         data_dir = None
     return data_dir
 
+def get_data_config():
+    """Get local cache, store & transfer settings, as specified in the local config"""
+    try:
+        run_config = dict(he.get_config(section='data'))
+    except Exception:
+        run_config = {}
+    return run_config
+
+# File extensions, used to infer the file type
+file_ext_lookup = {
+    'csv'       : 'txt',
+    'parquet'   : 'parquet'
+}
+
+def get_file_type(fn):
+    """Infer file type from the file extension"""
+    if str(fn).endswith('.parquet'):
+        return 'parquet'
+    elif str(fn).endswith('.jsonl'):
+        return 'jsonl'
+    return 'csv'
+
+# Parquet schema metadata key, with the JSON encoded columns
+json_columns_key = b'json_columns'
+
+def _serialize(x):
+    """JSON encode single values, keep missing values"""
+    if x is None or (isinstance(x, float) and np.isnan(x)):
+        return x
+    if isinstance(x, np.ndarray):
+        x = x.tolist()
+    return json.dumps(x, default=str)
+
+def to_parquet_compatible(data):
+    """JSON encode nested (list/dict) and mixed object columns, as
+    they are not supported by parquet. Returns the data & the encoded columns"""
+    _data = None
+    encoded = []
+    for col in data.columns[data.dtypes == object]:
+        if data[col].dropna().map(type).isin([str]).all():
+            continue
+        if _data is None:
+            _data = data.copy()
+        _data[col] = data[col].map(_serialize)
+        encoded.append(col)
+    return (data if _data is None else _data), encoded
+
+def from_parquet_compatible(data, encoded):
+    """Decode the JSON encoded columns"""
+    for col in encoded:
+        if col in data.columns:
+            data[col] = data[col].map(lambda x: json.loads(x) if isinstance(x, str) else x)
+    return data
+
+def get_json_columns(schema):
+    """JSON encoded columns, from the parquet schema metadata"""
+    return json.loads((schema.metadata or {}).get(json_columns_key, b'[]'))
+
+def write_parquet(data, fn, compression = 'snappy', index = False):
+    """Write parquet, with the JSON encoded columns in the schema metadata"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    data, encoded = to_parquet_compatible(data)
+    table = pa.Table.from_pandas(data, preserve_index = index)
+    if len(encoded) > 0:
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}),
+                                                json_columns_key: json.dumps(encoded).encode()})
+    pq.write_table(table, fn, compression = compression)
+
+def _encode(series):
+    """JSON encode a column, missing values as None"""
+    series = series.astype(object).map(_serialize)
+    return series.where(series.notna(), None)
+
+class ChunkWriter():
+    """Write a dataframe chunk by chunk to a csv or parquet file, for data larger than memory
+
+    Columns of later chunks are aligned to the first chunk. Columns first seen in a
+    later chunk are carried over: the rows written so far are rewritten once, with 
+    empty values. In parquet, nested & mixed columns and columns without values in 
+    the first chunk are JSON encoded, so later chunks may hold any values there.
+    The file is written to a temporary path and only moved in place when closed 
+    without error. Without any chunk, a previous file is removed.
+    """
+    def __init__(self, fn, file_type = None, sep = '\t', encoding = 'utf-8', compression = 'snappy'):
+        self.fn = str(fn)
+        self.file_type = file_type or get_file_type(fn)
+        if self.file_type not in ('csv', 'parquet'):
+            raise Exception(f'[ERROR] - file type ({self.file_type}) not supported in chunk writer. {fn} not saved.')
+        self.sep = sep
+        self.encoding = encoding
+        self.compression = compression
+        self.columns = None
+        self.encoded = []
+        self.rows = 0
+        self._fn_tmp = f'{self.fn}.tmp'
+        self._writer = None
+        self._empty = None
+
+    def write(self, data):
+        if self.columns is None:
+            self.columns = list(data.columns)
+        else:
+            late = [c for c in data.columns if c not in self.columns]
+            if len(late) > 0:
+                self._add_columns(late)
+            data = data.reindex(columns = self.columns)
+        if self._writer is None and len(data) == 0:
+            ## Types are taken from the first chunk with rows
+            self._empty = data
+            return
+        if self.file_type == 'csv':
+            data.to_csv(self._fn_tmp, sep = self.sep, encoding = self.encoding, index = False,
+                            header = self._writer is None, mode = 'w' if self._writer is None else 'a')
+            self._writer = True
+        else:
+            self._write_parquet(data)
+        self.rows += len(data)
+
+    def _get_schema(self, fields, metadata = None):
+        import pyarrow as pa
+        return pa.schema(fields, metadata = {**(metadata or {}), json_columns_key: json.dumps(self.encoded).encode()})
+
+    def _write_parquet(self, data):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        if self._writer is None:
+            data, self.encoded = to_parquet_compatible(data)
+            ## Columns without values in the first chunk, their type is not known yet
+            for col in data.columns:
+                if col not in self.encoded and data[col].isna().all():
+                    data[col] = _encode(data[col])
+                    self.encoded.append(col)
+            table = pa.Table.from_pandas(data, preserve_index = False)
+            fields = [pa.field(f.name, pa.string()) if f.name in self.encoded else f for f in table.schema]
+            self.schema = self._get_schema(fields, table.schema.metadata)
+            self._writer = pq.ParquetWriter(self._fn_tmp, self.schema, compression = self.compression)
+        else:
+            data = data.copy()
+            for col in self.encoded:
+                data[col] = _encode(data[col])
+        try:
+            table = pa.Table.from_pandas(data, schema = self.schema, preserve_index = False)
+        except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+            raise Exception(f'[ERROR] - chunk does not match the column types of the first chunk of {self.fn} -> {e}')
+        self._writer.write_table(table)
+
+    def _add_columns(self, columns):
+        """Carry over columns first seen in a later chunk, by rewriting the rows written so far"""
+        log.warning(f'[WARNING] Columns not in the first chunk of {self.fn}, rewriting {self.rows} rows: {columns}')
+        self.columns = self.columns + columns
+        if self._writer is None:
+            return
+        fn_old = f'{self._fn_tmp}.old'
+        if self.file_type == 'csv':
+            os.replace(self._fn_tmp, fn_old)
+            header = True
+            for chunk in pd.read_csv(fn_old, sep = self.sep, encoding = self.encoding, dtype = str, 
+                                        keep_default_na = False, chunksize = 100000):
+                chunk.reindex(columns = self.columns).to_csv(self._fn_tmp, sep = self.sep, encoding = self.encoding, 
+                                index = False, header = header, mode = 'w' if header else 'a')
+                header = False
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            self._writer.close()
+            os.replace(self._fn_tmp, fn_old)
+            ## Late columns are JSON encoded, as their type is not known for the rows written so far
+            self.encoded = self.encoded + columns
+            self.schema = self._get_schema(list(self.schema) + [pa.field(c, pa.string()) for c in columns], 
+                                            self.schema.metadata)
+            self._writer = pq.ParquetWriter(self._fn_tmp, self.schema, compression = self.compression)
+            for batch in pq.ParquetFile(fn_old).iter_batches(batch_size = 100000):
+                arrays = batch.columns + [pa.nulls(batch.num_rows, pa.string()) for __ in columns]
+                self._writer.write_table(pa.Table.from_arrays(arrays, schema = self.schema))
+        os.remove(fn_old)
+
+    def close(self):
+        if self._writer is None and self._empty is None:
+            ## Nothing to write, a previous file would be read as current
+            if os.path.isfile(self.fn):
+                os.remove(self.fn)
+            log.warning(f'[WARNING] No data written to {self.fn}')
+            return
+        if self._writer is None:
+            if self.file_type == 'csv':
+                self._empty.to_csv(self._fn_tmp, sep = self.sep, encoding = self.encoding, index = False)
+            else:
+                write_parquet(self._empty, self._fn_tmp, compression = self.compression)
+        elif self.file_type == 'parquet':
+            self._writer.close()
+        os.replace(self._fn_tmp, self.fn)
+        log.info(f'SAVED: {self.fn} ({self.rows} rows)')
+
+    def abort(self):
+        if self.file_type == 'parquet' and self._writer is not None:
+            self._writer.close()
+        for fn in [self._fn_tmp, f'{self._fn_tmp}.old']:
+            if os.path.isfile(fn):
+                os.remove(fn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+############################################
+#####   Connections
+############################################
+
+class Connections():
+    """Shared connections to the AML workspace and Storage Accounts
+
+    Connections are established lazily, on first use, and shared by all
+    Data objects of the process. Blob clients share a pooled HTTP session.
+    """
+    def __init__(self, pool_size = 16):
+        self.pool_size = pool_size
+        self._ws = None
+        self._ws_loaded = False
+        self._bbs = dict()
+        self._session = None
+        self._lock = threading.RLock()
+
+    def get_ws(self):
+        """Get AML workspace, authenticated once"""
+        with self._lock:
+            if not self._ws_loaded:
+                self._ws = he.get_aml_ws()
+                self._ws_loaded = True
+        return self._ws
+
+    def _get_session(self):
+        """HTTP session with a connection pool, shared by the blob clients"""
+        if self._session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            adapter = HTTPAdapter(pool_connections = self.pool_size, pool_maxsize = self.pool_size)
+            self._session = requests.Session()
+            self._session.mount('https://', adapter)
+            self._session.mount('http://', adapter)
+        return self._session
+
+    def get_bbs(self, connection_string = None, account_name = None, account_key = None):
+        """Get blob client by connection string or account, defaults to the storage-connection-string secret"""
+        with self._lock:
+            if connection_string is None and account_name is None:
+                connection_string = he.get_secret('storage-connection-string')
+            key = connection_string if connection_string is not None else account_name
+            if key not in self._bbs:
+                from azure.storage.blob import BlockBlobService
+                self._bbs[key] = BlockBlobService(account_name = account_name,
+                                                    account_key = account_key,
+                                                    connection_string = connection_string,
+                                                    request_session = self._get_session())
+            return self._bbs[key]
+
+    def reset(self):
+        """Drop all connections, e.g. after credential rotation"""
+        with self._lock:
+            self._ws = None
+            self._ws_loaded = False
+            self._bbs.clear()
+            self._session = None
+
+_connections = None
+
+def get_connections():
+    """Get process-level connections, the pool is sized to the transfer workers"""
+    global _connections
+    if _connections is None:
+        _connections = Connections(pool_size = int(get_data_config().get('transfer_workers', 8)))
+    return _connections
+
 class Data():
     def __init__(self,  
                     task            =   1,
@@ -91,6 +361,9 @@ class Data():
         self.language = cu.params.get('language')
         self.version = version
         self.env = cu.params.get('environment')
+        # File type of intermediate files (csv or parquet)
+        self.file_type = cu.params.get('prepare', {}).get('file_type', 'csv')
+        self.file_ext = file_ext_lookup.get(self.file_type, 'txt')
 
         # Directories
         ##NOTE: if data and model files are separate per task, 
@@ -142,31 +415,63 @@ class Data():
             'model_dir'         : self.model_dir
         }
         ## Filename
+        ##NOTE: train & test files are always TSV, as expected by FARM
         self.fn_lookup = {
             'fn_source'     : f"{self.project_name}-source.json",
-            'fn_prep'       : f'data-l{self.language}.txt',
+            'fn_prep'       : f'data-l{self.language}.{self.file_ext}',
             'fn_train'      : f'train-l{self.language}-t{self.task}.txt',
-            'fn_clean'      : f'clean-l{self.language}-t{self.task}.txt',
+            'fn_clean'      : f'clean-l{self.language}-t{self.task}.{self.file_ext}',
             'fn_test'       : f'test-l{self.language}-t{self.task}.txt',
             'fn_label'      : f'label-l{self.language}-t{self.task}.txt',
             'fn_rank'       : f'data-l{self.language}-t{self.task}.pkl',
+            'fn_cdb_state'  : f'cdb-l{self.language}.checkpoint.json',
+            'fn_delta'      : f'data-l{self.language}-t{self.task}.delta.json',
+            'fn_clean_base' : f'clean-l{self.language}-t{self.task}-base.{self.file_ext}',
             'fn_ner_list'   : f'ner.txt',
+            'fn_ner_rules'  : f'rules.txt',
             'fn_ner_flair'  : f'{he.get_flair_model(self.language, "fn")}',
             'fn_names'      : f'names.txt',
             'fn_stopwords'  : f'stopwords-{self.language}.txt',
         }
         #############################END###############################
 
-        # Load AML
-        self.ws = he.get_aml_ws()
+        # Local artifact cache & store
+        data_config = get_data_config()
+        self.cache = None
+        if not inference and data_config.get('cache', 'true').lower() != 'false':
+            self.cache = cache.ArtifactCache(data_config.get('cache_dir', f'{self.root_dir}cache/'),
+                                                quota_mb = float(data_config.get('cache_quota_mb', 10000)))
+        self.transfer_workers = int(data_config.get('transfer_workers', 8))
+        self.transfer_block_size = int(float(data_config.get('transfer_block_mb', 4)) * 1024 * 1024)
+        self.store = None
+        if 'store' in data_config:
+            ### Filesystem-backed stand-in for remote stores
+            self.store = cache.LocalStore(data_config.get('store'))
+            log.warning(f'[INFO] Using local store: {self.store.root}')
 
-        # Load Storage Account
+        # Remote connections (AML & Storage Account), shared and established on first use
+        #NOTE: never established in inference
+        self.inference = inference
+        self.connections = get_connections()
+
+    @property
+    def ws(self):
+        """Azure Machine Learning Workspace, None in inference"""
+        if self.inference:
+            return None
+        return self.connections.get_ws()
+
+    @property
+    def bbs(self):
+        """Storage Account (BlockBlobService), None in inference"""
+        if self.inference:
+            return None
         try:
-            blob_connection_string = he.get_secret('storage-connection-string')
-            self.bbs = BlockBlobService(connection_string = blob_connection_string)
+            return self.connections.get_bbs()
         except Exception as e:
             log.warning(f'[WARNING] Connection to Storage Account not established, \
                 but may not be needed for local development or endpoint deployment. Details: {e}')
+            return None
 
     def get_path(self, 
                 fn, 
@@ -208,26 +513,64 @@ class Data():
         return fn[:31]
     
     ##### DOWNLOAD #####
+    def _cached_download(self, key, version, target, download):
+        """Restore artifact from the local cache, or download and add it to the cache
+        
+        NOTE: download is a function returning the downloaded paths
+        """
+        if self.cache is not None and self.cache.get(key, version, target):
+            log.info(f'CACHED: {key}, version = {version}')
+            return
+        paths = download()
+        if self.cache is not None:
+            self.cache.put(key, version, target, paths if isinstance(paths, list) else [paths])
+
+    def _get_transfer(self, bbs = None):
+        """Get transfer engine for parallel, resumable block transfers"""
+        return transfer.TransferEngine(transfer.BlobStore(self.bbs if bbs is None else bbs),
+                                        max_workers = self.transfer_workers,
+                                        block_size = self.transfer_block_size)
+
     def _download_blob(self, fn, fp, container):
         """Download from blob storage account"""
-        self.bbs.get_blob_to_path(container, fn, fp)
+        def _download():
+            self._get_transfer().download(container, [(fn, fp)])
+            return [fp]
+        version = self.bbs.get_blob_properties(container, fn).properties.etag
+        self._cached_download(f'blob/{container}/{fn}', version, os.path.dirname(fp), _download)
 
     def _download_datastore(self, fn, dir = 'data_dir'):
         """Download from AML Data Store"""
-        Dataset.get_by_name(workspace = self.ws, name = fn).download(target_path = self.get_path(dir), overwrite = True)
+        from azureml.core import Dataset
+        _dataset = Dataset.get_by_name(workspace = self.ws, name = fn)
+        self._cached_download(f'datastore/{fn}', _dataset.version, self.get_path(dir),
+            lambda: _dataset.download(target_path = self.get_path(dir), overwrite = True))
     
     def _download_model(self, fn, dir = 'model_dir', version = None):
         """Download from AML Model Management"""
+        from azureml.core import Model
         _model = Model(self.ws, name = fn, version = version)
-        _model.download(self.get_path(dir), exist_ok = True)
+        self._cached_download(f'model/{fn}', _model.version, self.get_path(dir),
+            lambda: _model.download(self.get_path(dir), exist_ok = True))
         log.info(f'MODEL INFO: name = {_model.name}, version = {_model.version}')
 
+    def _download_store(self, fn, fp, source, version = None):
+        """Download from local store, the filesystem-backed stand-in for remote stores"""
+        if version is None:
+            version = self.store.get_version(source, fn)
+        target = fp if source != 'blob' else os.path.dirname(fp)
+        self._cached_download(f'{source}/{fn}', version, target,
+            lambda: self.store.download(source, fn, target, version))
+
     def download(self, fn, 
             dir = 'root_dir',
             container=None,
             source='datastore'
             ):
-        """Download file from online storage"""
+        """Download file from online storage
+        
+        Downloads are cached locally, by name, version and content hash.
+        """
         fp = self.get_path(fn, dir = dir)
         fn = self.get_path(fn, dir = None)
 
@@ -236,12 +579,21 @@ class Data():
                 container = self.project_name
             fn = self._get_blob_fn(fn, dir)
             log.debug(f'Starting blob download: {fn}, in {container}')
-            self._download_blob(fn, fp, container)
+            if self.store is not None:
+                self._download_store(f'{container}/{fn}', fp, source)
+            else:
+                self._download_blob(fn, fp, container)
         elif source == 'datastore':
-            self._download_datastore(fn, dir = dir)
+            if self.store is not None:
+                self._download_store(fn, self.get_path(dir), source)
+            else:
+                self._download_datastore(fn, dir = dir)
         elif source == 'model':
             log.debug(f'Starting model download: {self._trim_model_name(fn)}, in {dir}')
-            self._download_model(self._trim_model_name(fn), dir = dir)
+            if self.store is not None:
+                self._download_store(self._trim_model_name(fn), self.get_path(dir), source)
+            else:
+                self._download_model(self._trim_model_name(fn), dir = dir)
         else:
             raise Exception(f'[ERROR] Source <{source}> does not exist. \
                 Cannot download file {fn}.')
@@ -249,18 +601,28 @@ class Data():
 
     ##### UPLOAD #####
     def _upload_blob(self, fn, fp, container):
-        """Upload to blob storage"""
-        self.bbs.create_container(container, fail_on_exist = False)
-        self.bbs.create_blob_from_path(container, fn, fp)
+        """Upload file or directory to blob storage"""
+        self._get_transfer().upload(container, transfer.get_blob_files(fp, fn))
 
     def _upload_datastore(self, fn, fp):
         """Upload dataset to AzureML Datastore
         Note:
         -only works for sinlge/multiple file(s) or single directory
+        -blob datastores with account key use the transfer engine
         """
+        from azureml.core import Dataset
         datastore = self.ws.get_default_datastore()
 
-        if isinstance(fp, list) or os.path.isfile(fp):
+        if getattr(datastore, 'account_key', None) and (isinstance(fp, list) or os.path.exists(fp)):
+            if isinstance(fp, list):
+                files = [(f, f'{fn}/{os.path.basename(f)}') for f in fp]
+            elif os.path.isfile(fp):
+                files = [(fp, f'{fn}/{os.path.basename(fp)}')]
+            else:
+                files = transfer.get_blob_files(fp, fn)
+            bbs = self.connections.get_bbs(account_name = datastore.account_name, account_key = datastore.account_key)
+            self._get_transfer(bbs).upload(datastore.container_name, files)
+        elif isinstance(fp, list) or os.path.isfile(fp):
             if not isinstance(fp, list):
                 fp = [fp]
             datastore.upload_files(fp,
@@ -286,6 +648,7 @@ class Data():
         
         NOTE: expects model folder.
         """
+        from azureml.core import Model
         Model.register( workspace   = self.ws,
                         model_name  = self._trim_model_name(fn),
                         model_path  = fp,
@@ -308,6 +671,17 @@ class Data():
         fp = self.get_path(fn, dir = dir)
         fn = self.get_path(fn, dir = None)
 
+        if self.store is not None:
+            ### Filesystem-backed stand-in for remote stores
+            source = {'dataset': 'datastore'}.get(destination, destination)
+            if destination == 'blob':
+                fn = f'{container or self.project_name}/{self._get_blob_fn(fn, dir)}'
+            elif destination == 'model':
+                fn = self._trim_model_name(fn)
+            version = self.store.upload(source, fn, fp)
+            log.info(f'UPLOADED: {fn} TO: <{destination}>, version = {version}')
+            return
+
         if destination == 'dataset':
             self._upload_datastore(fn, fp)
         elif destination == 'model':
@@ -324,17 +698,24 @@ class Data():
 
     ##### I/O #####
     def save(self, 
-                data, fn, file_type = 'csv', dir = 'root_dir', 
+                data, fn, file_type = None, dir = 'root_dir', 
                 sep = '\t', encoding = 'utf-8', header = True, 
-                index = False, sheet_name = 'Sheet1'
+                index = False, sheet_name = 'Sheet1', compression = 'snappy'
             ):
         """Data saver
         
         Save/dump supported data types in standardized manner.
+        If no file type is given, it is inferred from the file extension (csv or parquet).
+        The compression (snappy, gzip, brotli, zstd or None) only applies to parquet,
+        list, dict and mixed object columns are stored as JSON in parquet and decoded on load.
         """
         fn = self.get_path(fn, dir=dir)
+        if file_type is None:
+            file_type = get_file_type(fn)
         if file_type == 'csv':
             data.to_csv(fn, sep = sep, encoding = encoding, index = index, header = header)
+        elif file_type == 'parquet':
+            write_parquet(data, fn, compression = compression, index = index)
         elif file_type == 'excel':
             data.to_excel(fn, sheet_name = sheet_name, header = header, index = index)
         elif file_type == 'list':
@@ -343,6 +724,8 @@ class Data():
         elif file_type == 'json':
             with open(fn, 'w', encoding = encoding) as f:
                 json.dump(data, f)
+        elif file_type == 'jsonl':
+            data.to_json(fn, orient = 'records', lines = True, force_ascii = False)
         elif file_type == 'numpy':
             np.save(fn, data)
         elif file_type == 'pickle':
@@ -352,18 +735,33 @@ class Data():
             raise Exception(f'[ERROR] - file type ({file_type}) not supported in data saver. {fn} not saved.')
         log.info(f'SAVED: {fn}')
 
+    def writer(self, fn, file_type = None, dir = 'root_dir', sep = '\t', encoding = 'utf-8', compression = 'snappy'):
+        """Chunk writer for csv or parquet files, use as context manager"""
+        return ChunkWriter(self.get_path(fn, dir=dir), file_type = file_type, sep = sep, 
+                            encoding = encoding, compression = compression)
+
     def load(self, 
-                fn, file_type = 'csv', dir = 'root_dir',
+                fn, file_type = None, dir = 'root_dir',
                 sep = '\t', encoding = 'utf-8', header = 'infer', 
-                low_memory = True, dtype = None, sheet_name=0
+                low_memory = True, dtype = None, sheet_name=0,
+                columns = None, chunksize = None
             ):
         """Data loader
         
         Load/read supported data types in standardized manner.
+        If no file type is given, it is inferred from the file extension (csv, jsonl or parquet).
+        Columns can be selected for csv and parquet, parquet only reads the selected columns.
+        If a chunksize is given, an iterator of dataframes with max chunksize rows is returned.
         """
         fn = self.get_path(fn, dir=dir)
+        if file_type is None:
+            file_type = get_file_type(fn)
+        if chunksize is not None:
+            log.info(f'LOADING: {fn} in chunks of {chunksize}')
+            return self._load_chunks(fn, file_type, chunksize, sep=sep, encoding=encoding, 
+                                        header=header, dtype=dtype, columns=columns)
         if file_type == 'csv':
-            data = pd.read_csv(fn, sep=sep, encoding=encoding, header=header, 
+            data = pd.read_csv(fn, sep=sep, encoding=encoding, header=header, usecols=columns,
                                     low_memory=low_memory, dtype=dtype, error_bad_lines=False)
         elif file_type == 'excel':
             data = pd.read_excel(fn, sheet_name=sheet_name, header=header, dtype=dtype)
@@ -372,44 +770,200 @@ class Data():
         elif file_type == 'json':
             with open(fn, encoding=encoding) as f:
                 data = json.load(f)
+        elif file_type == 'jsonl':
+            data = pd.read_json(fn, lines=True, encoding=encoding, dtype=dtype)
+            if columns is not None:
+                data = data[columns]
         elif file_type == 'numpy':
             data = np.load(fn, allow_pickle=True)
         elif file_type == 'pickle':
             with open(fn, 'rb') as f:
                 data = pickle.load(f)
         elif file_type == 'parquet':
-            data = pd.read_parquet(fn)
+            import pyarrow.parquet as pq
+            data = pd.read_parquet(fn, columns=columns)
+            data = from_parquet_compatible(data, get_json_columns(pq.read_schema(fn)))
+            if dtype is not None:
+                data = data.astype(dtype)
         else:
             raise Exception(f'[ERROR] - file type ({file_type}) not supported in data loader. {fn} not loaded.')
         log.info(f'LOADED: {fn}')
         return data
 
+    def _load_chunks(self, fn, file_type, chunksize, sep = '\t', encoding = 'utf-8', 
+                        header = 'infer', dtype = None, columns = None):
+        """Iterate over tabular files in chunks, for data larger than memory"""
+        if file_type == 'csv':
+            chunks = pd.read_csv(fn, sep=sep, encoding=encoding, header=header, usecols=columns,
+                                    dtype=dtype, chunksize=chunksize, error_bad_lines=False)
+        elif file_type == 'jsonl':
+            chunks = pd.read_json(fn, lines=True, encoding=encoding, dtype=dtype, chunksize=chunksize)
+        elif file_type == 'parquet':
+            import pyarrow.parquet as pq
+            pf = pq.ParquetFile(fn)
+            encoded = get_json_columns(pf.schema_arrow)
+            chunks = (from_parquet_compatible(batch.to_pandas(), encoded) for batch in 
+                        pf.iter_batches(batch_size=chunksize, columns=columns))
+        else:
+            raise Exception(f'[ERROR] - file type ({file_type}) not supported in chunked data loader. {fn} not loaded.')
+        for chunk in chunks:
+            if columns is not None and file_type == 'jsonl':
+                chunk = chunk[columns]
+            if dtype is not None and file_type == 'parquet':
+                chunk = chunk.astype(dtype)
+            yield chunk
+        log.info(f'LOADED: {fn}')
+
 ############################################
 #####   Fetch from CosmosDB
 ############################################
 
-def get_data():
-    # Query for CosmosDB
-    CONFIG = {
-        "ENDPOINT": f"https://{he.get_secret('cosmos-db-name')}.documents.azure.com:443/",
-        "PRIMARYKEY": he.get_secret('cosmos-db-key'),
-        "DATABASE": "data", 
-        "CONTAINER": "documents"
-    }
-    CONTAINER_LINK = f"dbs/{CONFIG['DATABASE']}/colls/{CONFIG['CONTAINER']}"
+def get_query(since=None):
+    """Get container link, query and feed options for the training documents
+    
+    If since (timestamp) is given, all documents created or changed since then are queried,
+    regardless of their status. Documents that are no longer for training are then removed
+    by the merge (see filter_status). Hard deletes are not part of the delta, they need 
+    a full run (prepare --do_format).
+    """
+    CONTAINER_LINK = "dbs/data/colls/documents"
     FEEDOPTIONS = {}
     FEEDOPTIONS["enableCrossPartitionQuery"] = True
-    QUERY = {
-        "query": f"SELECT * from c where c.status = 'train' and CONTAINS(c.language, '{cu.params.get('language')}')"
-    }
-    # Initialize the Cosmos client
-    client = cosmos_client.CosmosClient(
-        url_connection=CONFIG["ENDPOINT"], auth={"masterKey": CONFIG["PRIMARYKEY"]}
+    if since is None:
+        QUERY = {
+            "query": f"SELECT * from c where c.status = 'train' and CONTAINS(c.language, '{cu.params.get('language')}')"
+        }
+    else:
+        QUERY = {
+            "query": f"SELECT * from c where CONTAINS(c.language, '{cu.params.get('language')}') and c._ts >= {int(since)}"
+        }
+    return CONTAINER_LINK, QUERY, FEEDOPTIONS
+
+def filter_status(data, status='train'):
+    """Keep documents of a status, all documents if there is no status field"""
+    if 'status' not in data.columns:
+        return data
+    return data[data.status == status]
+
+def get_client():
+    """Initialize the Cosmos client"""
+    from azure.cosmos import cosmos_client
+    return cosmos_client.CosmosClient(
+        url_connection=f"https://{he.get_secret('cosmos-db-name')}.documents.azure.com:443/", 
+        auth={"masterKey": he.get_secret('cosmos-db-key')}
     )
+
+def get_data(client=None, options=None, since=None):
+    # Query for CosmosDB
+    CONTAINER_LINK, QUERY, FEEDOPTIONS = get_query(since=since)
+    if client is None:
+        client = get_client()
     # Query for some data
-    results = client.QueryItems(CONTAINER_LINK, QUERY, FEEDOPTIONS)
+    results = client.QueryItems(CONTAINER_LINK, QUERY, {**FEEDOPTIONS, **(options or {})})
     return results
 
+def get_pages(client=None, page_size=1000, continuation=None, since=None):
+    """Page through query results
+    
+    Yields the documents of each page and the continuation token 
+    for the next page (None for the last page).
+    """
+    if client is None:
+        client = get_client()
+    options = {'maxItemCount': page_size}
+    if continuation is not None:
+        options['continuation'] = continuation
+    results = get_data(client=client, options=options, since=since)
+    while True:
+        documents = results.fetch_next_block()
+        continuation = (client.last_response_headers or {}).get('x-ms-continuation')
+        if len(documents) > 0 or continuation is None:
+            yield documents, continuation or None
+        if not continuation:
+            break
+
+class LocalCosmosClient():
+    """In-memory stand-in for the Cosmos client, for local testing
+    
+    NOTE: the query is not evaluated, documents are expected to be filtered.
+    """
+    def __init__(self, documents):
+        self.documents = documents
+        self.last_response_headers = {}
+
+    def QueryItems(self, link, query, options=None):
+        self.last_query = query
+        return LocalQueryIterable(self, options or {})
+
+class LocalQueryIterable():
+    def __init__(self, client, options):
+        self.client = client
+        self.page_size = options.get('maxItemCount') or 100
+        self.position = int(options.get('continuation') or 0)
+
+    def fetch_next_block(self):
+        documents = self.client.documents[self.position:self.position + self.page_size]
+        self.position += len(documents)
+        self.client.last_response_headers = {'x-ms-continuation': 
+            str(self.position) if self.position < len(self.client.documents) else None}
+        return documents
+
+    def __iter__(self):
+        while True:
+            documents = self.fetch_next_block()
+            yield from documents
+            if self.client.last_response_headers.get('x-ms-continuation') is None:
+                break
+
+def get_batches(cl, client=None, page_size=1000, since=None, refresh=False):
+    """Stream documents from Cosmos DB as flattened dataframe batches
+    
+    Progress is checkpointed to the raw directory, so a failed pull 
+    resumes from the last completed page. With refresh, a checkpoint of 
+    a completed pull (left by a run that failed afterwards) is discarded
+    and the documents are fetched again.
+    """
+    fn_state = cl.dt.get_path('fn_cdb_state', dir='raw_dir')
+    state = None
+    if os.path.isfile(fn_state):
+        state = cl.dt.load('fn_cdb_state', file_type='json', dir='raw_dir')
+        if refresh and state.get('complete'):
+            log.warning('[INFO] Discarding checkpoint of a completed Cosmos DB pull')
+            clear_batches(cl)
+            state = None
+        elif state.get('since') == since:
+            log.warning(f'[INFO] Resuming Cosmos DB pull after {state["batches"]} batches, {state["documents"]} documents')
+        else:
+            clear_batches(cl)
+            state = None
+    if state is None:
+        state = dict(continuation=None, batches=0, documents=0, complete=False, since=since)
+    
+    # Load completed batches
+    for i in range(state['batches']):
+        yield cl.dt.load(f'cdb-l{cl.dt.language}-{i:05d}.pkl', file_type='pickle', dir='raw_dir')
+    
+    # Fetch remaining pages
+    if not state['complete']:
+        for documents, continuation in get_pages(client, page_size, state['continuation'], since=since):
+            batch = cu.prepare_source(documents)
+            cl.dt.save(batch, f'cdb-l{cl.dt.language}-{state["batches"]:05d}.pkl', file_type='pickle', dir='raw_dir')
+            state = dict(continuation=continuation, batches=state['batches'] + 1, 
+                            documents=state['documents'] + len(documents), complete=continuation is None,
+                            since=since)
+            cl.dt.save(state, 'fn_cdb_state', file_type='json', dir='raw_dir')
+            yield batch
+    log.warning(f'[INFO] Fetched {state["documents"]} documents from Cosmos DB')
+
+def clear_batches(cl):
+    """Remove checkpointed batches, after a completed pull"""
+    if not os.path.isfile(cl.dt.get_path('fn_cdb_state', dir='raw_dir')):
+        return
+    state = cl.dt.load('fn_cdb_state', file_type='json', dir='raw_dir')
+    for i in range(state['batches']):
+        os.remove(cl.dt.get_path(f'cdb-l{cl.dt.language}-{i:05d}.pkl', dir='raw_dir'))
+    os.remove(cl.dt.get_path('fn_cdb_state', dir='raw_dir'))
+
 def get_label(obj, task):
     out = dict()
     for o in obj:
@@ -424,27 +978,100 @@ def get_label(obj, task):
                 out[_key] = _value
     return out
 
-def get_dataset(cl, source="cdb"):
+def get_labels(data, fields=('label_classification', 'label_answer')):
+    """Flatten the nested label structures of all label fields in one pass
+
+    Same columns as get_label, collected into one array per label column.
+    Returns a DataFrame of label columns, aligned with the data.
+    """
+    n = len(data)
+    columns = dict()
+    for field in fields:
+        if field not in data.columns:
+            continue
+        is_class = 'class' in field
+        _columns = dict()
+        values = data[field].values
+        for i in np.flatnonzero(data[field].notna().values).tolist():
+            for o in values[i]:
+                if is_class:
+                    items = ((o.get('task_type'), o.get('version')[0].get('value')),)
+                else:
+                    items = o.items()
+                for k, v in items:
+                    col = _columns.get(k)
+                    if col is None:
+                        col = _columns[k] = [np.nan] * n
+                    col[i] = v
+        columns.update({f'{field}_{k}': v for k, v in _columns.items()})
+    return pd.DataFrame(columns, index = data.index)
+
+def format_batch(data):
+    """Flatten the label fields of a batch of source documents"""
+    data = pd.concat([data, get_labels(data)], axis = 1)
+    #TODO: temporary workaround for data
+    if 'label_classification_simple' in data.columns:
+        data['label_classification_multi'] = data['label_classification_simple']
+        data['label_classification_simple'] = data['label_classification_simple'].str.replace(r',.*', '', regex = True)
+    ##end temp workaround
+    # Same prepare columns in every batch, also without labels
+    columns = [c for _columns in cu.prepare_columns.values() for c in _columns if c not in data.columns]
+    return data.reindex(columns = list(data.columns) + list(dict.fromkeys(columns)))
+
+def iter_dataset(cl, client=None, page_size=1000, refresh=False):
+    """Stream formatted source batches from Cosmos DB, while storing them as fn_prep
+
+    fn_prep is only replaced once all batches are consumed.
+    """
+    with cl.dt.writer('fn_prep', dir = 'data_dir') as writer:
+        for batch in get_batches(cl, client=client, page_size=page_size, refresh=refresh):
+            if len(batch) == 0:
+                continue
+            batch = format_batch(batch)
+            writer.write(batch)
+            yield batch
+    clear_batches(cl)
+
+def get_dataset(cl, source="cdb", client=None, page_size=1000, since=None, refresh=False):
+    """Fetch and format source data, stored as fn_prep
+
+    If since (timestamp) is given, only new or changed documents are fetched
+    and merged into the existing fn_prep: changed documents are replaced, those
+    no longer for training removed. The whole delta is returned, also the documents
+    that are no longer for training (to be removed from the cleaned data).
+    A full pull from Cosmos DB is streamed to fn_prep, which is then loaded once.
+    """
     # Transform request result
     if source == "cdb":
-        results = get_data()
-        data = cu.prepare_source(results)
-        if 'label_classification' in data.columns:
-            lbl_class = data.label_classification.apply(lambda x: get_label(x, 'label_classification')).to_list()
-            data = pd.concat([data, pd.DataFrame(lbl_class)], axis = 1)
-        #TODO: temporary workaround for data
-        data['label_classification_multi'] = data['label_classification_simple']
-        data['label_classification_simple'] = data['label_classification_simple'].apply(lambda x: x.split(',')[0])
-        ##end temp workaround
-        if 'label_ner' in data.columns:
-            label_ner = data.label_answer.apply(lambda x: get_label(x, 'label_ner')).to_list()
-            data = pd.concat([data, pd.DataFrame(label_ner)], axis = 1)
-        if 'label_answer' in data.columns:
-            lbl_answer = data.label_answer.apply(lambda x: get_label(x, 'label_answer')).to_list()
-            data = pd.concat([data, pd.DataFrame(lbl_answer)], axis = 1)
+        if since is None:
+            for __ in iter_dataset(cl, client=client, page_size=page_size, refresh=refresh):
+                pass
+            if not os.path.isfile(cl.dt.get_path('fn_prep', dir = 'data_dir')):
+                log.warning('[INFO] No documents fetched from Cosmos DB')
+                return pd.DataFrame()
+            return cl.dt.load('fn_prep', dir = 'data_dir')
+        batches = [format_batch(b) for b in get_batches(cl, client=client, page_size=page_size, since=since) if len(b) > 0]
+        data = pd.concat(batches, ignore_index=True, sort=False) if len(batches) > 0 else pd.DataFrame()
+        del batches
+        if len(data) == 0:
+            log.warning('[INFO] No documents fetched from Cosmos DB')
+            clear_batches(cl)
+            return data
     elif source == "datastore":
         if not os.path.isfile(cl.dt.get_path('fn_source')):
             cl.dt.download('fn_source', dir = 'root_dir', source = 'datastore')
         data = cl.dt.process(data_type=cu.params.get('prepare').get('data_type'))
-    cl.dt.save(data, 'fn_prep', dir = 'data_dir')
+    if since is not None and os.path.isfile(cl.dt.get_path('fn_prep', dir = 'data_dir')):
+        ### Merge new & changed documents, chunk by chunk
+        ids = set(data.id.astype(str))
+        with cl.dt.writer('fn_prep', dir = 'data_dir') as writer:
+            for prep in cl.dt.load('fn_prep', dir = 'data_dir', chunksize = max(page_size, 10000)):
+                prep = prep[~prep.id.astype(str).isin(ids)]
+                if len(prep) > 0:
+                    writer.write(prep)
+            writer.write(filter_status(data))
+    else:
+        cl.dt.save(filter_status(data), 'fn_prep', dir = 'data_dir')
+    if source == "cdb":
+        clear_batches(cl)
     return data
\ No newline at end of file
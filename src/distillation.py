@@ -0,0 +1,477 @@
+"""
+DISTILL CLASSIFICATION MODEL
+
+Trains a small student model on the soft labels of a trained teacher model,
+for faster CPU inference. The student is either a distilled language model
+(e.g. distilbert, distilroberta), or the teacher with fewer layers.
+
+Before running distillation, you need to train the teacher with classification.py
+(or multi_classification.py). By default, the teacher is loaded from the model
+directory of the task. The student is saved to its own directory (<model dir>-student),
+with --promote it replaces the teacher in the model directory, the teacher is 
+kept in <model dir>-teacher.
+
+Example (in the command line):
+> cd to root dir
+> conda activate nlp
+> python src/classification.py --task 1 --model_type roberta --use_cuda
+> python src/distillation.py --task 1 --student_type distilroberta --use_cuda
+> python src/distillation.py --task 1 --student_layers 6 --use_cuda --promote
+
+"""
+import os
+import json
+import shutil
+import hashlib
+import argparse
+from pathlib import Path
+
+import torch
+from farm.data_handler.processor import TextClassificationProcessor
+from farm.modeling.optimization import initialize_optimizer
+from farm.modeling.adaptive_model import AdaptiveModel
+from farm.modeling.language_model import LanguageModel
+from farm.modeling.tokenization import Tokenizer
+from farm.train import Trainer
+from farm.utils import set_all_seeds, initialize_device_settings
+
+# Custom functions
+import sys
+sys.path.append('./src')
+import helper as he
+import data as dt
+import custom as cu
+import cache
+import features as fe
+import export as ex
+import classification as cl
+
+# Logger
+logger = he.get_logger(location=__name__)
+aml_run = he.get_context()
+
+############################################
+#####   Soft Labels
+############################################
+
+def get_teacher(teacher_dir):
+    """Teacher model directory & prediction head, resolves the head of a multi-task model"""
+    shared = ex.get_shared(teacher_dir)
+    if shared is None:
+        return teacher_dir, 0
+    return dt.Data(task=shared['task']).get_path('model_dir'), shared['head']
+
+def get_teacher_logits(teacher_dir, texts, label_list, multilabel, head=0, batch_size=32, use_cuda=False, max_seq_len=256):
+    """Run the teacher (head) once over the texts, returns logits aligned to label_list
+
+    FARM returns probabilities, they are converted back to logits (log for softmax,
+    logit for sigmoid), which is exact up to a constant per sample.
+    """
+    teacher = fe.PaddedInferencer.load(teacher_dir, batch_size=batch_size, gpu=use_cuda, return_class_probs=True,
+                                max_seq_len=max_seq_len, num_processes=0)
+    task_name = teacher.model.prediction_heads[head].task_name
+    teacher_labels = teacher.processor.tasks[task_name]['label_list']
+    if sorted(teacher_labels) != sorted(label_list):
+        raise Exception('TEACHER LABELS DO NOT MATCH TASK LABELS')
+    order = [teacher_labels.index(l) for l in label_list]
+
+    result = teacher.inference_by_heads(dicts=[{"text": t} for t in texts])[head]
+    probs = torch.tensor([list(p['probability']) for r in result for p in r['predictions']], dtype=torch.float)
+    probs = probs[:, order].clamp(1e-7, 1 - 1e-7)
+    if multilabel:
+        return torch.log(probs / (1 - probs))
+    return torch.log(probs)
+
+def get_soft_labels(teacher_dir, train_file, processor, multilabel, head=0, cache_dir=None, **kwargs):
+    """Teacher logits of all training texts, cached by teacher model (head) & training data
+
+    Returns the logits and a lookup of text to row.
+    """
+    dicts = processor.file_to_dicts(train_file)
+    texts = sorted({d['text'] for d in dicts})
+    ## Labels of the student task
+    label_list = list(processor.tasks.values())[0]['label_list']
+
+    fp = None
+    if cache_dir is not None:
+        key = {
+            'teacher'       : [cache.get_hash(f) for f in sorted(Path(teacher_dir).glob('*.bin'))],
+            'head'          : head,
+            'train'         : cache.get_hash(train_file),
+            'label_list'    : label_list,
+            'multilabel'    : multilabel
+        }
+        fp = Path(cache_dir) / f"{hashlib.sha256(json.dumps(key).encode()).hexdigest()}.pt"
+        if fp.is_file():
+            logger.warning(f'[INFO] Loading soft labels from cache -> {fp}')
+            return torch.load(fp), {t: i for i, t in enumerate(texts)}
+
+    logits = get_teacher_logits(teacher_dir, texts, label_list, multilabel, head=head, **kwargs)
+    if fp is not None:
+        fp.parent.mkdir(parents=True, exist_ok=True)
+        torch.save(logits, fp)
+        logger.warning(f'[INFO] Cached soft labels -> {fp}')
+    return logits, {t: i for i, t in enumerate(texts)}
+
+class DistillationProcessor(TextClassificationProcessor):
+    """Text classification processor, which adds the row of the teacher soft label to the features
+
+    Texts without soft label (e.g. test set) get -1.
+    """
+    def __init__(self, soft_label_ids=None, **kwargs):
+        super().__init__(**kwargs)
+        self._soft_label_ids = soft_label_ids or {}
+
+    def _sample_to_features(self, sample) -> dict:
+        features = super()._sample_to_features(sample)
+        for f in features:
+            f['teacher_ids'] = self._soft_label_ids.get(sample.clear_text.get('text'), -1)
+        return features
+
+############################################
+#####   Student
+############################################
+
+class DistillationModel(AdaptiveModel):
+    """AdaptiveModel trained on hard labels and temperature scaled teacher logits
+
+    loss = (1 - alpha) * hard loss + alpha * temperature^2 * soft loss
+
+    The soft loss is the KL divergence of the softmax (single label), or the binary
+    cross entropy of the sigmoid (multi label) outputs. Saved like an AdaptiveModel.
+    """
+    def __init__(self, soft_labels, multilabel=False, temperature=2.0, alpha=0.5, **kwargs):
+        super().__init__(**kwargs)
+        self.soft_labels = soft_labels
+        self.multilabel = multilabel
+        self.temperature = temperature
+        self.alpha = alpha
+
+    def logits_to_loss(self, logits, global_step=None, **kwargs):
+        loss = super().logits_to_loss(logits, global_step=global_step, **kwargs)
+        ids = kwargs.get('teacher_ids')
+        if ids is None:
+            return loss
+        mask = ids >= 0
+        if not mask.any():
+            return loss
+        t = self.temperature
+        student = logits[0][mask] / t
+        if self.soft_labels.device != student.device:
+            self.soft_labels = self.soft_labels.to(student.device)
+        teacher = self.soft_labels[ids[mask]] / t
+        if self.multilabel:
+            soft = torch.nn.functional.binary_cross_entropy_with_logits(student, torch.sigmoid(teacher),
+                                                                        reduction='none').mean(1)
+        else:
+            soft = (torch.softmax(teacher, 1) * (torch.log_softmax(teacher, 1) - torch.log_softmax(student, 1))).sum(1)
+        distill = torch.zeros_like(loss)
+        distill[mask] = soft * t * t
+        return torch.where(mask, (1 - self.alpha) * loss + self.alpha * distill, loss)
+
+def to_adaptive_model(model):
+    """Plain AdaptiveModel of a trained student, without the soft labels
+
+    Exported variants are pickled as a whole (torch.save), and have to load without 
+    the distillation module (and its __main__ class, if run as script).
+    """
+    return AdaptiveModel(
+        language_model=model.language_model,
+        prediction_heads=model.prediction_heads,
+        embeds_dropout_prob=model.dropout.p,
+        lm_output_types=model.lm_output_types,
+        device=model.device
+    )
+
+def truncate_layers(language_model, n_layers):
+    """Keep n_layers evenly spaced transformer layers of a language model"""
+    hf_model = language_model.model
+    if hasattr(hf_model, 'encoder'):
+        ### BERT, RoBERTa, CamemBERT, XLM-R
+        layers = hf_model.encoder.layer
+    else:
+        ### DistilBERT
+        layers = hf_model.transformer.layer
+    keep = sorted({round(i * (len(layers) - 1) / max(n_layers - 1, 1)) for i in range(n_layers)})
+    layers = torch.nn.ModuleList([layers[i] for i in keep])
+    if hasattr(hf_model, 'encoder'):
+        hf_model.encoder.layer = layers
+        hf_model.config.num_hidden_layers = len(keep)
+    else:
+        hf_model.transformer.layer = layers
+        hf_model.transformer.n_layers = len(keep)
+        hf_model.config.n_layers = len(keep)
+    return language_model
+
+def promote_student(student_dir, save_dir):
+    """Replace the model in save_dir by the student, the previous model is kept in <save_dir>-teacher"""
+    backup_dir = f'{save_dir}-teacher'
+    if os.path.isdir(save_dir):
+        shutil.rmtree(backup_dir, ignore_errors=True)
+        os.replace(save_dir, backup_dir)
+        logger.warning(f'[INFO] Previous model moved to {backup_dir}')
+    os.replace(student_dir, save_dir)
+    logger.warning(f'[INFO] Student promoted to {save_dir}')
+
+def doc_distillation(task, teacher_dir, student_type, student_layers, n_epochs, batch_size, embeds_dropout,
+                        evaluate_every, use_cuda, max_seq_len, learning_rate, do_lower_case,
+                        register_model, temperature=2.0, alpha=0.5, save_model=True,
+                        featurize_workers=128, featurize_chunksize=2000, bucketing=True,
+                        quantize=True, max_quantization_delta=0.01, export_onnx=False,
+                        student_dir=None, promote=False):
+
+    language = cu.params.get('language')
+
+    # Check task
+    task_type = cl.get_task_type(task)
+    multilabel = task_type == 'multi_classification'
+    if student_type is None and student_layers is None:
+        raise Exception('STUDENT TYPE OR STUDENT LAYERS REQUIRED')
+    if register_model and not promote:
+        raise Exception('REGISTER MODEL REQUIRES --promote, THE STUDENT IS NOT IN THE MODEL DIRECTORY')
+
+    # Data
+    dt_task = dt.Data(task=task)
+    ## Download training files
+    if not os.path.isfile(dt_task.get_path('fn_train', dir='data_dir')):
+        dt_task.download('data_dir', dir = 'data_dir', source = 'datastore')
+
+    # Settings
+    set_all_seeds(seed=42)
+    use_amp = None
+    device, n_gpu = initialize_device_settings(use_cuda = use_cuda, use_amp = use_amp)
+    save_dir = dt_task.get_path('model_dir')
+    teacher_dir = teacher_dir or save_dir
+    ## Head of a multi-task teacher
+    teacher_dir, teacher_head = get_teacher(teacher_dir)
+    ## The student is saved to its own directory, never over the teacher
+    student_dir = student_dir or f'{save_dir}-student'
+    if os.path.abspath(student_dir) == os.path.abspath(teacher_dir):
+        raise Exception('STUDENT DIR MUST DIFFER FROM TEACHER DIR')
+    ## The heads of a multi-task model serve further tasks, it is not replaced by a single task student
+    if promote and any((ex.get_shared(dt.Data(task=t).get_path('model_dir')) or {}).get('task') == task
+                        for t, c in cu.tasks.items() if c.get('type') in cl.head_lookup):
+        raise Exception('MODEL OF THE TASK IS SHARED WITH OTHER TASKS (MULTI-TASK), IT CANNOT BE REPLACED BY THE STUDENT')
+    ## Student from a distilled language model, or from the teacher with fewer layers
+    lang_model = he.get_farm_model(student_type, language) if student_type is not None else teacher_dir
+    label_list = dt_task.load('fn_label', dir = 'data_dir', header = None)[0].to_list()
+
+    # AML log
+    try:
+        aml_run.log('task', task)
+        aml_run.log('language', language)
+        aml_run.log('n_epochs', n_epochs)
+        aml_run.log('batch_size', batch_size)
+        aml_run.log('learning_rate', learning_rate)
+        aml_run.log('max_seq_len', max_seq_len)
+        aml_run.log('lang_model', str(lang_model))
+        aml_run.log('student_layers', student_layers)
+        aml_run.log('temperature', temperature)
+        aml_run.log('alpha', alpha)
+    except:
+        pass
+
+    # 1.Create a tokenizer
+    tokenizer = Tokenizer.load(
+        pretrained_model_name_or_path=lang_model,
+        do_lower_case = do_lower_case
+    )
+
+    metric = cl.register_metric()
+
+    # 2. Processors, with soft labels for training, without for the saved model
+    processor_params = cl.get_processor_params(dt_task, task_type, tokenizer, max_seq_len, label_list, metric)
+    processor = TextClassificationProcessor(**processor_params)
+
+    ## Teacher soft labels, computed once per teacher and training data
+    cache_path = fe.get_cache_path(dt_task)
+    soft_labels, soft_label_ids = get_soft_labels(teacher_dir, dt_task.get_path('fn_train', dir ='data_dir'),
+                                        processor, multilabel, head = teacher_head,
+                                        cache_dir = cache_path.parent / 'soft_labels' if cache_path else None,
+                                        batch_size = batch_size, use_cuda = use_cuda, max_seq_len = max_seq_len)
+    train_processor = DistillationProcessor(soft_label_ids=soft_label_ids, **processor_params)
+
+    # 3. Create a DataSilo that loads several datasets (train/dev/test), provides DataLoaders for them and calculates a few descriptive statistics of our datasets
+    data_silo = fe.CachedDataSilo(
+        processor=train_processor,
+        batch_size=batch_size,
+        lang_model=lang_model,
+        do_lower_case=do_lower_case,
+        cache_path=cache_path,
+        max_processes=featurize_workers,
+        max_chunksize=featurize_chunksize,
+        bucketing=bucketing
+    )
+    data_silo.log_stats(aml_run)
+
+    # 4. Create the student
+    language_model = LanguageModel.load(lang_model)
+    if student_layers is not None:
+        language_model = truncate_layers(language_model, student_layers)
+    prediction_head = cl.head_lookup[task_type](num_labels=len(label_list))
+
+    model = DistillationModel(
+        soft_labels=soft_labels,
+        multilabel=multilabel,
+        temperature=temperature,
+        alpha=alpha,
+        language_model=language_model,
+        prediction_heads=[prediction_head],
+        embeds_dropout_prob=embeds_dropout,
+        lm_output_types=["per_sequence"],
+        device=device
+    )
+
+    # 5. Create an optimizer
+    model, optimizer, lr_schedule = initialize_optimizer(
+        model=model,
+        n_batches=len(data_silo.loaders["train"]),
+        n_epochs=n_epochs,
+        device=device,
+        learning_rate=learning_rate,
+        use_amp=use_amp
+    )
+
+    # 6. Feed everything to the Trainer
+    trainer = Trainer(
+        model=model,
+        optimizer=optimizer,
+        data_silo=data_silo,
+        epochs=n_epochs,
+        n_gpu=n_gpu,
+        lr_schedule=lr_schedule,
+        evaluate_every=evaluate_every,
+        device=device
+    )
+
+    # 7. Let it grow
+    trainer.train()
+
+    # 8. Store it, with the processor without soft labels
+    if save_model:
+        model.save(student_dir)
+        processor.save(student_dir)
+
+        # 9. Export variants for CPU inference (int8 quantized, ONNX), if accurate enough on the test set
+        model = to_adaptive_model(model)
+        cl.export_variants(model, processor, data_silo.get_data_loader("test"), student_dir, device, quantize=quantize,
+                            max_quantization_delta=max_quantization_delta, export_onnx=export_onnx)
+
+        # 10. Replace the model of the task by the student
+        if promote:
+            promote_student(student_dir, save_dir)
+
+        if register_model:
+            dt_task.upload('model_dir', destination='model')
+
+def run():
+    # Run arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--task",
+                    default=1,
+                    type=int,
+                    help="Task where: \
+                            -task 1 : classification subcat \
+                            -task 2 : classification cat")
+    parser.add_argument("--teacher_dir",
+                    default=None,
+                    type=str,
+                    help="Directory of the trained teacher model, default is the model directory of the task")
+    parser.add_argument("--student_dir",
+                    default=None,
+                    type=str,
+                    help="Directory the student is saved to, default is <model dir>-student")
+    parser.add_argument('--promote',
+                        action='store_true',
+                        help="Replace the model of the task by the student, the teacher is kept in <model dir>-teacher")
+    parser.add_argument("--student_type",
+                    default=None,
+                    type=str,
+                    help="Distilled model types: \
+                            -distilbert: en/de/xx \
+                            -distilroberta: en/de/fr/es/it")
+    parser.add_argument("--student_layers",
+                    default=None,
+                    type=int,
+                    help="Number of transformer layers, if the student is the teacher with fewer layers")
+    parser.add_argument('--temperature',
+                    default=2.0,
+                    type=float,
+                    help='Softmax/sigmoid temperature of the soft labels')
+    parser.add_argument('--alpha',
+                    default=0.5,
+                    type=float,
+                    help='Weight of the soft label loss, vs. the hard label loss')
+    parser.add_argument('--use_cuda',
+                        action='store_true',
+                        help="Use CUDA for training")
+    parser.add_argument('--n_epochs',
+                    default=3,
+                    type=int,
+                    help='')
+    parser.add_argument('--batch_size',
+                    default=32,
+                    type=int,
+                    help='')
+    parser.add_argument('--embeds_dropout',
+                    default=0.2,
+                    type=float,
+                    help='')
+    parser.add_argument('--evaluate_every',
+                    default=3000,
+                    type=int,
+                    help='')
+    parser.add_argument('--max_seq_len',
+                    default=128,
+                    type=int,
+                    help='')
+    parser.add_argument('--learning_rate',
+                    default=5e-5,
+                    type=float,
+                    help='')
+    parser.add_argument('--do_lower_case',
+                        action='store_true',
+                        help="")
+    parser.add_argument('--register_model',
+                        action='store_true',
+                        help="Register model in AML")
+    parser.add_argument('--featurize_workers',
+                    default=128,
+                    type=int,
+                    help="Max number of processes for featurization (tokenization), 1 disables multiprocessing")
+    parser.add_argument('--featurize_chunksize',
+                    default=2000,
+                    type=int,
+                    help="Max number of samples per featurization chunk")
+    parser.add_argument('--no_bucketing',
+                        action='store_true',
+                        help="Pad all batches to max_seq_len, instead of batching by length with dynamic padding")
+    parser.add_argument('--no_quantize',
+                        action='store_true',
+                        help="Do not export an int8 quantized model for CPU inference")
+    parser.add_argument('--max_quantization_delta',
+                    default=0.01,
+                    type=float,
+                    help="Max accuracy loss on the test set, for the quantized model to be exported")
+    parser.add_argument('--export_onnx',
+                        action='store_true',
+                        help="Export an ONNX model, served with ONNX Runtime on CPU")
+    args = parser.parse_args()
+
+    doc_distillation(args.task, args.teacher_dir, args.student_type, args.student_layers,
+                    args.n_epochs, args.batch_size, args.embeds_dropout, args.evaluate_every,
+                    args.use_cuda, args.max_seq_len, args.learning_rate,
+                    args.do_lower_case, args.register_model,
+                    temperature=args.temperature,
+                    alpha=args.alpha,
+                    featurize_workers=args.featurize_workers,
+                    featurize_chunksize=args.featurize_chunksize,
+                    bucketing=not args.no_bucketing,
+                    quantize=not args.no_quantize,
+                    max_quantization_delta=args.max_quantization_delta,
+                    export_onnx=args.export_onnx,
+                    student_dir=args.student_dir,
+                    promote=args.promote)
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,294 @@
+"""
+EXPORT TRAINED MODELS FOR CPU INFERENCE
+
+Variants are stored next to the full precision model, and are uploaded with it:
+
+model_dir/                  <- full precision FARM model & processor
+model_dir/quantized/        <- dynamic int8 quantization of the linear layers
+model_dir/onnx/             <- ONNX graph of language model & prediction head, for ONNX Runtime
+
+A variant is only kept, if its accuracy on the test set is close to the full
+precision model. infer.score loads the fastest variant, which exists.
+
+The further tasks of a multi-task model have no model of their own:
+
+model_dir/shared.json       <- task of the multi-task model & index of the prediction head
+"""
+import logging
+log = logging.getLogger(__name__)
+
+import os
+import json
+import time
+import shutil
+from pathlib import Path
+
+import torch
+from farm.data_handler.processor import Processor
+from farm.modeling.adaptive_model import ONNXAdaptiveModel, ONNXWrapper
+
+# Custom functions
+import sys
+sys.path.append('./src')
+import features as fe
+
+quantized_dir = 'quantized'
+onnx_dir = 'onnx'
+fn_quantized = 'model.pt'
+fn_onnx = 'model.onnx'
+fn_report = 'export.json'
+fn_shared = 'shared.json'
+
+# Serving preference, if backend is 'auto'
+backends = ['onnx', 'quantized', 'pytorch']
+
+############################################
+#####   Evaluation
+############################################
+
+def get_predictions(model, data_loader, device):
+    """Predictions & labels of the first prediction head"""
+    model.eval()
+    preds, labels = [], []
+    head = model.prediction_heads[0]
+    start = time.perf_counter()
+    for batch in data_loader:
+        batch = {key: batch[key].to(device) for key in batch}
+        with torch.no_grad():
+            logits = model.forward(**batch)
+            preds += head.logits_to_preds(logits=logits[0])
+            labels += head.prepare_labels(**batch)
+    return preds, labels, time.perf_counter() - start
+
+def get_accuracy(preds, labels):
+    """Share of exact matches, for single labels & lists of labels"""
+    if len(labels) == 0:
+        return 0.0
+    return sum(p == l for p, l in zip(preds, labels)) / len(labels)
+
+def get_size(path):
+    """Size of a file or directory in MB"""
+    path = Path(path)
+    files = [path] if path.is_file() else [p for p in path.rglob('*') if p.is_file()]
+    return sum(f.stat().st_size for f in files) / 1e6
+
+def compare(model, variant, data_loader, device, max_delta=0.01, reference=None):
+    """Compare a CPU variant to the full precision model on the test set
+
+    The variant is accepted, if its accuracy is at most max_delta below the model.
+    Predictions of the model can be passed as reference, to evaluate it only once.
+    """
+    preds, labels, t_fp32 = reference or get_predictions(model, data_loader, device)
+    preds_var, __, t_var = get_predictions(variant, data_loader, 'cpu')
+    acc_fp32 = get_accuracy(preds, labels)
+    acc_var = get_accuracy(preds_var, labels)
+    return dict(
+        samples = len(labels),
+        acc_fp32 = acc_fp32,
+        acc_variant = acc_var,
+        acc_delta = acc_var - acc_fp32,
+        agreement = get_accuracy(preds_var, preds),
+        seconds_fp32 = t_fp32,
+        seconds_variant = t_var,
+        device_fp32 = str(device),
+        max_delta = max_delta,
+        exported = acc_fp32 - acc_var <= max_delta
+    )
+
+def save_report(report, out_dir):
+    with open(Path(out_dir) / fn_report, 'w', encoding='utf-8') as fp:
+        json.dump(report, fp, indent=4)
+
+def log_report(report, run, prefix='quantized'):
+    """Log export report to the AML run"""
+    try:
+        for key in ['acc_fp32', 'acc_variant', 'acc_delta', 'agreement']:
+            if key in report:
+                run.log(f'{prefix}_{key}', report[key])
+    except Exception:
+        pass
+
+############################################
+#####   Quantization
+############################################
+
+def quantize(model):
+    """Dynamic int8 quantization of the linear layers, for CPU inference"""
+    model.to('cpu')
+    model.eval()
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=False)
+
+def export_quantized(model, processor, data_loader, save_dir, device, max_delta=0.01, reference=None):
+    """Export a quantized variant of a trained model to save_dir/quantized
+
+    The variant is evaluated against the full precision model on the test set
+    (data_loader), and discarded if its accuracy drops by more than max_delta.
+    Returns the evaluation report.
+    """
+    out_dir = Path(save_dir) / quantized_dir
+    shutil.rmtree(out_dir, ignore_errors=True)
+
+    reference = reference or get_predictions(model, data_loader, device)
+    # Quantize a CPU copy, the trained model is left unchanged
+    model_int8 = quantize(model)
+    report = compare(model, model_int8, data_loader, device, max_delta=max_delta, reference=reference)
+    model.to(device)
+    log.warning(f'[INFO] Quantization - acc fp32 = {report["acc_fp32"]:.4f}, '
+                    f'acc int8 = {report["acc_variant"]:.4f}, agreement = {report["agreement"]:.4f}')
+
+    if report['exported']:
+        out_dir.mkdir(parents=True, exist_ok=True)
+        torch.save(model_int8, out_dir / fn_quantized)
+        processor.save(out_dir)
+        report['size_mb_fp32'] = get_size(Path(save_dir) / 'language_model.bin')
+        report['size_mb_variant'] = get_size(out_dir / fn_quantized)
+        save_report(report, out_dir)
+        log.warning(f'[INFO] Exported quantized model -> {out_dir}')
+    else:
+        log.warning(f'[WARNING] Quantized model not exported, accuracy delta '
+                        f'{report["acc_delta"]:.4f} exceeds {max_delta}')
+    return report
+
+############################################
+#####   ONNX
+############################################
+
+def to_onnx(model, batch, out_dir, opset_version=11):
+    """Trace language model & prediction heads to an ONNX graph
+
+    Inputs and logits have dynamic batch and sequence axes, so dynamically padded
+    batches are supported. Only the config of the prediction heads is stored, as
+    FARM applies them (logits to predictions) in Python.
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    model.to('cpu')
+    model.eval()
+    wrapper = ONNXWrapper.load_from_adaptive_model(model)
+    inputs = tuple(batch[name].to('cpu') for name in ['input_ids', 'padding_mask', 'segment_ids'])
+    dynamic_axes = {'input_ids': {0: 'batch_size', 1: 'max_seq_len'},
+                    'padding_mask': {0: 'batch_size', 1: 'max_seq_len'},
+                    'segment_ids': {0: 'batch_size', 1: 'max_seq_len'},
+                    'logits': {0: 'batch_size'}}
+    with torch.no_grad():
+        torch.onnx.export(wrapper,
+                        args = inputs,
+                        f = str(out_dir / fn_onnx),
+                        opset_version = opset_version,
+                        do_constant_folding = True,
+                        input_names = ['input_ids', 'padding_mask', 'segment_ids'],
+                        output_names = ['logits'],
+                        dynamic_axes = dynamic_axes)
+    for i, ph in enumerate(model.prediction_heads):
+        ph.save_config(out_dir, i)
+    with open(out_dir / 'model_config.json', 'w', encoding='utf-8') as fp:
+        json.dump({'onnx_opset_version': opset_version, 'language': model.get_language()}, fp)
+
+def load_onnx_model(load_dir, tasks=None):
+    """ONNX Runtime model, with prediction heads connected to the tasks of the processor"""
+    model = ONNXAdaptiveModel.load(load_dir=Path(load_dir), device='cpu')
+    if tasks is not None:
+        model.connect_heads_with_processor(tasks, require_labels=True)
+    return model
+
+def export_onnx(model, processor, data_loader, save_dir, device, max_delta=0.01, reference=None, opset_version=11):
+    """Export an ONNX variant of a trained model to save_dir/onnx
+
+    The ONNX Runtime predictions are evaluated against the PyTorch model on the
+    test set (data_loader), the variant is discarded if its accuracy drops by more
+    than max_delta. Returns the evaluation report.
+    """
+    out_dir = Path(save_dir) / onnx_dir
+    shutil.rmtree(out_dir, ignore_errors=True)
+
+    reference = reference or get_predictions(model, data_loader, device)
+    try:
+        to_onnx(model, next(iter(data_loader)), out_dir, opset_version=opset_version)
+        processor.save(out_dir)
+        model_onnx = load_onnx_model(out_dir, processor.tasks)
+    except Exception as e:
+        log.warning(f'[WARNING] ONNX export failed -> {e}')
+        shutil.rmtree(out_dir, ignore_errors=True)
+        model.to(device)
+        return dict(exported = False, error = str(e))
+    report = compare(model, model_onnx, data_loader, device, max_delta=max_delta, reference=reference)
+    model.to(device)
+    log.warning(f'[INFO] ONNX - acc pytorch = {report["acc_fp32"]:.4f}, '
+                    f'acc onnx = {report["acc_variant"]:.4f}, agreement = {report["agreement"]:.4f}')
+
+    if report['exported']:
+        report['size_mb_fp32'] = get_size(Path(save_dir) / 'language_model.bin')
+        report['size_mb_variant'] = get_size(out_dir / fn_onnx)
+        save_report(report, out_dir)
+        log.warning(f'[INFO] Exported ONNX model -> {out_dir}')
+    else:
+        shutil.rmtree(out_dir, ignore_errors=True)
+        log.warning(f'[WARNING] ONNX model not exported, accuracy delta '
+                        f'{report["acc_delta"]:.4f} exceeds {max_delta}')
+    return report
+
+############################################
+#####   Loading
+############################################
+
+def save_shared(model_dir, task, head):
+    """Refer a task to a prediction head of the multi-task model of another task, replaces its model"""
+    shutil.rmtree(model_dir, ignore_errors=True)
+    os.makedirs(model_dir, exist_ok=True)
+    with open(Path(model_dir) / fn_shared, 'w', encoding='utf-8') as fp:
+        json.dump({'task': task, 'head': head}, fp)
+    log.warning(f'[INFO] Model of {model_dir} is head {head} of the model of task {task}')
+
+def get_shared(model_dir):
+    """Task & prediction head of the multi-task model serving a task, None if it has a model of its own"""
+    fp = Path(model_dir) / fn_shared
+    if not fp.is_file():
+        return None
+    with open(fp, encoding='utf-8') as f:
+        return json.load(f)
+
+def has_variant(model_dir, backend):
+    if backend == 'onnx':
+        return (Path(model_dir) / onnx_dir / fn_onnx).is_file()
+    elif backend == 'quantized':
+        return (Path(model_dir) / quantized_dir / fn_quantized).is_file()
+    return backend == 'pytorch'
+
+def has_quantized(model_dir):
+    return has_variant(model_dir, 'quantized')
+
+def load_quantized(model_dir, batch_size=4, max_seq_len=256, **kwargs):
+    """Inferencer of the quantized variant, on CPU
+
+    The processor is set up like by Inferencer.load, so inputs are identical.
+    """
+    load_dir = Path(model_dir) / quantized_dir
+    model = torch.load(load_dir / fn_quantized, map_location='cpu')
+    processor = Processor.load_from_dir(load_dir)
+    processor.max_seq_len = max_seq_len
+    return fe.PaddedInferencer(model, processor, task_type=None, batch_size=batch_size,
+                                gpu=False, name=os.path.basename(str(model_dir)), **kwargs)
+
+def load_onnx(model_dir, batch_size=4, **kwargs):
+    """Inferencer of the ONNX variant, on ONNX Runtime (CPU)
+
+    Pre- and post-processing are the same as for the PyTorch model.
+    """
+    return fe.PaddedInferencer.load(Path(model_dir) / onnx_dir, batch_size=batch_size, gpu=False, **kwargs)
+
+def load(model_dir, backend='auto', **kwargs):
+    """Inferencer of a model, by backend (onnx, quantized, pytorch)
+
+    With 'auto', the first available of onnx, quantized and pytorch is used.
+    """
+    if backend == 'auto':
+        backend = next(b for b in backends if has_variant(model_dir, b))
+    elif not has_variant(model_dir, backend):
+        log.warning(f'[WARNING] No {backend} model in {model_dir}, using pytorch')
+        backend = 'pytorch'
+    log.warning(f'[INFO] Loading {backend} model from {model_dir}')
+    if backend == 'onnx':
+        return load_onnx(model_dir, **kwargs)
+    elif backend == 'quantized':
+        return load_quantized(model_dir, **kwargs)
+    return fe.PaddedInferencer.load(model_dir, **kwargs)
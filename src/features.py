@@ -0,0 +1,302 @@
+"""
+Features for FARM training and inference
+
+Tokenized datasets (train/dev/test) are stored on disk and reused by repeated
+training runs and hyperdrive trials, as long as the data and the preprocessing
+settings are unchanged. On AML, each run has its own disk, the cache is only 
+shared with a cache_dir on a mounted datastore (see deploy/hyperdrive.py).
+
+cache_dir/features/<checksum>/      <- serialized datasets & tensor names
+
+Batches are built from samples of similar length (length bucketing) and trimmed
+to their longest sample (dynamic padding), instead of always padding to max_seq_len.
+"""
+import logging
+log = logging.getLogger(__name__)
+
+import os
+import json
+import time
+import shutil
+import hashlib
+from pathlib import Path
+
+import numpy as np
+from functools import partial
+
+import torch
+from torch.utils.data import DataLoader, Sampler
+from farm.data_handler.data_silo import DataSilo
+from farm.infer import Inferencer
+
+# Custom functions
+import sys
+sys.path.append('./src')
+import cache
+import data as dt
+
+############################################
+#####   Dynamic Padding
+############################################
+
+# Label tensors of these task types are per sequence, never trimmed
+sequence_level_tasks = ['classification', 'multilabel_classification', 'regression']
+
+def get_fixed_tensor_names(processor):
+    """Names of tensors, which are not trimmed to the batch length"""
+    return {t['label_tensor_name'] for t in processor.tasks.values() if t.get('task_type') in sequence_level_tasks}
+
+def get_lengths(dataset, tensor_names):
+    """Number of tokens (without padding) per sample"""
+    i = tensor_names.index('padding_mask')
+    if hasattr(dataset, 'datasets'):
+        ### ConcatDataset
+        lengths = [get_lengths(d, tensor_names) for d in dataset.datasets]
+        return np.concatenate(lengths) if len(lengths) > 0 else np.zeros(0, dtype=int)
+    elif hasattr(dataset, 'tensors'):
+        ### TensorDataset
+        return dataset.tensors[i].sum(1).numpy()
+    return np.array([int(dataset[j][i].sum()) for j in range(len(dataset))])
+
+def collate(batch, tensor_names, fixed_tensor_names=(), pad_multiple=8):
+    """Stack samples to named tensors, trimmed to the longest sample of the batch
+
+    The length is rounded up to a multiple of pad_multiple, for efficient kernels.
+    """
+    stacked = {name: torch.stack([sample[i] for sample in batch]) for i, name in enumerate(tensor_names)}
+    padding_mask = stacked['padding_mask']
+    full_len = padding_mask.size(1)
+    max_len = min(full_len, -(-int(padding_mask.sum(1).max()) // pad_multiple) * pad_multiple)
+    # Only trim, if padding is on the right
+    if max_len < full_len and not padding_mask[:, max_len:].any():
+        for name, tensor in stacked.items():
+            if name not in fixed_tensor_names and tensor.dim() == 2 and tensor.size(1) == full_len:
+                stacked[name] = tensor[:, :max_len]
+    return stacked
+
+class LengthBucketSampler(Sampler):
+    """Batches of samples with similar length
+
+    When shuffled, samples are sorted by length within buckets of bucket_size batches
+    and the order of the batches is shuffled. Otherwise all samples are sorted by length.
+    The shuffle only depends on seed and epoch, so a resumed training sees the same batches.
+    """
+    def __init__(self, lengths, batch_size, shuffle=True, bucket_size=100, seed=42):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _batches(self, idx):
+        idx = idx[np.argsort(self.lengths[idx], kind = 'stable')]
+        return [idx[i:i + self.batch_size] for i in range(0, len(idx), self.batch_size)]
+
+    def __iter__(self):
+        if self.shuffle:
+            rng = np.random.RandomState(self.seed + self.epoch)
+            self.epoch += 1
+            idx = rng.permutation(len(self.lengths))
+            chunk = self.batch_size * self.bucket_size
+            batches = [b for start in range(0, len(idx), chunk) for b in self._batches(idx[start:start + chunk])]
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        else:
+            batches = self._batches(np.arange(len(self.lengths)))
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+class BucketedDataLoader(DataLoader):
+    """DataLoader of named tensors, with length bucketing and dynamic padding"""
+    def __init__(self, dataset, batch_size, tensor_names, fixed_tensor_names=(), 
+                    shuffle=True, bucket_size=100, pad_multiple=8):
+        self.tensor_names = tensor_names
+        super().__init__(dataset = dataset,
+                        batch_sampler = LengthBucketSampler(get_lengths(dataset, tensor_names),
+                                            batch_size, shuffle = shuffle, bucket_size = bucket_size),
+                        collate_fn = partial(collate, tensor_names = tensor_names,
+                                            fixed_tensor_names = fixed_tensor_names, pad_multiple = pad_multiple))
+
+class PaddedInferencer(Inferencer):
+    """Inferencer with dynamic padding, the order of the samples is kept
+
+    Models with several prediction heads (multi-task) are run once for all heads,
+    see inference_by_heads. inference_from_dicts returns the first head.
+    """
+    _all_heads = False
+
+    def inference_by_heads(self, dicts):
+        """Predictions of all prediction heads from one forward pass, a list of results per head"""
+        ## Results per head are not merged across multiprocessing chunks
+        pool, self.process_pool = getattr(self, 'process_pool', None), None
+        self._all_heads = True
+        try:
+            return self.inference_from_dicts(dicts = dicts)
+        finally:
+            self.process_pool = pool
+            self._all_heads = False
+
+    def _format_preds(self, head, logits, **kwargs):
+        """Formatted predictions of a head, as list"""
+        if len(self.model.prediction_heads) == 1:
+            return self.model.formatted_preds(logits = [logits], **kwargs)
+        preds = self.model.prediction_heads[head].formatted_preds(logits = logits, **kwargs)
+        return preds if isinstance(preds, list) else [preds]
+
+    def _get_predictions(self, dataset, tensor_names, baskets):
+        samples = [s for b in baskets for s in b.samples]
+        data_loader = DataLoader(dataset = dataset, batch_size = self.batch_size, shuffle = False,
+                            collate_fn = partial(collate, tensor_names = tensor_names,
+                                            fixed_tensor_names = get_fixed_tensor_names(self.processor)))
+        heads = range(len(self.model.prediction_heads)) if self._all_heads else [0]
+        preds_all = [[] for __ in heads]
+        for i, batch in enumerate(data_loader):
+            batch = {key: batch[key].to(self.device) for key in batch}
+            batch_samples = samples[i * self.batch_size : (i + 1) * self.batch_size]
+            with torch.no_grad():
+                logits = self.model.forward(**batch)
+                for head, preds in zip(heads, preds_all):
+                    preds += self._format_preds(head, logits[head],
+                        samples = batch_samples,
+                        tokenizer = self.processor.tokenizer,
+                        return_class_probs = self.return_class_probs,
+                        **batch)
+        return preds_all if self._all_heads else preds_all[0]
+
+############################################
+#####   Feature Cache
+############################################
+
+def get_cache_path(dt_task, cache_dir=None):
+    """Feature cache directory, None if the local cache is disabled in config.ini
+
+    cache_dir (e.g. a mounted datastore, shared by runs) overrides the config.ini cache_dir.
+    """
+    data_config = dt.get_data_config()
+    if data_config.get('cache', 'true').lower() == 'false':
+        return None
+    return Path(cache_dir or data_config.get('cache_dir', f'{dt_task.root_dir}cache/')) / 'features'
+
+class CachedDataSilo(DataSilo):
+    """DataSilo with a persistent feature cache
+
+    Cached datasets are keyed by the content of the data files, the tokenizer
+    (language model & do_lower_case), max_seq_len, dev split and tasks of the processor.
+    Only the max_entries most recently used datasets are kept.
+
+    Featurization runs in max_processes worker processes, each converting chunks of
+    at most max_chunksize samples. The throughput is logged and kept in featurization_stats.
+
+    With bucketing, the data loaders batch samples of similar length with dynamic padding.
+    """
+    def __init__(self, processor, batch_size, lang_model, do_lower_case,
+                    cache_path=None, max_entries=5, max_processes=128, max_chunksize=2000, 
+                    bucketing=True, **kwargs):
+        self.bucketing = bucketing
+        self.lang_model = lang_model
+        self.do_lower_case = do_lower_case
+        self.max_entries = max_entries
+        self._checksum = None
+        self._from_cache = False
+        start = time.perf_counter()
+        super().__init__(processor = processor,
+                        batch_size = batch_size,
+                        caching = cache_path is not None,
+                        cache_path = Path(cache_path) if cache_path is not None else None,
+                        max_processes = max_processes,
+                        max_multiprocessing_chunksize = max_chunksize,
+                        **kwargs)
+        duration = max(time.perf_counter() - start, 1e-9)
+        n_samples = sum(len(d) for d in self.data.values() if d)
+        self.featurization_stats = dict(samples = n_samples, 
+                                        seconds = duration,
+                                        samples_per_sec = n_samples / duration,
+                                        workers = max_processes,
+                                        chunksize = max_chunksize,
+                                        cached = self._from_cache)
+        log.warning(f'[INFO] Featurized {n_samples} samples in {duration:.1f}s '
+                        f'({n_samples / duration:.0f} samples/s, workers = {max_processes}, '
+                        f'chunksize = {max_chunksize}, cached = {self._from_cache})')
+
+    def log_stats(self, run):
+        """Log featurization throughput to the AML run"""
+        try:
+            run.log('featurization_samples', self.featurization_stats['samples'])
+            run.log('featurization_seconds', self.featurization_stats['seconds'])
+            run.log('featurization_samples_per_sec', self.featurization_stats['samples_per_sec'])
+        except Exception:
+            pass
+
+    def set_epoch(self, epoch):
+        """Set the epoch of the train batch order, e.g. when resuming training"""
+        loader = self.loaders.get('train')
+        if loader is not None and isinstance(loader.batch_sampler, LengthBucketSampler):
+            loader.batch_sampler.set_epoch(epoch)
+
+    def _initialize_data_loaders(self):
+        """Data loaders with length bucketing & dynamic padding"""
+        if not self.bucketing or self.distributed:
+            return super()._initialize_data_loaders()
+        fixed_tensor_names = get_fixed_tensor_names(self.processor)
+        self.loaders = {name: BucketedDataLoader(self.data[name], self.batch_size, self.tensor_names,
+                                                fixed_tensor_names, shuffle = name == 'train')
+                            if self.data.get(name) is not None else None
+                            for name in ['train', 'dev', 'test']}
+
+    def _get_checksum(self):
+        """Get checksum of data content & preprocessing settings"""
+        if self._checksum is None:
+            files = []
+            for fn in [self.processor.train_filename, self.processor.dev_filename, self.processor.test_filename]:
+                fp = Path(self.processor.data_dir) / fn if fn else None
+                files.append(cache.get_hash(fp) if fp is not None and os.path.isfile(fp) else None)
+            payload = {
+                'files'         : files,
+                'lang_model'    : str(self.lang_model),
+                'tokenizer'     : type(self.processor.tokenizer).__name__,
+                'do_lower_case' : self.do_lower_case,
+                'max_seq_len'   : self.processor.max_seq_len,
+                'dev_split'     : self.processor.dev_split,
+                'processor'     : type(self.processor).__name__,
+                'tasks'         : self.processor.tasks
+            }
+            self._checksum = hashlib.sha256(json.dumps(payload, sort_keys = True, default = str).encode()).hexdigest()
+        return self._checksum
+
+    def _load_dataset_from_cache(self, cache_dir):
+        log.warning(f'[INFO] Loading features from cache -> {cache_dir}')
+        # Update last access, for eviction
+        os.utime(cache_dir)
+        self._from_cache = True
+        super()._load_dataset_from_cache(cache_dir)
+
+    def _save_dataset_to_cache(self):
+        """Serialize datasets via temporary directory, so incomplete entries are never loaded"""
+        cache_dir = self.cache_path / self._get_checksum()
+        tmp_dir = self.cache_path / f'.{self._get_checksum()}.{os.getpid()}'
+        tmp_dir.mkdir(parents = True, exist_ok = True)
+        for name in ['train', 'dev', 'test']:
+            if self.data.get(name):
+                torch.save(self.data[name], tmp_dir / f'{name}_dataset')
+        torch.save(self.tensor_names, tmp_dir / 'tensor_names')
+        try:
+            os.replace(tmp_dir, cache_dir)
+        except OSError:
+            # Stored by a concurrent run
+            shutil.rmtree(tmp_dir, ignore_errors = True)
+        log.warning(f'[INFO] Cached features -> {cache_dir}')
+        self._evict()
+
+    def _evict(self):
+        """Remove least recently used datasets, beyond max_entries"""
+        entries = sorted([p for p in self.cache_path.iterdir() if p.is_dir() and not p.name.startswith('.')],
+                            key = lambda p: p.stat().st_mtime, reverse = True)
+        for p in entries[self.max_entries:]:
+            shutil.rmtree(p, ignore_errors = True)
+            log.info(f'[INFO] Evicted features {p.name} from cache')
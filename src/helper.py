@@ -9,27 +9,14 @@ import os
 import platform
 import configparser
 from pathlib import Path
-import pandas as pd
 import re
 import json
-import yaml
-import spacy
-from flair.models import SequenceTagger
-
-try:
-    from azure.common.credentials import ServicePrincipalCredentials
-    from azure.keyvault import KeyVaultClient
-except Exception as e:
-    log.warning(f'Azure KeyVault is not installed, \
-        but may not be needed for local development or training. Details: {e}')
-
-try:
-    from azureml.core import Run
-    from azureml.core.authentication import ServicePrincipalAuthentication
-    from azureml.core import Workspace
-except Exception as e:
-    log.warning(f'Azure Machine Learning is not installed, \
-        but may not be needed for local development or endpoint deployment. Details: {e}')
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+#NOTE: heavy dependencies (spacy, flair, Azure KeyVault & Machine Learning SDKs)
+#       are imported by the functions needing them, to keep imports fast.
 
 ############################################
 #####   Logging
@@ -67,6 +54,7 @@ def get_logger(level='info', location = None, excl_az_storage=True):
 def get_context():
     """Get AML Run Context for Logging to AML Services"""
     try:
+        from azureml.core import Run
         run = Run.get_context()
     except Exception as e:
         logger.warning(f'[WARNING] Azure ML not loaded. Nothing will be logged. {e}')
@@ -106,14 +94,8 @@ def get_project_config(fn):
     return params
 
 def get_config(section = None):
-    """Load local config file"""
-    run_config = configparser.ConfigParser()
-    run_config.read(get_repo_dir() + 'config.ini')
-    if len(run_config) == 1:
-        run_config = None
-    elif section is not None:
-        run_config = run_config[section]
-    return run_config
+    """Load local config file (parsed once per process, see SecretProvider)"""
+    return get_provider().get_config(section = section)
 
 ############################################
 #####   Requirements
@@ -154,53 +136,178 @@ def get_requirements(req_type = 'deploy'):
 #####   Secret Management
 ############################################
 
-def _get_sp_credentials():
-    """Retrieve Service Principal Credentials"""
-    credentials = ServicePrincipalCredentials(
-        client_id   = get_secret('sp-client-id'),
-        secret      = get_secret('sp-secret'),
-        tenant      = get_secret('sp-tenant-id'),
-        resource    = 'https://vault.azure.net/'
-    )
-    return credentials
-
-def _get_kv_secret(name):
-    """ Retrieve Secret from KeyVault"""
-    client = KeyVaultClient(_get_sp_credentials())
-    vault_url = get_secret('keyvault-url')
-    return client.get_secret(vault_url, name, "").value
-
-def get_secret(name, section = 'environ'):
-    """Get KeyVault Secret
+class LocalVault():
+    """Local fake of a KeyVault, for development and testing
     
-    Order of trials:
-    - config.ini (local)
-    - ENV variable (deployment)
-    - KeyVault direct (deployment)
-    - KeyVault via AML (training)
+    Secrets are given as dict, or loaded from a json file.
     """
-    secret = None
-    config = get_config(section = section)
-
-    if config is not None and name in config:
-        # Get secret from local config
-        secret = config[name]
-    elif name in os.environ:
-        # Get secret from environment variable
-        secret = os.environ[name]
-    elif 'sp-tenant-id' in os.environ:
-        # Get via KeyVault
-        secret = _get_kv_secret(name)
-    else:
-        # Get via AML linked KeyVault
-        run_context = get_aml_context()
-        if run_context is not None:
-            secret = run_context.get_secret(name = name)
-
-    if secret is None:
-        raise Exception(f'The secret {name} was not found via the helper.')
+    def __init__(self, secrets = None, fn = None):
+        self.secrets = dict(secrets or {})
+        if fn is not None:
+            with open(fn, encoding='utf-8') as f:
+                self.secrets.update(json.load(f))
+        self.requests = 0
+
+    def get_secret(self, name):
+        self.requests += 1
+        return self.secrets.get(name)
+
+class KeyVault():
+    """KeyVault client, authenticated via Service Principal"""
+    def __init__(self, client_id, secret, tenant, vault_url):
+        from azure.common.credentials import ServicePrincipalCredentials
+        from azure.keyvault import KeyVaultClient
+        self.client = KeyVaultClient(ServicePrincipalCredentials(
+            client_id   = client_id,
+            secret      = secret,
+            tenant      = tenant,
+            resource    = 'https://vault.azure.net/'
+        ))
+        self.vault_url = vault_url
+
+    def get_secret(self, name):
+        return self.client.get_secret(self.vault_url, name, "").value
+
+class SecretProvider():
+    """Process-level provider of config and secrets
     
-    return secret
+    - config.ini is parsed once
+    - the KeyVault client and the AML run context are created once and reused
+    - secrets are cached for ttl seconds
+    - several secrets can be fetched concurrently (get_secrets)
+    """
+    def __init__(self, ttl = 3600, vault = None, max_workers = 8):
+        self.ttl = ttl
+        self.vault = vault
+        self.max_workers = max_workers
+        self._config = None
+        self._config_loaded = False
+        self._run_context = None
+        self._run_context_loaded = False
+        self._secrets = dict()
+        self._lock = threading.RLock()
+
+    def get_config(self, section = None):
+        """Load local config file"""
+        with self._lock:
+            if not self._config_loaded:
+                run_config = configparser.ConfigParser()
+                run_config.read(get_repo_dir() + 'config.ini')
+                self._config = run_config if len(run_config) > 1 else None
+                self._config_loaded = True
+        if self._config is None or section is None:
+            return self._config
+        return self._config[section]
+
+    def _get_local(self, name, section):
+        """Get secret from config.ini (local) or ENV variable (deployment), None if not set"""
+        config = self.get_config(section = section)
+        if config is not None and name in config:
+            return config[name]
+        return os.environ.get(name)
+
+    def _get_vault(self):
+        """Get KeyVault client, authenticated once
+        
+        NOTE: the Service Principal credentials are only read from config.ini or ENV, 
+            as fetching them via the KeyVault would recurse.
+        """
+        if self.vault is None:
+            names = ['sp-client-id', 'sp-secret', 'sp-tenant-id', 'keyvault-url']
+            secrets = {n: self._get_local(n, 'environ') for n in names}
+            missing = [n for n in names if secrets[n] is None]
+            if len(missing) > 0:
+                raise Exception(f'The secrets {missing} for the KeyVault were not found in config.ini or ENV.')
+            with self._lock:
+                if self.vault is None:
+                    self.vault = KeyVault(client_id = secrets['sp-client-id'],
+                                            secret      = secrets['sp-secret'],
+                                            tenant      = secrets['sp-tenant-id'],
+                                            vault_url   = secrets['keyvault-url'])
+        return self.vault
+
+    def _get_run_context(self):
+        with self._lock:
+            if not self._run_context_loaded:
+                self._run_context = get_aml_context()
+                self._run_context_loaded = True
+        return self._run_context
+
+    def _fetch(self, name, section):
+        """Get secret from its source
+        
+        Order of trials:
+        - config.ini (local)
+        - ENV variable (deployment)
+        - KeyVault direct (deployment, or local fake vault)
+        - KeyVault via AML (training)
+        """
+        # Get secret from local config or environment variable
+        secret = self._get_local(name, section)
+
+        if secret is not None:
+            return secret
+        if self.vault is not None or 'sp-tenant-id' in os.environ:
+            # Get via KeyVault
+            secret = self._get_vault().get_secret(name)
+        else:
+            # Get via AML linked KeyVault
+            run_context = self._get_run_context()
+            if run_context is not None:
+                secret = run_context.get_secret(name = name)
+
+        if secret is None:
+            raise Exception(f'The secret {name} was not found via the helper.')
+        return secret
+
+    def get_secret(self, name, section = 'environ'):
+        """Get secret, from cache if not expired"""
+        key = (section, name)
+        with self._lock:
+            cached = self._secrets.get(key)
+        if cached is not None and cached[1] > time.monotonic():
+            return cached[0]
+        secret = self._fetch(name, section)
+        with self._lock:
+            self._secrets[key] = (secret, time.monotonic() + self.ttl)
+        return secret
+
+    def get_secrets(self, names, section = 'environ'):
+        """Get several secrets concurrently, returns dict name -> secret"""
+        if len(names) <= 1:
+            return {n: self.get_secret(n, section) for n in names}
+        with ThreadPoolExecutor(max_workers = min(self.max_workers, len(names))) as pool:
+            secrets = pool.map(lambda n: self.get_secret(n, section), names)
+            return dict(zip(names, secrets))
+
+    def clear(self):
+        """Drop cached secrets and config, e.g. after rotation"""
+        with self._lock:
+            self._secrets.clear()
+            self._config_loaded = False
+
+_provider = None
+
+def get_provider():
+    """Get process-level secret provider"""
+    global _provider
+    if _provider is None:
+        _provider = SecretProvider(ttl = float(os.environ.get('SECRET_TTL', 3600)))
+    return _provider
+
+def set_provider(provider):
+    """Replace process-level secret provider, e.g. with a LocalVault for testing"""
+    global _provider
+    _provider = provider
+    return provider
+
+def get_secret(name, section = 'environ'):
+    """Get KeyVault Secret, cached by the process-level SecretProvider"""
+    return get_provider().get_secret(name, section = section)
+
+def get_secrets(names, section = 'environ'):
+    """Get several KeyVault Secrets concurrently"""
+    return get_provider().get_secrets(names, section = section)
 
 ############################################
 #####   Azure Machine Learning
@@ -209,6 +316,7 @@ def get_secret(name, section = 'environ'):
 def get_aml_context():
     """Get Azure Machine Learning Run context"""
     try:
+        from azureml.core import Run
         run = Run.get_context()
         run.experiment #NOTE: this raises an error when not loaded
     except Exception:
@@ -226,6 +334,7 @@ def get_aml_ws():
     elif config is not None and platform.system() == 'Windows':
         # Fetch via config
         try:
+            from azureml.core import Workspace
             # Authenticate via Interactive
             ws = Workspace.get(name = get_secret('aml-ws-name'),
                     resource_group  = get_secret('aml-ws-rg'),
@@ -238,15 +347,19 @@ def get_aml_ws():
     else:
         # Fetch via SP
         try:
+            from azureml.core import Workspace
+            from azureml.core.authentication import ServicePrincipalAuthentication
+            secrets = get_secrets(['sp-tenant-id', 'sp-client-id', 'sp-secret', 
+                                    'aml-ws-name', 'aml-ws-rg', 'aml-ws-sid'])
             # Authenticate via SP
-            sp = ServicePrincipalAuthentication(tenant_id           = get_secret('sp-tenant-id'),
-                                        service_principal_id        = get_secret('sp-client-id'),
-                                        service_principal_password  = get_secret('sp-secret'))
+            sp = ServicePrincipalAuthentication(tenant_id           = secrets['sp-tenant-id'],
+                                        service_principal_id        = secrets['sp-client-id'],
+                                        service_principal_password  = secrets['sp-secret'])
             # Get workspace
-            ws = Workspace.get(name = get_secret('aml-ws-name'),
-                    resource_group  = get_secret('aml-ws-rg'),
+            ws = Workspace.get(name = secrets['aml-ws-name'],
+                    resource_group  = secrets['aml-ws-rg'],
                     auth            = sp,
-                    subscription_id = get_secret('aml-ws-sid'))
+                    subscription_id = secrets['aml-ws-sid'])
         except Exception as e:
             log.warning(f'[WARNING] Unable to get AML workspace via Service Principal. {e}')
 
@@ -282,7 +395,16 @@ farm_model_lookup = {
     },
     'distilbert' : {
         'xx' : 'distilbert-base-multilingual-cased',
+        'en' : 'distilbert-base-cased',
         'de' : 'distilbert-base-german-cased'
+    },
+    'distilroberta' : {
+        'en' : 'distilroberta-base',
+        'de' : 'distilroberta-base',
+        'fr' : 'distilroberta-base',
+        'es' : 'distilroberta-base',
+        'it' : 'distilroberta-base'
+        # Students of roberta teachers, same tokenizer
     }
 }
 
@@ -307,6 +429,7 @@ spacy_model_lookup = {
 }
 
 def load_spacy_model(language='xx', disable=[]):
+    import spacy
     try:
         nlp = spacy.load(spacy_model_lookup[language], disable=disable)
     except OSError:
@@ -339,6 +462,7 @@ def get_flair_model(language, object_type):
 
 def load_flair_model(path=None, language='xx', task='ner'):
     if task == 'ner':
+        from flair.models import SequenceTagger
         # if path is None:
         model = SequenceTagger.load(get_flair_model(language, 'model'))
         # else:
@@ -355,29 +479,54 @@ def load_flair_model(path=None, language='xx', task='ner'):
 def csv_to_string(df):
     return df.to_csv(sep="\t", encoding="utf-8", index=False)
 
+def _validate_concat_row(sub, des, max_len=1000):
+    """Concatenate a single subject and body, see validate_concat"""
+    try:
+        if sub in des[:len(sub)]:
+            return des[:max_len]
+        else:
+            new_line = sub + '. ' + des
+            return new_line[:max_len]
+    except Exception as e:
+        if 'float' in str(e):
+            return str(des)
+        else:
+            return des[:max_len]
+
 def validate_concat(col1, col2, max_len=1000):
     """
     Determine if concatination is needed, by checking for dublicate in subject and body.
     Max length of sequence (text) is set. Characters surpassing max_len are cut-off. 
+
+    Bulk version of _validate_concat_row: missing values (nan) are masked over the arrays,
+    their body is returned as string. Columns with other types than strings and 
+    missing values fall back to the row-wise concatenation.
     """
-    text_concat = []
+    import numpy as np
+    import pandas as pd
     if isinstance(col1, str):
         col1, col2 = [col1], [col2]
-
-    for __, (sub, des) in enumerate(zip(col1, col2)):
-        try:
-            if sub in des[:len(sub)]:
-                text_concat.append(des[:max_len])
-            else:
-                new_line = sub + '. ' + des
-                text_concat.append(new_line[:max_len])
-        except Exception as e:
-            logger.warning(f'[WARNING] Validate Concat - {e}')
-            if 'float' in str(e):
-                text_concat.append(str(des))
-            else:
-                text_concat.append(des[:max_len])
-    return text_concat
+    sub = np.asarray(col1, dtype=object)
+    des = np.asarray(col2, dtype=object)
+
+    # Missing values, body as string
+    sub_na, des_na = pd.isna(sub), pd.isna(des)
+    missing = sub_na | des_na
+    text = np.empty(len(sub), dtype=object)
+    if missing.any():
+        if not all(isinstance(x, float) for x in np.concatenate([sub[sub_na], des[des_na]])):
+            return [_validate_concat_row(s, d, max_len) for s, d in zip(sub, des)]
+        log.warning(f'[WARNING] Validate Concat - {missing.sum()} rows with missing subject or body')
+        text[missing] = [str(d) for d in des[missing]]
+    
+    # Concatenate, if the body does not start with the subject
+    valid = ~missing
+    try:
+        text[valid] = [(d if d.startswith(s) else s + '. ' + d)[:max_len] 
+                            for s, d in zip(sub[valid], des[valid])]
+    except (AttributeError, TypeError):
+        return [_validate_concat_row(s, d, max_len) for s, d in zip(sub, des)]
+    return text.tolist()
 
 def remove_short(data, column='text_clean', min_char_length = 5):
     """
@@ -6,9 +6,9 @@ INFERENCE: Orchestration service for serving the model.
 import os, sys; sys.path.append(os.path.dirname(os.path.realpath(__file__)))
 import os
 import json
+import time
 import shutil
 # import threading
-from farm.infer import Inferencer
 
 # Custom functions
 import sys
@@ -19,18 +19,33 @@ import prepare as pr
 import custom as cu
 import rank
 import ner
+import export as ex
+import postprocess as pp
+import timing
 
 # Load configs & logger 
 logger = he.get_logger(location=__name__)
 
+# Loaded models by model directory, a multi-task model is loaded once for all its tasks
+models = {}
+
+def get_head(task):
+    """Task of the multi-task model & head serving a classification task, None if it has a model of its own"""
+    if cu.tasks.get(str(task)).get('type') not in ['classification', 'multi_classification']:
+        return None
+    return ex.get_shared(dt.Data(task=task, inference=True).get_path('model_dir'))
+
 def score(task):
     task_type = cu.tasks.get(str(task)).get('type')
-    if task_type == 'classification':
-        _dt = dt.Data(task=task, inference=True)
-        return Inferencer.load(_dt.get_path('model_dir'))
-    elif task_type == 'multi_classification':
-        _dt = dt.Data(task=task, inference=True)
-        return Inferencer.load(_dt.get_path('model_dir'))   
+    # Model backend: auto, onnx, quantized or pytorch
+    backend = cu.params.get('deploy', {}).get('backend', 'auto')
+    if task_type in ['classification', 'multi_classification']:
+        shared = get_head(task)
+        _dt = dt.Data(task=task if shared is None else shared['task'], inference=True)
+        model_dir = _dt.get_path('model_dir')
+        if model_dir not in models:
+            models[model_dir] = ex.load(model_dir, backend=backend)
+        return models[model_dir]
     elif task_type == 'ner':
         return ner.NER(task=task, inference=True)
     elif task_type == 'qa':
@@ -40,24 +55,55 @@ def score(task):
         return None
     
 def init():
-    global task_models, prepare_classes
+    global task_models, prepare_classes, registry
+
+    # Stage latency histograms, exported in the Prometheus text format
+    deploy = cu.params.get('deploy', {})
+    registry = timing.Registry(enabled=deploy.get('metrics', True))
+    if deploy.get('metrics_port') and registry.enabled:
+        timing.serve(registry, int(deploy.get('metrics_port')))
+        logger.warning(f'[INFO] Serving metrics on port {deploy.get("metrics_port")}')
 
     # Load models & prepare steps
     task_models = []
     prepare_classes = {}
     for task in cu.tasks.keys():
         task = int(task)
+        params = cu.tasks.get(str(task))
+        infer = score(task)
+        shared = get_head(task)
+        head = shared['head'] if shared is not None else None
+        if head is None and params.get('type') in ['classification', 'multi_classification'] \
+                and len(infer.model.prediction_heads) > 1:
+            ## Main task of a multi-task model
+            head = 0
         task_models.append({
             'task' : task,
-            'infer': score(task),
-            'params' : cu.tasks.get(str(task))
+            'infer': infer,
+            'params' : params,
+            # Head of a multi-task model, all heads are inferred at once
+            'head' : head,
+            # Labels in the order of the probabilities, for multi label post-processing
+            'labels' : pp.get_label_array(infer, head) if params.get('type') == 'multi_classification' else None
         })
         prepare_classes[task] = pr.Clean(task=task, inference=True)
         logger.warning(f'[INFO] Loaded model and prepare steps for task {task}.')
 
+def metrics():
+    """Stage latency histograms, in the Prometheus text format
+    
+    NOTE: not exposed via the scoring endpoint, only on the metrics port (see init)
+    """
+    return registry.to_prometheus()
+
 def run(req):
+    start = time.perf_counter()
     # Load request
     req_data = json.loads(req)[0]
+    ## Timing breakdown in the response, if requested
+    with_timing = bool(req_data.get('timing', False))
+    trace = registry.trace(start, force=with_timing)
+    trace.lap('parse')
     # Prepare text
     if 'subject' in req_data:
         s = req_data['subject']
@@ -68,28 +114,35 @@ def run(req):
     else:
         b = ''
     text = he.validate_concat(s, b)
+    trace.lap('validate_concat')
     # Score request for multiple models
     res = []
     _cat = ''
+    ## Predictions of all heads of a multi-task model, by model & clean text
+    shared = {}
     for tm in task_models:
+        task = int(tm['task'])
+        task_start = trace.last
         # Clean text
         clean = prepare_classes[tm['task']].transform_by_task(text)
-        # Infer text
-        result = tm['infer'].inference_from_dicts(dicts=[{"text": clean, "cat": _cat}])
+        trace.lap('clean', task)
+        # Infer text, once for all tasks of a multi-task model
+        if tm['head'] is None:
+            result = tm['infer'].inference_from_dicts(dicts=[{"text": clean, "cat": _cat}])
+        else:
+            key = (id(tm['infer']), clean)
+            if key not in shared:
+                shared[key] = tm['infer'].inference_by_heads(dicts=[{"text": clean, "cat": _cat}])
+            result = shared[key][tm['head']]
+        trace.lap('inference', task)
         _temp = []
         if tm['params'].get('type') == 'multi_classification':
-            # Special treatment for classification (FARM)
-            ##TODO: standardize for all
-            for r in result[0]['predictions']:
-                _labels = r.get('label').replace('"', "").replace("'", "").strip('][').split(', ')
-                _indices = sorted(r.get("probability").argsort()[-len(_labels):][::-1].tolist())
-                _ref = r.get("probability").tolist()
-                _temp.append(dict(
-                    category = _labels,
-                    score = [_ref[i] for i in _indices]
-                ))
-                _cat = _temp[0].get('category')
-                result = _temp
+            # Labels above the threshold (and/or top k), on the probability matrix of the batch
+            _temp = pp.multi_label(pp.get_probabilities(result), tm['labels'],
+                                    threshold=tm['params'].get('threshold', 0.5),
+                                    top_k=tm['params'].get('top_k'))
+            _cat = _temp[0].get('category')
+            result = _temp
         elif tm['params'].get('type') == 'classification':
             for r in result[0]['predictions']:
                 _temp.append(dict(
@@ -101,13 +154,22 @@ def run(req):
         else:
             logger.warning(f'[INFO] - Not a FARM model -> {tm["params"].get("type")}')
 
+        trace.lap('postprocess', task)
+        trace.since('task', task_start, task)
+
         # Prepare output
         res.append({
-            "task" : int(tm['task']),
+            "task" : task,
             "params" : tm['params'],
             "result" : result
         })
-        logger.warning(f'[INFO] Completed task {tm["task"]}.')
+        logger.info(f'[INFO] Completed task {tm["task"]}.')
+    trace.since('total', trace.start)
+    registry.record(trace)
+    ## Stages of the request & the task, in ms
+    if with_timing:
+        for r in res:
+            r['timing'] = trace.breakdown(r['task'])
     return res
 
 if __name__ == '__main__':
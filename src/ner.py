@@ -1,5 +1,6 @@
 import pandas as pd
 import re
+import csv
 from pathlib import Path
 import logging
 import requests
@@ -10,7 +11,6 @@ from spacy.tokens import Span
 
 from flair.data import Sentence
 
-from farm.data_handler.data_silo import DataSilo
 from farm.data_handler.processor import NERProcessor
 from farm.modeling.optimization import initialize_optimizer
 from farm.infer import Inferencer
@@ -29,6 +29,8 @@ sys.path.append('./src')
 import custom as cu
 import data as dt
 import helper as he
+import rules
+import features as fe
 
 
 # Custom FLAIR element for spacy pipeline
@@ -80,7 +82,8 @@ class CustomNER():
     def init(self):
         pass
 
-    def ner(self, task, model_type, n_epochs, batch_size, evaluate_every, use_cude):
+    def ner(self, task, model_type, n_epochs, batch_size, evaluate_every, use_cude,
+                featurize_workers=128, featurize_chunksize=2000, bucketing=True):
         aml_run = he.get_context()
         # Check task
         if cu.tasks.get(str(task)).get('type') != 'ner':
@@ -126,7 +129,13 @@ class CustomNER():
         )
 
         # 3. Create a DataSilo that loads several datasets (train/dev/test), provides DataLoaders for them and calculates a few descriptive statistics of our datasets
-        data_silo = DataSilo(processor=processor, batch_size=batch_size)
+        data_silo = fe.CachedDataSilo(processor=processor, batch_size=batch_size,
+                                        lang_model=lang_model, do_lower_case=False,
+                                        cache_path=fe.get_cache_path(dt_task),
+                                        max_processes=featurize_workers,
+                                        max_chunksize=featurize_chunksize,
+                                        bucketing=bucketing)
+        data_silo.log_stats(aml_run)
 
         # 4. Create an AdaptiveModel
         # a) which consists of a pretrained language model as a basis
@@ -193,6 +202,11 @@ class NER():
             patterns = [self.nlp.make_doc(v) for v in _values.value]
             self.matcher.add(product, None, *patterns)
 
+        # Load rules (literals & regex)
+        rule_items = pd.read_csv(dt_ner.get_path('fn_ner_rules', dir='asset_dir'), encoding='utf-8', 
+                                    sep='\t', quoting=csv.QUOTE_NONE, dtype=str)
+        self.rule_matcher = rules.RuleMatcher(rule_items.to_dict(orient='records'))
+
     def get_doc(self, text):
         return self.nlp(text)
 
@@ -209,12 +223,10 @@ class NER():
         return ents
 
     def get_rules(self, text):
-        #TODO: move regex to custom or config
+        """Get entities from the rules in /assets/rules.txt"""
         ents = []
-        ## Get error codes
-        matches = re.finditer(r'\b(((o|0)(x|\*))|(800))\S*', text, re.IGNORECASE) 
-        for match in matches:
-            ents.append(he.append_ner(text[match.span()[0]:match.span()[1]], match.span()[0], match.span()[1] ,'ERROR CODE', 'regex'))
+        for value, start, end, label, source in self.rule_matcher.match(text):
+            ents.append(he.append_ner(value, start, end, label, source))
         return ents
 
     def get_list(self, doc):
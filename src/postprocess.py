@@ -0,0 +1,49 @@
+"""
+Post-processing of classification predictions
+
+Works on the probability matrix of a batch (one row per text, one column per
+label), instead of the label strings formatted by FARM. Labels are mapped
+through a precomputed label array.
+"""
+import numpy as np
+
+def get_label_array(inferencer, head=None):
+    """Labels of a prediction head (default the first task) of a (FARM) inferencer, in the order of the probabilities"""
+    if head is None:
+        return np.asarray(list(inferencer.processor.tasks.values())[0]['label_list'])
+    task_name = inferencer.model.prediction_heads[head].task_name
+    return np.asarray(inferencer.processor.tasks[task_name]['label_list'])
+
+def get_probabilities(result):
+    """Probability matrix (texts x labels) of FARM inference results"""
+    probs = [p.get('probability') for r in result for p in r['predictions']]
+    if len(probs) == 0:
+        return np.zeros((0, 0))
+    return np.stack(probs)
+
+def multi_label(probs, labels, threshold=0.5, top_k=None):
+    """Labels & scores per text, above the threshold and/or the top k, by descending score
+
+    All rows are selected at once: argpartition finds the k best columns per row,
+    only those are sorted.
+    """
+    probs = np.atleast_2d(np.asarray(probs))
+    n_rows, n_labels = probs.shape
+    k = n_labels if top_k is None else min(top_k, n_labels)
+    if threshold is not None:
+        ## No more columns than the row with most labels above the threshold
+        k = min(k, int((probs >= threshold).sum(axis=1).max(initial=0)))
+    if n_rows == 0 or k == 0:
+        return [dict(category=[], score=[]) for __ in range(n_rows)]
+
+    indices = np.argpartition(-probs, k - 1, axis=1)[:, :k] if k < n_labels else np.tile(np.arange(n_labels), (n_rows, 1))
+    scores = np.take_along_axis(probs, indices, axis=1)
+    order = np.argsort(-scores, axis=1, kind='stable')
+    indices = np.take_along_axis(indices, order, axis=1)
+    scores = np.take_along_axis(scores, order, axis=1)
+
+    # Scores are sorted, the selected labels are a prefix of each row
+    counts = (scores >= threshold).sum(axis=1) if threshold is not None else np.full(n_rows, k)
+    categories = labels[indices]
+    return [dict(category=categories[i, :c].tolist(), score=scores[i, :c].tolist())
+                for i, c in enumerate(counts)]
@@ -16,7 +16,9 @@ import pandas as pd
 import numpy as np
 import string
 import re
+import hashlib
 import argparse
+from collections import Counter
 from sklearn.model_selection import StratifiedShuffleSplit
 
 # Custom functions
@@ -277,65 +279,199 @@ class Clean():
             logger.warning('[WARNING] No transform by task found.')
             return text[0]
 
-def prepare_classification(task, do_format, train_split, min_cat_occurance, 
-                            min_char_length, register_data):
-
-    # Get clean object
-    cl = Clean(task=task, download_source=True)
-    # Load data
+def load_prep(cl, do_format, chunksize=None):
+    """Load formatted source data
+    
+    Returns a list with a single dataframe, or an iterator of dataframes 
+    with max chunksize rows. When loading in chunks, only the columns 
+    required by the task type are read. If the source data is (re)fetched,
+    the batches are streamed from Cosmos DB while being stored. With do_format,
+    a leftover checkpoint of a completed pull is not reused.
+    """
     if not os.path.isfile(cl.dt.get_path('fn_prep', dir = 'data_dir')) or do_format:
-        data = dt.get_dataset(cl, source="cdb")
-    else:
-        data = cl.dt.load('fn_prep', dir = 'data_dir')
-    logger.warning(f'Data Length : {len(data)}')
-
+        if chunksize is None:
+            return [dt.get_dataset(cl, source="cdb", refresh=do_format)]
+        return dt.iter_dataset(cl, page_size=chunksize, refresh=do_format)
+    elif chunksize is None:
+        return [cl.dt.load('fn_prep', dir = 'data_dir')]
+    task_type = cu.tasks.get(str(cl.task)).get('type')
+    return iter_chunks(cl, 'fn_prep', chunksize, columns = cu.prepare_columns.get(task_type))
+
+def iter_chunks(cl, fn, chunksize=None, columns=None, dtype=None):
+    """Load a data file at once (list with one dataframe) or in chunks of max chunksize rows"""
+    if chunksize is None:
+        return [cl.dt.load(fn, dir = 'data_dir', columns = columns, dtype = dtype)]
+    return cl.dt.load(fn, dir = 'data_dir', chunksize = chunksize, columns = columns, dtype = dtype)
+
+def get_text_hashes(texts):
+    """Stable 64 bit hashes of texts, for deduplication across chunks"""
+    return [int.from_bytes(hashlib.blake2b(str(t).encode('utf-8'), digest_size=8).digest(), 'little') for t in texts]
+
+def drop_seen(data, subset, seen):
+    """Drop duplicates within the chunk and of previous chunks (seen text hashes), keeps the first"""
+    hashes = pd.Series(get_text_hashes(data[subset]), index=data.index)
+    keep = ~hashes.duplicated() & ~hashes.map(seen.__contains__)
+    seen.update(hashes[keep])
+    return data[keep]
+
+def clean_classification(cl, data):
+    """Load text & label fields and clean text of a (chunk of) classification data"""
     # Load text & label field
     text_raw = cu.load_text(data)
-    data['label'] = cu.load_label(data, task)
-    if cu.tasks.get(str(task)).get('type') == 'multi_classification':
+    data['label'] = cu.load_label(data, cl.task)
+    if cu.tasks.get(str(cl.task)).get('type') == 'multi_classification':
         data['label'] = data['label'].str.replace(', ', '_').str.replace(' ', '_')
-        flat_labels = [row['label'].split(',') for index, row in data.iterrows()] 
-        labels_clean = []
-        for labels in flat_labels:
-            for label in labels:
-                labels_clean.append(label)
-        label_list_raw = pd.DataFrame({'label':labels_clean})
-        label_list_raw = label_list_raw[label_list_raw.label != '']
-        label_list_raw = label_list_raw.label.drop_duplicates()
-    elif cu.tasks.get(str(task)).get('type') == 'classification': # in case of single label classification
-        label_list_raw = data.label.drop_duplicates()
-    
+
     # Clean text
     data['text'] = cl.transform(text_raw,
                     rm_email_formatting = True, 
                     rm_email_header     = True,
                     rm_email_footer     = True,
                     rp_generic          = True)
-    
-    # Filter by length
-    data = he.remove_short(data, 'text', min_char_length=min_char_length)
-    logger.warning(f'Data Length : {len(data)}')
+    return data
+
+def get_delta_state(cl, fn_base):
+    """Load high-water mark & aggregates of the previous run, for incremental prepare"""
+    if os.path.isfile(cl.dt.get_path('fn_delta', dir = 'data_dir')) and \
+            os.path.isfile(cl.dt.get_path(fn_base, dir = 'data_dir')):
+        state = cl.dt.load('fn_delta', file_type = 'json', dir = 'data_dir')
+        if state.get('ts') is not None:
+            logger.warning(f'[INFO] Incremental prepare for documents since {state["ts"]}')
+            return state
+    logger.warning('[WARNING] No high-water mark of a previous run found, running full prepare.')
+    return None
+
+def get_high_water_mark(data, ts=None):
+    """Get latest document timestamp (_ts)"""
+    if '_ts' in data.columns and data['_ts'].notna().any():
+        ts = max(ts or 0, int(data['_ts'].max()))
+    return ts
+
+def get_label_counts(data, task_type):
+    """Count label occurance, by single label for multi label classification"""
+    if task_type == 'multi_classification':
+        labels = data.label.str.split(',').explode()
+    else:
+        labels = data.label.dropna().astype(str)
+    return {str(k): int(v) for k, v in labels.value_counts().items()}
+
+def merge_delta(cl, fn_base, data, subset, ids, chunksize=None, dtype=None):
+    """Merge new & changed documents into the stored cleaned data, chunk by chunk
+
+    Changed documents (ids of the fetched delta, also those dropped while 
+    filtering or no longer for training) are removed, new duplicates are dropped 
+    and the rest is added. Hard deleted documents are not part of the delta, 
+    these are only removed by a full run (--do_format).
+    Only the text hashes of the stored data are kept in memory.
+    Returns the replaced and the added documents.
+    """
+    ids, seen, removed = set(pd.Series(list(ids)).astype(str)), set(), []
+    with cl.dt.writer(fn_base, dir = 'data_dir') as writer:
+        for base in iter_chunks(cl, fn_base, chunksize, dtype = dtype):
+            changed = base.id.astype(str).isin(ids)
+            removed.append(base[changed])
+            base = base[~changed]
+            seen.update(get_text_hashes(base[subset]))
+            if len(base) > 0:
+                writer.write(base)
+        data = drop_seen(data, subset, seen)
+        writer.write(data)
+    removed = pd.concat(removed, ignore_index=True, sort=False)
+    logger.warning(f'[INFO] Delta: {len(data)} documents added, {len(removed)} replaced')
+    return removed, data
+
+def filter_min_occurance(data, label_counts, min_cat_occurance, task_type):
+    """Remove labels below the min occurance, based on the label counts"""
+    labels = {l for l, c in label_counts.items() if c > min_cat_occurance}
+    if task_type == 'multi_classification':
+        data = data.assign(label = [','.join(l for l in ls.split(',') if l in labels) for ls in data.label])
+        return data[data.label != '']
+    return data[data.label.astype(str).isin(labels)]
+
+def get_label_set(data, task_type):
+    """Distinct labels, by single label for multi label classification"""
+    if task_type == 'multi_classification':
+        return {l for ls in data.label for l in ls.split(',') if l != ''}
+    return set(data.label.dropna().astype(str))
+
+def clean_classification_chunks(cl, chunks, task_type, min_char_length):
+    """Clean, filter by length & remove duplicates chunk by chunk, stored as fn_clean_base
+
+    Only running aggregates are kept in memory: the text hashes, label counts and labels.
+    Returns the label counts, the labels before filtering and the high-water mark.
+    """
+    seen, label_counts, label_list_raw, ts, rows = set(), Counter(), set(), None, 0
+    with cl.dt.writer('fn_clean_base', dir = 'data_dir') as writer:
+        for chunk in chunks:
+            chunk = clean_classification(cl, chunk)
+            ts = get_high_water_mark(chunk, ts)
+            label_list_raw |= get_label_set(chunk, task_type)
+            # Filter by length & remove duplicates
+            chunk = he.remove_short(chunk, 'text', min_char_length=min_char_length)
+            chunk = drop_seen(chunk, 'text', seen)
+            label_counts.update(get_label_counts(chunk, task_type))
+            writer.write(chunk)
+            rows += len(chunk)
+            logger.warning(f'Data Length : {rows}')
+    return dict(label_counts), label_list_raw, ts
+
+def filter_classification_chunks(chunks, label_counts, min_cat_occurance, task_type, max_rows=300000):
+    """Remove rare labels chunk by chunk, keeping the last max_rows rows"""
+    data, rows = pd.DataFrame(), 0
+    for chunk in chunks:
+        chunk = filter_min_occurance(chunk, label_counts, min_cat_occurance, task_type)
+        rows += len(chunk)
+        data = pd.concat([data, chunk], ignore_index=True, sort=False).tail(max_rows)
+    logger.warning(f'Data Length : {rows}')
+    return data.reset_index(drop=True).copy()
+
+def prepare_classification(task, do_format, train_split, min_cat_occurance, 
+                            min_char_length, register_data, chunksize=None, do_delta=False):
+    task_type = cu.tasks.get(str(task)).get('type')
+
+    # Get clean object
+    cl = Clean(task=task, download_source=True)
+    state = get_delta_state(cl, 'fn_clean_base') if do_delta else None
+    if state is not None:
+        # Load new & changed data only
+        delta = dt.get_dataset(cl, source="cdb", since=state['ts'])
+        if len(delta) == 0:
+            logger.warning('[INFO] No new or changed documents, nothing to prepare.')
+            return
+        ts = get_high_water_mark(delta, state['ts'])
+        # Load text & label fields and clean text, of documents still for training
+        data = dt.filter_status(delta)
+        if len(data) > 0:
+            data = clean_classification(cl, data)
+        else:
+            data = pd.DataFrame(columns = ['id', 'text', 'label'])
+        logger.warning(f'Data Length : {len(data)}')
+        label_list_raw = get_label_set(data, task_type) | set(state['label_counts'])
+
+        # Filter by length
+        data = he.remove_short(data, 'text', min_char_length=min_char_length)
+        logger.warning(f'Data Length : {len(data)}')
+
+        # Replace changed documents, remove duplicates & count labels
+        removed, added = merge_delta(cl, 'fn_clean_base', data, 'text', delta.id, chunksize, 
+                                        dtype = {'text': str, 'label': str})
+        label_counts = Counter(state['label_counts'])
+        label_counts.subtract(get_label_counts(removed, task_type))
+        label_counts.update(get_label_counts(added, task_type))
+        label_counts = {l: c for l, c in label_counts.items() if c > 0}
+        chunks = iter_chunks(cl, 'fn_clean_base', chunksize, dtype = {'text': str, 'label': str})
+    else:
+        # Load data chunk by chunk, clean, filter by length, remove duplicates & count labels
+        label_counts, label_list_raw, ts = clean_classification_chunks(cl, load_prep(cl, do_format, chunksize), 
+                                                                        task_type, min_char_length)
+        chunks = iter_chunks(cl, 'fn_clean_base', chunksize, dtype = {'text': str, 'label': str})
 
-    # Remove duplicates
-    data_red = data.drop_duplicates(subset=['text'])
-    logger.warning(f'Data Length : {len(data_red)}')
+    # Store aggregates, for incremental runs
+    cl.dt.save(dict(ts = ts, label_counts = label_counts), fn = 'fn_delta', file_type = 'json', dir = 'data_dir')
     
     # Min class occurance
-    if cu.tasks.get(str(task)).get('type') == 'classification':
-        data_red = data_red[data_red.groupby('label').label.transform('size') > min_cat_occurance]
-    elif cu.tasks.get(str(task)).get('type') == 'multi_classification':
-        # Split rows
-        data_transform = data_red[['id', 'label']].copy()
-        data_transform['label'] = [row['label'].split(",") for index, row in data_transform.iterrows()] # pipe it to list
-        data_transform = pd.DataFrame({'index':data_transform.index.repeat(data_transform.label.str.len()), 'label':np.concatenate(data_transform.label.values)}) # explode df
-        data_transform = data_transform[data_transform.groupby('label').label.transform('size') > min_cat_occurance] # count for min occurance and only keep relevant ones
-        data_transform = data_transform.groupby(['index'])['label'].apply(lambda x: ','.join(x.astype(str))).reset_index() # re-merge
-        data_transform = data_transform.set_index('index')
-        del data_red['label']
-        data_red = pd.concat([data_red, data_transform], join='inner', axis=1)
-    logger.warning(f'Data Length : {len(data_red)}')
-    data_red = data_red.tail(300000).reset_index(drop=True).copy() 
-    #TODO: .tail() temp is for debugging
+    data_red = filter_classification_chunks(chunks, label_counts, min_cat_occurance, task_type)
+    #TODO: the limit to the last 300000 rows is temp, for debugging
     ## There is a memory issue for the EN dataset, due to its size. Needs further investigation.
 
     # Label list
@@ -376,16 +512,8 @@ def prepare_classification(task, do_format, train_split, min_cat_occurance,
 def prepare_ner(task, do_format, register_data):
     pass
 
-def prepare_qa(task, do_format, min_char_length, register_data):
-
-    # Get clean object
-    cl = Clean(task=task, download_source=True)
-    
-    # Load data
-    if not os.path.isfile(cl.dt.get_path('fn_prep', dir = 'data_dir')) or do_format:
-        data = dt.get_dataset(cl, source="cdb")
-    else:
-        data = cl.dt.load('fn_prep', dir = 'data_dir')
+def clean_qa(cl, data):
+    """Filter question answer pairs and clean text of a (chunk of) qa data"""
     logger.warning(f'Data Length : {len(data)}')
 
     # Filter relevant question answer pairs
@@ -424,19 +552,59 @@ def prepare_qa(task, do_format, min_char_length, register_data):
                 rm_email_header     = True,
                 rm_email_footer     = True
             )
+    return data
 
-    # Filter by length
-    data = he.remove_short(data, 'question_clean', min_char_length=min_char_length)
-    logger.warning(f'Data Length : {len(data)}')
+def clean_qa_chunks(cl, chunks, min_char_length):
+    """Clean, filter by length & remove duplicates chunk by chunk, stored as fn_clean
 
-    # Remove duplicates
-    data = data.drop_duplicates(subset=['question_clean'])
-    logger.warning(f'Data Length : {len(data)}')
+    Returns the high-water mark.
+    """
+    seen, ts, rows = set(), None, 0
+    with cl.dt.writer('fn_clean', dir = 'data_dir') as writer:
+        for chunk in chunks:
+            chunk = clean_qa(cl, chunk)
+            ts = get_high_water_mark(chunk, ts)
+            # Filter by length & remove duplicates
+            chunk = he.remove_short(chunk, 'question_clean', min_char_length=min_char_length)
+            chunk = drop_seen(chunk, 'question_clean', seen)
+            writer.write(chunk)
+            rows += len(chunk)
+            logger.warning(f'Data Length : {rows}')
+    return ts
+
+def prepare_qa(task, do_format, min_char_length, register_data, chunksize=None, do_delta=False):
+
+    # Get clean object
+    cl = Clean(task=task, download_source=True)
+    state = get_delta_state(cl, 'fn_clean') if do_delta else None
+    if state is not None:
+        # Load new & changed data only
+        delta = dt.get_dataset(cl, source="cdb", since=state['ts'])
+        if len(delta) == 0:
+            logger.warning('[INFO] No new or changed documents, nothing to prepare.')
+            return
+    
+        ts = get_high_water_mark(delta, state['ts'])
+        # Filter and clean text, of documents still for training
+        data = dt.filter_status(delta)
+        if len(data) > 0:
+            data = clean_qa(cl, data)
+        else:
+            data = pd.DataFrame(columns = ['id', 'question_clean'])
+        logger.warning(f'Data Length : {len(data)}')
 
-    data = data.reset_index(drop=True).copy()
+        # Filter by length
+        data = he.remove_short(data, 'question_clean', min_char_length=min_char_length)
+        logger.warning(f'Data Length : {len(data)}')
 
-    # Save data
-    cl.dt.save(data, fn = 'fn_clean', dir = 'data_dir')
+        # Replace changed documents & remove duplicates
+        merge_delta(cl, 'fn_clean', data, 'question_clean', delta.id, chunksize)
+    else:
+        # Load data chunk by chunk, filter, clean text & remove duplicates
+        ts = clean_qa_chunks(cl, load_prep(cl, do_format, chunksize), min_char_length)
+
+    # Save aggregates, for incremental runs
+    cl.dt.save(dict(ts = ts), fn = 'fn_delta', file_type = 'json', dir = 'data_dir')
     # Upload data
     if register_data:
         cl.dt.upload('data_dir', destination='dataset')
@@ -446,17 +614,19 @@ def main(task=1,
             split=0.9, 
             min_cat_occurance=300, 
             min_char_length=20,
-            register_data=False):
+            register_data=False,
+            chunksize=None,
+            do_delta=False):
     logger.warning(f'Running <PREPARE> for task {task}')
     task_type = cu.tasks.get(str(task)).get('type')
     if 'classification' == task_type:
-        prepare_classification(task, do_format, split, min_cat_occurance, min_char_length, register_data)
+        prepare_classification(task, do_format, split, min_cat_occurance, min_char_length, register_data, chunksize, do_delta)
     elif 'multi_classification' == task_type:
-        prepare_classification(task, do_format, split, min_cat_occurance, min_char_length, register_data)
+        prepare_classification(task, do_format, split, min_cat_occurance, min_char_length, register_data, chunksize, do_delta)
     elif 'ner' == task_type:
         prepare_ner(task, do_format, register_data)
     elif 'qa' == task_type:
-        prepare_qa(task, do_format, min_char_length, register_data)
+        prepare_qa(task, do_format, min_char_length, register_data, chunksize, do_delta)
     else:
         logger.warning('[ERROR] TASK TYPE UNKNOWN. Nothing was processed.')
 
@@ -489,9 +659,19 @@ def run():
     parser.add_argument('--register_data',
                     action='store_true',
                     help="")
+    parser.add_argument("--chunksize", 
+                    default=None,
+                    type=int,
+                    help="Load, clean and store data in chunks of n rows, for data larger than memory. \
+                            Only running aggregates (text hashes, label counts) and the final \
+                            training sample are kept in memory.")
+    parser.add_argument('--do_delta',
+                    action='store_true',
+                    help="Only fetch and clean documents that are new or changed since the last run. Hard deleted documents need a full run (--do_format).")
     args = parser.parse_args()
     main(args.task, args.do_format, args.split, min_cat_occurance=args.min_cat_occurance, 
-                    min_char_length=args.min_char_length, register_data=args.register_data)
+                    min_char_length=args.min_char_length, register_data=args.register_data,
+                    chunksize=args.chunksize, do_delta=args.do_delta)
         
 if __name__ == '__main__':
     run()
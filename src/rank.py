@@ -16,6 +16,9 @@ import data as dt
 
 logger = he.get_logger(location=__name__)
 
+# Columns required for ranking & output
+rank_columns = ['question_clean', 'answer_text_clean', 'label_classification_simple', 'label_classification_multi']
+
 rank_type_lookup = {
     'historical' : 0, #NOTE: currently only 0 is supported
     'textblocks' : 1,
@@ -79,17 +82,25 @@ def create_bm25():
     parser.add_argument('--download_train',
                         action='store_true',
                         help="")
+    parser.add_argument("--chunksize", 
+                        default=None,
+                        type=int,
+                        help="Load and tokenize data in chunks of n rows. The BM25 index and \
+                            the ranking columns are kept in memory, as they are served.")
     args = parser.parse_args()
 
-    # Load data
+    # Load data & tokenize, chunk by chunk
+    ## The tokens are streamed into BM25, only its term frequencies and the ranking columns are kept
     cl = pr.Clean(task=args.task, download_train=args.download_train)
-    data = cl.dt.load('fn_clean', dir = 'data_dir')
-
-    # Split tokenized data
-    toks = data.question_clean.apply(cl.transform_by_task).to_list()
+    data = []
+    def iter_tokens():
+        for chunk in pr.iter_chunks(cl, 'fn_clean', args.chunksize, columns = rank_columns):
+            data.append(chunk[rank_columns])
+            yield from chunk.question_clean.apply(cl.transform_by_task)
 
     # Create BM25 Object
-    bm = bm25.BM25(toks)
+    bm = bm25.BM25(iter_tokens())
+    data = pd.concat(data, ignore_index=True)
 
     # Dump objects
     with open(cl.dt.get_path('fn_rank', 'model_dir'), 'wb') as fp:
@@ -0,0 +1,200 @@
+"""
+Rule engine for entity extraction
+
+Literal rules (error codes, KB numbers, product SKUs, ...) are held in one
+Aho-Corasick automaton, regex rules are compiled into a single alternation.
+A text is scanned once by the automaton and once by the alternation,
+independent of the number of rules.
+
+Regex rules that can not be combined (backreferences, named groups,
+conditionals or inline global flags) are matched one by one. Invalid regex
+rules are skipped with a warning.
+
+Overlaps:
+- literals: leftmost-longest, non overlapping matches on word boundaries
+- combined regex: non overlapping, at each position the first rule (in file
+  order) that matches wins, later rules do not match inside that span
+- separate regex rules: non overlapping per rule, they may overlap with all others
+
+Rules are maintained in /assets/rules.txt (tab-delimited):
+value           key         type
+KB[0-9]{6}      KB          regex
+surface pro     Product     literal
+"""
+import logging
+log = logging.getLogger(__name__)
+
+import re
+from collections import deque
+
+############################################
+#####   Aho-Corasick
+############################################
+
+def _fold(text):
+    """Lowercase text, while keeping character offsets intact"""
+    folded = text.lower()
+    if len(folded) != len(text):
+        folded = ''.join(c.lower() if len(c.lower()) == 1 else c for c in text)
+    return folded
+
+class AhoCorasick():
+    """Aho-Corasick automaton for matching many literal patterns at once"""
+
+    def __init__(self, patterns=None, ignore_case=True):
+        self.ignore_case = ignore_case
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+        self.patterns = []
+        self._built = False
+        for p in patterns or []:
+            self.add(p)
+
+    def add(self, pattern):
+        """Add pattern, returns the pattern id"""
+        if self.ignore_case:
+            pattern = _fold(pattern)
+        if pattern == '':
+            raise ValueError('Empty patterns are not supported.')
+        node = 0
+        for c in pattern:
+            nxt = self._goto[node].get(c)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][c] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+            node = nxt
+        pid = len(self.patterns)
+        self.patterns.append(pattern)
+        self._out[node].append((pid, len(pattern)))
+        self._built = False
+        return pid
+
+    def build(self):
+        """Compute failure links (breadth first)"""
+        queue = deque()
+        for nxt in self._goto[0].values():
+            self._fail[nxt] = 0
+            queue.append(nxt)
+        while queue:
+            node = queue.popleft()
+            for c, nxt in self._goto[node].items():
+                queue.append(nxt)
+                f = self._fail[node]
+                while f and c not in self._goto[f]:
+                    f = self._fail[f]
+                self._fail[nxt] = self._goto[f].get(c, 0)
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+        self._built = True
+
+    def iter(self, text):
+        """Yield (pattern id, start, end) for every occurrence in text"""
+        if not self._built:
+            self.build()
+        if self.ignore_case:
+            text = _fold(text)
+        goto, fail, out = self._goto, self._fail, self._out
+        node = 0
+        for i, c in enumerate(text):
+            while node and c not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(c, 0)
+            for pid, length in out[node]:
+                yield pid, i - length + 1, i + 1
+
+############################################
+#####   Rule Matcher
+############################################
+
+def _is_boundary(text, pos):
+    """Check for a word boundary at position"""
+    if pos <= 0 or pos >= len(text):
+        return True
+    return not (text[pos - 1].isalnum() and text[pos].isalnum())
+
+# Patterns which depend on the group numbering or apply to the whole expression
+_not_combinable = re.compile(r'\\[1-9]|\(\?P=|\(\?\(|\(\?[aiLmsux]+\)')
+
+def is_combinable(value, compiled):
+    """Check if a regex can be part of the combined alternation"""
+    return not compiled.groupindex and _not_combinable.search(value) is None
+
+class RuleMatcher():
+    """Match literal and regex rules, with one scan for all literals and one for all combined regex rules
+
+    Rules are dicts (or rows) with the keys:
+    - value : literal term or regular expression
+    - key   : entity label
+    - type  : 'literal' (default) or 'regex'
+    """
+
+    def __init__(self, rules, ignore_case=True):
+        flags = re.IGNORECASE if ignore_case else 0
+        self.literals = AhoCorasick(ignore_case=ignore_case)
+        self.literal_labels = []
+        self.regex_labels = []
+        self.separate = []
+        self.invalid = []
+        regex = []
+        for rule in rules:
+            value, key = rule.get('value'), rule.get('key')
+            if not isinstance(value, str) or value == '':
+                continue
+            if rule.get('type', 'literal') == 'regex':
+                ## Validate each rule on its own
+                try:
+                    compiled = re.compile(value, flags)
+                except re.error as e:
+                    log.warning(f'[WARNING] Skipping invalid regex rule {value!r} ({key}): {e}')
+                    self.invalid.append((value, key, str(e)))
+                    continue
+                if is_combinable(value, compiled):
+                    regex.append(f'(?P<_r{len(regex)}>{value})')
+                    self.regex_labels.append(key)
+                else:
+                    self.separate.append((compiled, key))
+            else:
+                self.literals.add(value)
+                self.literal_labels.append(key)
+        self.literals.build()
+        self.regex = None
+        if regex:
+            try:
+                self.regex = re.compile('|'.join(regex), flags)
+            except re.error as e:
+                ## Fall back to matching the rules one by one
+                log.warning(f'[WARNING] Could not combine regex rules, matching them separately: {e}')
+                self.separate = [(re.compile(r[r.index('>') + 1:-1], flags), k)
+                                    for r, k in zip(regex, self.regex_labels)] + self.separate
+                self.regex_labels = []
+        log.info(f'[INFO] Loaded {len(self.literal_labels)} literal, {len(self.regex_labels)} combined regex and '
+                    f'{len(self.separate)} separate regex rules, skipped {len(self.invalid)} invalid rules.')
+
+    def match_literals(self, text):
+        """Leftmost-longest, non overlapping literal matches on word boundaries"""
+        hits = sorted(((s, -e, pid) for pid, s, e in self.literals.iter(text)
+                        if _is_boundary(text, s) and _is_boundary(text, e)))
+        res, last = [], -1
+        for s, e, pid in hits:
+            if s >= last:
+                res.append((text[s:-e], s, -e, self.literal_labels[pid], 'rule'))
+                last = -e
+        return res
+
+    def match_regex(self, text):
+        """Matches of the combined regex alternation and of the separate regex rules"""
+        res = []
+        if self.regex is not None:
+            res = [(m.group(), m.start(), m.end(), self.regex_labels[int(m.lastgroup[2:])], 'regex')
+                    for m in self.regex.finditer(text) if m.end() > m.start()]
+        for compiled, key in self.separate:
+            res.extend((m.group(), m.start(), m.end(), key, 'regex')
+                        for m in compiled.finditer(text) if m.end() > m.start())
+        return res
+
+    def match(self, text):
+        """Get all rule matches as (value, start, end, label, source)"""
+        return self.match_literals(text) + self.match_regex(text)
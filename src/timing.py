@@ -0,0 +1,166 @@
+"""
+Latency instrumentation of the scoring hot path
+
+Each request gets a Trace, which records the duration of its stages (laps).
+Traces are aggregated into histograms with fixed, exponential buckets: recording
+is a bisect and an increment, percentiles (p50/p95/p99) are estimated from the
+buckets. The histograms are exported in the Prometheus text format.
+
+When disabled, requests get a no-op trace, so the overhead is an empty call per stage.
+"""
+import time
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds (seconds) of the histogram buckets, 0.1ms to ~74s in steps of sqrt(2)
+buckets = [1e-4 * 2 ** (i / 2) for i in range(40)]
+quantiles = [0.5, 0.95, 0.99]
+prefix = 'infer_stage_seconds'
+
+class Histogram():
+    """Counts by bucket, with sum & max"""
+    __slots__ = ('bounds', 'counts', 'sum', 'max')
+
+    def __init__(self, bounds=buckets):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def quantile(self, q):
+        """Estimated quantile, interpolated linearly within its bucket"""
+        total = self.count
+        if total == 0:
+            return 0.0
+        rank = q * total
+        cumulative = 0
+        for i, c in enumerate(self.counts):
+            if c > 0 and cumulative + c >= rank:
+                lower = self.bounds[i - 1] if i > 0 else 0.0
+                upper = self.bounds[i] if i < len(self.bounds) else self.max
+                return min(lower + (upper - lower) * (rank - cumulative) / c, self.max)
+            cumulative += c
+        return self.max
+
+class Trace():
+    """Stage durations (seconds) of a single request"""
+    __slots__ = ('start', 'last', 'timings')
+
+    def __init__(self, start=None):
+        self.start = self.last = start if start is not None else time.perf_counter()
+        self.timings = []
+
+    def lap(self, stage, task=None):
+        """Record the time since the previous lap as stage, returns the current time"""
+        now = time.perf_counter()
+        self.timings.append((stage, task, now - self.last))
+        self.last = now
+        return now
+
+    def since(self, stage, start, task=None):
+        """Record the time from start to the last lap as stage, e.g. a whole task"""
+        self.timings.append((stage, task, self.last - start))
+
+    def breakdown(self, task=None):
+        """Durations in ms by stage, of the request and a task"""
+        return {stage: round(seconds * 1e3, 3) for stage, _task, seconds in self.timings
+                    if _task is None or _task == task}
+
+class NullTrace():
+    """Trace which records nothing"""
+    __slots__ = ()
+    start = last = 0.0
+    timings = ()
+
+    def lap(self, stage, task=None):
+        return 0.0
+
+    def since(self, stage, start, task=None):
+        pass
+
+    def breakdown(self, task=None):
+        return {}
+
+null_trace = NullTrace()
+
+class Registry():
+    """Stage histograms by stage & task, shared by all requests of the service"""
+    def __init__(self, enabled=True, bounds=buckets):
+        self.enabled = enabled
+        self.bounds = bounds
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def trace(self, start=None, force=False):
+        """New trace of a request, a no-op trace if disabled (and not forced, e.g. for a timing response)"""
+        return Trace(start) if self.enabled or force else null_trace
+
+    def record(self, trace):
+        """Add the stage durations of a finished request to the histograms"""
+        if not self.enabled or not trace.timings:
+            return
+        with self._lock:
+            for stage, task, seconds in trace.timings:
+                key = (stage, task)
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = Histogram(self.bounds)
+                histogram.observe(seconds)
+
+    def summary(self):
+        """Count & percentiles (ms) by stage & task"""
+        with self._lock:
+            return {(stage, task): dict(count=h.count, **{f'p{int(q * 100)}': h.quantile(q) * 1e3 for q in quantiles})
+                        for (stage, task), h in self.histograms.items()}
+
+    def to_prometheus(self):
+        """Histograms & estimated quantiles, in the Prometheus text format"""
+        lines = [f'# HELP {prefix} Duration of the scoring stages.',
+                f'# TYPE {prefix} histogram']
+        lines_q = [f'# HELP {prefix}_quantile Estimated quantiles of the scoring stage durations.',
+                f'# TYPE {prefix}_quantile gauge']
+        with self._lock:
+            for (stage, task), h in sorted(self.histograms.items(), key = lambda x: (x[0][0], str(x[0][1]))):
+                labels = f'stage="{stage}"' + (f',task="{task}"' if task is not None else '')
+                cumulative = 0
+                for bound, c in zip(self.bounds, h.counts):
+                    cumulative += c
+                    lines.append(f'{prefix}_bucket{{{labels},le="{bound:.6g}"}} {cumulative}')
+                lines.append(f'{prefix}_bucket{{{labels},le="+Inf"}} {h.count}')
+                lines.append(f'{prefix}_sum{{{labels}}} {h.sum:.9g}')
+                lines.append(f'{prefix}_count{{{labels}}} {h.count}')
+                for q in quantiles:
+                    lines_q.append(f'{prefix}_quantile{{{labels},quantile="{q}"}} {h.quantile(q):.9g}')
+        return '\n'.join(lines + lines_q) + '\n'
+
+def serve(registry, port):
+    """Expose the histograms on http://<host>:port/metrics, in a daemon thread"""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip('/') != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.to_prometheus().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('', port), Handler)
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    return server
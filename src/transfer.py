@@ -0,0 +1,234 @@
+"""
+Transfer engine for parallel, resumable uploads and downloads
+
+Large files are split into blocks, blocks of several files are transferred
+concurrently by a bounded worker pool.
+- Uploads are resumable, as blocks are staged (uncommitted) in the store
+  and block ids are derived from the block content.
+- Downloads are resumable, as the completed blocks are tracked next to
+  the partial file (<file>.part.json), and validated against the etag.
+
+Stores implement the block blob interface of BlobStore, the FakeBlobStore
+is a local filesystem fake for testing.
+"""
+import logging
+log = logging.getLogger(__name__)
+
+import os
+import json
+import time
+import base64
+import shutil
+import hashlib
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+############################################
+#####   Stores
+############################################
+
+class BlobStore():
+    """Block blob interface for the Azure Storage Account (BlockBlobService)"""
+    def __init__(self, bbs):
+        self.bbs = bbs
+
+    def create_container(self, container):
+        self.bbs.create_container(container, fail_on_exist = False)
+
+    def put_block(self, container, blob, block_id, data):
+        self.bbs.put_block(container, blob, data, block_id)
+
+    def put_block_list(self, container, blob, block_ids):
+        from azure.storage.blob import BlobBlock
+        self.bbs.put_block_list(container, blob, [BlobBlock(id = i) for i in block_ids])
+
+    def get_uncommitted_blocks(self, container, blob):
+        from azure.storage.blob import BlockListType
+        try:
+            blocks = self.bbs.get_block_list(container, blob, block_list_type = BlockListType.Uncommitted)
+        except Exception:
+            return set()
+        return {b.id for b in blocks.uncommitted_blocks}
+
+    def get_properties(self, container, blob):
+        """Get size and etag of blob"""
+        properties = self.bbs.get_blob_properties(container, blob).properties
+        return properties.content_length, properties.etag
+
+    def get_range(self, container, blob, start, end):
+        return self.bbs.get_blob_to_bytes(container, blob, start_range = start, end_range = end - 1).content
+
+class FakeBlobStore():
+    """Local filesystem fake of a block blob store
+
+    root/<container>/<blob>                 <- committed blobs
+    root/.blocks/<container>/<blob>/<id>    <- uncommitted blocks
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def _blob(self, container, blob):
+        return os.path.join(self.root, container, blob)
+
+    def _blocks(self, container, blob):
+        return os.path.join(self.root, '.blocks', container, blob)
+
+    def create_container(self, container):
+        os.makedirs(os.path.join(self.root, container), exist_ok = True)
+
+    def put_block(self, container, blob, block_id, data):
+        fp = os.path.join(self._blocks(container, blob), base64.urlsafe_b64encode(block_id.encode()).decode())
+        os.makedirs(os.path.dirname(fp), exist_ok = True)
+        with open(fp, 'wb') as f:
+            f.write(data)
+
+    def put_block_list(self, container, blob, block_ids):
+        fp = self._blob(container, blob)
+        os.makedirs(os.path.dirname(fp), exist_ok = True)
+        with open(fp, 'wb') as f:
+            for i in block_ids:
+                with open(os.path.join(self._blocks(container, blob),
+                            base64.urlsafe_b64encode(i.encode()).decode()), 'rb') as b:
+                    shutil.copyfileobj(b, f)
+        shutil.rmtree(self._blocks(container, blob), ignore_errors = True)
+
+    def get_uncommitted_blocks(self, container, blob):
+        if not os.path.isdir(self._blocks(container, blob)):
+            return set()
+        return {base64.urlsafe_b64decode(i.encode()).decode() for i in os.listdir(self._blocks(container, blob))}
+
+    def get_properties(self, container, blob):
+        stat = os.stat(self._blob(container, blob))
+        return stat.st_size, f'{stat.st_mtime_ns}-{stat.st_size}'
+
+    def get_range(self, container, blob, start, end):
+        with open(self._blob(container, blob), 'rb') as f:
+            f.seek(start)
+            return f.read(end - start)
+
+############################################
+#####   Transfer Engine
+############################################
+
+def get_block_id(index, data):
+    """Block ids are derived from position and content, so staged blocks can be reused"""
+    return base64.b64encode(f'{index:08d}-{hashlib.md5(data).hexdigest()}'.encode()).decode()
+
+def get_blob_files(fp, fn):
+    """Map a local file or directory to (local path, blob name) pairs"""
+    if os.path.isdir(fp):
+        return [(str(f), f'{fn}/{f.relative_to(fp).as_posix()}')
+                    for f in sorted(Path(fp).rglob('*')) if f.is_file()]
+    return [(fp, fn)]
+
+def write_state(part, state):
+    """Write the download progress atomically, synced to disk before it replaces the previous state"""
+    tmp = f'{part}.json.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, f'{part}.json')
+
+class TransferEngine():
+    def __init__(self, store, max_workers = 8, block_size = 4 * 1024 * 1024):
+        self.store = store
+        self.max_workers = max_workers
+        self.block_size = block_size
+
+    def _n_blocks(self, size):
+        return (size + self.block_size - 1) // self.block_size
+
+    def _report(self, direction, n_files, n_bytes, start):
+        """Log throughput of transfer"""
+        duration = max(time.perf_counter() - start, 1e-9)
+        stats = dict(files = n_files, bytes = n_bytes, seconds = duration, mb_per_sec = n_bytes / 1e6 / duration)
+        log.warning(f'[INFO] {direction} {n_files} files, {n_bytes / 1e6:.1f} MB in {duration:.1f}s '
+                        f'({stats["mb_per_sec"]:.1f} MB/s)')
+        return stats
+
+    ##### UPLOAD #####
+    def _upload_block(self, container, blob, fp, index, staged):
+        """Read and stage block, unless it was staged before"""
+        with open(fp, 'rb') as f:
+            f.seek(index * self.block_size)
+            data = f.read(self.block_size)
+        block_id = get_block_id(index, data)
+        if block_id in staged:
+            return block_id, 0
+        self.store.put_block(container, blob, block_id, data)
+        return block_id, len(data)
+
+    def upload(self, container, files):
+        """Upload files, as list of (local path, blob name)"""
+        start = time.perf_counter()
+        self.store.create_container(container)
+        with ThreadPoolExecutor(max_workers = self.max_workers) as pool:
+            jobs = []
+            for fp, blob in files:
+                staged = self.store.get_uncommitted_blocks(container, blob)
+                if len(staged) > 0:
+                    log.info(f'[INFO] Resuming upload of {blob}, {len(staged)} blocks staged')
+                jobs.append((blob, [pool.submit(self._upload_block, container, blob, fp, i, staged)
+                                        for i in range(self._n_blocks(os.path.getsize(fp)))]))
+            n_bytes = 0
+            for blob, futures in jobs:
+                results = [f.result() for f in futures]
+                self.store.put_block_list(container, blob, [block_id for block_id, __ in results])
+                n_bytes += sum(n for __, n in results)
+        return self._report('Uploaded', len(files), n_bytes, start)
+
+    ##### DOWNLOAD #####
+    def _download_block(self, container, blob, part, index, size, state, lock):
+        """Download block into its position of the partial file"""
+        start = index * self.block_size
+        data = self.store.get_range(container, blob, start, min(start + self.block_size, size))
+        with open(part, 'r+b') as f:
+            f.seek(start)
+            f.write(data)
+            # On disk, before the block is marked as done
+            f.flush()
+            os.fsync(f.fileno())
+        with lock:
+            state['done'].append(index)
+            write_state(part, state)
+        return len(data)
+
+    def _get_state(self, part, size, etag):
+        """Load progress of a previous download, if the blob did not change"""
+        try:
+            with open(f'{part}.json') as f:
+                state = json.load(f)
+            if state.get('etag') == etag and state.get('block_size') == self.block_size \
+                    and os.path.getsize(part) == size:
+                return state
+        except (OSError, ValueError):
+            pass
+        os.makedirs(os.path.dirname(os.path.abspath(part)), exist_ok = True)
+        with open(part, 'wb') as f:
+            f.truncate(size)
+        state = dict(etag = etag, block_size = self.block_size, done = [])
+        write_state(part, state)
+        return state
+
+    def download(self, container, files):
+        """Download files, as list of (blob name, local path)"""
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers = self.max_workers) as pool:
+            jobs = []
+            for blob, fp in files:
+                size, etag = self.store.get_properties(container, blob)
+                part = f'{fp}.part'
+                state = self._get_state(part, size, etag)
+                if len(state['done']) > 0:
+                    log.info(f'[INFO] Resuming download of {blob}, {len(state["done"])} blocks done')
+                done, lock = set(state['done']), threading.Lock()
+                jobs.append((fp, part, [pool.submit(self._download_block, container, blob, part, i, size, state, lock)
+                                            for i in range(self._n_blocks(size)) if i not in done]))
+            n_bytes = 0
+            for fp, part, futures in jobs:
+                n_bytes += sum(f.result() for f in futures)
+                os.replace(part, fp)
+                os.remove(f'{part}.json')
+        return self._report('Downloaded', len(files), n_bytes, start)
@@ -0,0 +1,319 @@
+"""
+Benchmark text cleaning (Clean.transform & transform_by_task), by stage, language and flags
+
+On a generated corpus of tickets per language (with email headers, greetings, footers,
+HTML, urls, dates, numbers, ...), each flag combination is run stage by stage
+(prepare, remove, placeholder, tokenize, lower, whitespace), with the same steps as
+Clean.transform (checked against its output). Reported are docs/sec, µs/doc by stage
+and the peak allocated memory (tracemalloc). transform_by_task is timed per document,
+as called by the scoring service.
+
+Results are compared to a stored baseline, throughput drops or memory increases above
+the tolerance are flagged as regressions (exit code 1). Baselines depend on the machine,
+store one with --save_baseline before a change.
+
+Example (in the command line):
+> cd to root dir
+> python tests/benchmark_clean.py --save_baseline
+> python tests/benchmark_clean.py --languages en de --combinations stage
+"""
+import sys
+import json
+import time
+import platform
+import tempfile
+import argparse
+import itertools
+import tracemalloc
+import subprocess
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+sys.path.append('./src')
+import helper as he
+import custom as cu
+
+logger = he.get_logger(location=__name__)
+
+fn_baseline = 'tests/benchmark_clean_baseline.json'
+languages = ['en', 'de', 'fr', 'es', 'it']
+task_types = ['classification', 'multi_classification', 'ner', 'qa']
+
+# Flags of Clean.transform by stage, remove_whitespace is on by default
+stage_flags = {
+    'remove'        : ['rm_email_formatting', 'rm_email_header', 'rm_email_footer', 'rm_punctuation'],
+    'placeholder'   : ['rp_generic', 'rp_num'],
+    'tokenize'      : ['lemmatize', 'rm_stopwords', 'return_token'],
+    'lower'         : ['to_lower']
+}
+# Flags of transform_by_task
+presets = {
+    'classification' : dict(rm_email_formatting=True, rm_email_header=True, rm_email_footer=True, rp_generic=True),
+    'qa' : dict(to_lower=True, rm_email_formatting=True, rm_email_header=True, rm_email_footer=True,
+                rm_punctuation=True, rp_generic=True, rp_num=True, lemmatize=True, rm_stopwords=True,
+                return_token=True)
+}
+
+############################################
+#####   Corpus
+############################################
+
+corpus_lookup = {
+    'en' : dict(
+        words = ['the', 'computer', 'does', 'not', 'start', 'after', 'update', 'and', 'I', 'have', 'tried',
+                'to', 'restart', 'it', 'several', 'times', 'screen', 'stays', 'black', 'error', 'message',
+                'shows', 'when', 'installing', 'driver', 'printer', 'is', 'offline', 'account', 'password'],
+        headers = ['RE: ', 'FW: ', 'AW: ', ''],
+        greetings = ['Hello,', 'Dear Sir or Madam,', 'Hi team,'],
+        footers = ['Kind regards, John', 'Thanks in advance', 'Best, Jane']),
+    'de' : dict(
+        words = ['der', 'Computer', 'startet', 'nicht', 'mehr', 'nach', 'dem', 'Update', 'und', 'ich', 'habe',
+                'versucht', 'ihn', 'neu', 'zu', 'starten', 'Bildschirm', 'bleibt', 'schwarz', 'Fehlermeldung',
+                'erscheint', 'beim', 'Installieren', 'Treiber', 'Drucker', 'ist', 'offline', 'Konto', 'Passwort', 'leider'],
+        headers = ['AW: ', 'WG: ', 'RE: ', ''],
+        greetings = ['Sehr geehrte Damen und Herren,', 'Hallo,', 'Guten Tag,'],
+        footers = ['Mit freundlichen Grüßen Max Mustermann', 'Vielen Dank im Voraus', 'LG Anna',
+                'Von meinem iPhone gesendet ']),
+    'fr' : dict(
+        words = ["l'ordinateur", 'ne', 'démarre', 'plus', 'après', 'la', 'mise', 'à', 'jour', 'et', "j'ai",
+                'essayé', 'de', 'le', 'redémarrer', 'plusieurs', 'fois', "l'écran", 'reste', 'noir', 'message',
+                "d'erreur", 'pilote', 'imprimante', 'est', 'hors', 'ligne', 'compte', 'mot', 'passe'],
+        headers = ['RE: ', 'TR: ', ''],
+        greetings = ['Bonjour,', 'Madame, Monsieur,'],
+        footers = ['Cordialement, Jean', 'Merci d\'avance']),
+    'es' : dict(
+        words = ['el', 'ordenador', 'no', 'arranca', 'después', 'de', 'la', 'actualización', 'y', 'he',
+                'intentado', 'reiniciarlo', 'varias', 'veces', 'pantalla', 'se', 'queda', 'negra', 'mensaje',
+                'error', 'al', 'instalar', 'controlador', 'impresora', 'está', 'desconectada', 'cuenta',
+                'contraseña', 'también', 'ayuda'],
+        headers = ['RE: ', 'RV: ', ''],
+        greetings = ['Hola,', 'Estimados señores,'],
+        footers = ['Saludos cordiales, Juan', 'Gracias de antemano']),
+    'it' : dict(
+        words = ['il', 'computer', 'non', 'si', 'avvia', 'più', 'dopo', "l'aggiornamento", 'e', 'ho', 'provato',
+                'a', 'riavviarlo', 'diverse', 'volte', 'lo', 'schermo', 'rimane', 'nero', 'messaggio', 'di',
+                'errore', 'installare', 'driver', 'stampante', 'è', 'offline', 'account', 'password', 'aiuto'],
+        headers = ['R: ', 'I: ', ''],
+        greetings = ['Buongiorno,', 'Gentili signori,'],
+        footers = ['Cordiali saluti, Mario', 'Grazie in anticipo'])
+}
+# Noise, for the remove & placeholder steps
+noise = ['<div>', '</p>', '<br/>', 'john.doe@contoso.com', 'https://support.microsoft.com/help/4028080',
+        '12/05/2020', '14:30', '192.168.0.1', 'KB123456', '+491701234567', '0x80070005 ', '2500', '42', '€',
+        '$', '(see', 'below)!', 'Original Title:', '\t']
+
+def get_corpus(language, docs, lengths, seed=42):
+    """Tickets of a language, with the lengths (words) in turn"""
+    rng = np.random.RandomState(seed)
+    lookup = corpus_lookup[language]
+    texts = []
+    for i in range(docs):
+        length = lengths[i % len(lengths)]
+        body = list(rng.choice(lookup['words'], length))
+        for j in rng.randint(0, length, max(1, length // 10)):
+            body[j] = rng.choice(noise)
+        texts.append(f"{rng.choice(lookup['headers'])}{' '.join(rng.choice(lookup['words'], 5))}. "
+                    f"{rng.choice(lookup['greetings'])} {' '.join(body)} {rng.choice(lookup['footers'])}")
+    return texts
+
+############################################
+#####   Flag Combinations
+############################################
+
+def get_combinations(mode='stage'):
+    """Named flag combinations: per stage (all subsets of its flags), all (full product) or presets only"""
+    combinations = {'none': {}}
+    if mode == 'stage':
+        for flags in stage_flags.values():
+            for r in range(1, len(flags) + 1):
+                for subset in itertools.combinations(flags, r):
+                    combinations['+'.join(subset)] = {f: True for f in subset}
+        combinations['no_whitespace'] = dict(remove_whitespace=False)
+    elif mode == 'all':
+        flags = [f for _flags in stage_flags.values() for f in _flags] + ['remove_whitespace']
+        for values in itertools.product([False, True], repeat=len(flags)):
+            combination = {f: v for f, v in zip(flags, values) if v != (f == 'remove_whitespace')}
+            combinations['+'.join(f if v else f'no_{f}' for f, v in combination.items()) or 'none'] = combination
+    combinations.update({f'task_{k}': v for k, v in presets.items()})
+    return combinations
+
+############################################
+#####   Measurement
+############################################
+
+def staged_transform(cl, texts, flags):
+    """Clean.transform, stage by stage, returns the output & seconds by stage"""
+    f = {flag: False for _flags in stage_flags.values() for flag in _flags}
+    f['remove_whitespace'] = True
+    f.update(flags)
+    seconds = {}
+    start = time.perf_counter()
+
+    def lap(stage):
+        nonlocal start
+        now = time.perf_counter()
+        seconds[stage] = now - start
+        start = now
+
+    df_texts = pd.Series(texts).replace('\t', ' ', regex=True)
+    lap('prepare')
+    if any(f[k] for k in stage_flags['remove']):
+        df_texts = df_texts.apply(cl.remove, **{k: f[k] for k in stage_flags['remove']})
+        lap('remove')
+    if any(f[k] for k in stage_flags['placeholder']):
+        df_texts = df_texts.apply(cl.get_placeholder, **{k: f[k] for k in stage_flags['placeholder']})
+        lap('placeholder')
+    if any(f[k] for k in stage_flags['tokenize']):
+        df_texts = df_texts.apply(cl.tokenize, lemmatize=f['lemmatize'], rm_stopwords=f['rm_stopwords'])
+        lap('tokenize')
+    if f['to_lower']:
+        df_texts = df_texts.apply(str.lower)
+        lap('lower')
+    if f['remove_whitespace']:
+        df_texts = df_texts.apply(lambda x: " ".join(x.split()))
+        lap('whitespace')
+    if f['return_token']:
+        return [t.split(' ') for t in df_texts.to_list()], seconds
+    return df_texts.to_list(), seconds
+
+def measure_allocations(cl, texts, flags):
+    """Peak allocated memory (KB) of Clean.transform"""
+    tracemalloc.start()
+    try:
+        cl.transform(texts, **flags)
+        __, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / 1024
+
+def measure(cl, texts, flags, repeats):
+    """Docs/sec, µs/doc by stage (fastest of the repeats) & peak KB of a flag combination"""
+    output, __ = staged_transform(cl, texts[:50], flags)
+    if output != cl.transform(texts[:50], **flags):
+        raise Exception(f'STAGED TRANSFORM DIFFERS FROM Clean.transform FOR {flags}')
+    best = None
+    for __ in range(repeats):
+        __, seconds = staged_transform(cl, texts, flags)
+        best = seconds if best is None else {k: min(v, best[k]) for k, v in seconds.items()}
+    return dict(
+        docs_per_sec = len(texts) / sum(best.values()),
+        stage_us_per_doc = {k: v / len(texts) * 1e6 for k, v in best.items()},
+        peak_kb = measure_allocations(cl, texts, flags)
+    )
+
+def measure_by_task(cl, texts, repeats):
+    """Docs/sec of transform_by_task, one document per call"""
+    result = {}
+    for task_type in task_types:
+        cu.tasks[str(cl.task)] = dict(type=task_type)
+        # Input as passed by the scoring service
+        inputs = [[t] for t in texts] if task_type == 'ner' else texts
+        seconds = []
+        for __ in range(repeats):
+            start = time.perf_counter()
+            for text in inputs:
+                cl.transform_by_task(text)
+            seconds.append(time.perf_counter() - start)
+        result[task_type] = len(texts) / min(seconds)
+    return result
+
+def load_clean(language, task, blank):
+    """Clean instance of a language, optionally with a blank spacy model (offline, no lemmatizer)"""
+    import prepare as pr
+    cu.params['language'] = language
+    if blank:
+        import spacy
+        he.load_spacy_model = lambda language='xx', disable=[]: spacy.blank(language)
+    return pr.Clean(task=task, inference=True)
+
+############################################
+#####   Report
+############################################
+
+def compare(baseline, results, tolerance):
+    """Regressions vs. the baseline: lower docs/sec or higher peak memory, beyond the tolerance"""
+    regressions = []
+    for language, combinations in results.items():
+        for name, r in combinations.items():
+            b = baseline.get(language, {}).get(name)
+            if b is None:
+                continue
+            if name == 'by_task':
+                checks = [(f'{k} docs/sec', b.get(k), v, 'higher') for k, v in r.items()]
+            else:
+                checks = [('docs/sec', b['docs_per_sec'], r['docs_per_sec'], 'higher'),
+                        ('peak KB', b['peak_kb'], r['peak_kb'], 'lower')]
+            for metric, old, new, better in checks:
+                if not old:
+                    continue
+                change = new / old - 1
+                if (change < -tolerance) if better == 'higher' else (change > tolerance):
+                    regressions.append((language, name, metric, old, new, change))
+    return regressions
+
+def get_meta(args):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return dict(commit=commit, date=time.strftime('%Y-%m-%dT%H:%M:%S'), python=platform.python_version(),
+                platform=platform.platform(), docs=args.docs, lengths=args.lengths, repeats=args.repeats,
+                blank=args.blank)
+
+def run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--languages", default=languages, nargs='+', choices=languages)
+    parser.add_argument("--combinations", default='stage', choices=['stage', 'all', 'presets'],
+                        help="Flag combinations: per stage, full product of all flags or transform_by_task presets")
+    parser.add_argument("--docs", default=1000, type=int)
+    parser.add_argument("--lengths", default=[10, 50, 200], nargs='+', type=int, help="Document lengths (words)")
+    parser.add_argument("--repeats", default=3, type=int)
+    parser.add_argument("--task", default=1, type=int, help="Task id of the Clean instance")
+    parser.add_argument("--blank", action='store_true', help="Blank spacy models, no download needed")
+    parser.add_argument("--baseline", default=fn_baseline, type=str)
+    parser.add_argument("--save_baseline", action='store_true', help="Store the results as the new baseline")
+    parser.add_argument("--tolerance", default=0.2, type=float, help="Max relative change, before a regression is flagged")
+    parser.add_argument("--output", default=None, type=str, help="Also write the results (JSON)")
+    args = parser.parse_args()
+
+    # Clean writes its data dirs to the data dir of the project
+    cu.params['data_dir'] = tempfile.mkdtemp(prefix='benchmark_clean_')
+    combinations = get_combinations(args.combinations)
+    results = {}
+    for language in args.languages:
+        cl = load_clean(language, args.task, args.blank)
+        texts = get_corpus(language, args.docs, args.lengths)
+        results[language] = {}
+        print(f'\n{language.upper()} - {args.docs} docs')
+        print(f'{"flags":<48}{"docs/s":>10}{"peak KB":>10}  µs/doc by stage')
+        for name, flags in combinations.items():
+            r = results[language][name] = measure(cl, texts, flags, args.repeats)
+            stages = ' '.join(f'{k}={v:.1f}' for k, v in r['stage_us_per_doc'].items())
+            print(f'{name:<48}{r["docs_per_sec"]:>10.0f}{r["peak_kb"]:>10.0f}  {stages}')
+        r = results[language]['by_task'] = measure_by_task(cl, texts, args.repeats)
+        print('transform_by_task docs/s: ' + ', '.join(f'{k}={v:.0f}' for k, v in r.items()))
+
+    output = dict(meta=get_meta(args), results=results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(output, f, indent=2)
+        print(f'\nBaseline saved -> {args.baseline}')
+    elif Path(args.baseline).exists():
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline['results'], results, args.tolerance)
+        print(f'\n{len(regressions)} regression(s) vs. baseline {baseline["meta"].get("commit")} (tolerance {args.tolerance:.0%})')
+        for language, name, metric, old, new, change in regressions:
+            print(f'  {language} {name:<44}{metric:<28}{old:>10.0f} -> {new:>10.0f} ({change:+.1%})')
+        if len(regressions) > 0:
+            sys.exit(1)
+    else:
+        logger.warning(f'[INFO] No baseline at {args.baseline}, store one with --save_baseline')
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,74 @@
+"""
+Benchmark subject/body concatenation, row-wise vs. vectorized
+
+Example (in the command line):
+> cd to root dir
+> python tests/benchmark_concat.py --rows 1000000
+"""
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+import sys
+sys.path.append('./src')
+import helper as he
+
+logger = he.get_logger(location=__name__)
+
+def get_corpus(rows, seed=42):
+    """Generate subjects & bodies, with duplicated subjects and missing values"""
+    rng = np.random.RandomState(seed)
+    words = np.array(['windows', 'surface', 'update', 'error', 'driver', 'screen', 'office',
+                        'install', 'account', 'password', 'network', 'battery', 'printer'])
+    subjects = [' '.join(rng.choice(words, rng.randint(1, 8))) for _ in range(rows)]
+    bodies = [' '.join(rng.choice(words, rng.randint(5, 300))) for _ in range(rows)]
+    # Body starts with subject
+    dup = rng.rand(rows) < 0.3
+    bodies = [f'{s} {b}' if d else b for s, b, d in zip(subjects, bodies, dup)]
+    data = pd.DataFrame({'subject': subjects, 'body': bodies}, dtype=object)
+    # Missing values
+    data.loc[rng.rand(rows) < 0.01, 'subject'] = np.nan
+    data.loc[rng.rand(rows) < 0.01, 'body'] = np.nan
+    return data
+
+def validate_concat_loop(col1, col2, max_len=1000):
+    """Previous row-wise implementation, as reference"""
+    text_concat = []
+    for __, (sub, des) in enumerate(zip(col1, col2)):
+        try:
+            if sub in des[:len(sub)]:
+                text_concat.append(des[:max_len])
+            else:
+                new_line = sub + '. ' + des
+                text_concat.append(new_line[:max_len])
+        except Exception as e:
+            logger.warning(f'[WARNING] Validate Concat - {e}')
+            if 'float' in str(e):
+                text_concat.append(str(des))
+            else:
+                text_concat.append(des[:max_len])
+    return text_concat
+
+def run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", default=1000000, type=int)
+    parser.add_argument("--max_len", default=1000, type=int)
+    args = parser.parse_args()
+
+    data = get_corpus(args.rows)
+
+    start = time.perf_counter()
+    expected = validate_concat_loop(data.subject, data.body, max_len=args.max_len)
+    t_row = time.perf_counter() - start
+
+    start = time.perf_counter()
+    result = he.validate_concat(data.subject, data.body, max_len=args.max_len)
+    t_vec = time.perf_counter() - start
+
+    assert result == expected, 'Vectorized results differ from row-wise results'
+    print(f'{"rows":<12}{"row-wise (s)":>14}{"vectorized (s)":>16}{"speedup":>10}')
+    print(f'{args.rows:<12}{t_row:>14.3f}{t_vec:>16.3f}{t_row / t_vec:>9.1f}x')
+
+if __name__ == '__main__':
+    run()
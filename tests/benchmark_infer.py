@@ -0,0 +1,350 @@
+"""
+End-to-end benchmark of the scoring service (infer.init & infer.run), per task type
+
+Runs offline on CPU: tiny, randomly initialized models are built from demo/sample_data.csv
+in a temporary data directory, and external services are replaced by local stand-ins
+(spacy model download -> blank spacy model, Text Analytics -> no entities).
+Each task type is measured in a fresh process, for the cold start and memory:
+- init: seconds to import infer and run infer.init()
+- latency: p50/p95/p99 (ms) of single requests, for the sample tickets and for
+  synthetic tickets by length (words), with the p50 by stage
+- throughput: requests/sec of single requests, and tickets/sec of batched model inference
+- peak RSS (MB), after init and at the end
+
+Results are written as JSON. With --compare, the key metrics are compared to a
+previous result and regressions above the tolerance are flagged (exit code 1).
+
+Example (in the command line):
+> cd to root dir
+> python tests/benchmark_infer.py --tickets 200 --output benchmark_infer.json
+> python tests/benchmark_infer.py --task_types classification qa --compare benchmark_infer.json
+"""
+import os
+import re
+import sys
+import json
+import time
+import pickle
+import shutil
+import platform
+import tempfile
+import argparse
+import resource
+import subprocess
+from pathlib import Path
+from collections import Counter
+import numpy as np
+import pandas as pd
+
+sys.path.append('./src')
+
+fn_sample = 'demo/sample_data.csv'
+marker = 'BENCHMARK_RESULT '
+# Task ids, as in the project configs
+task_lookup = {
+    'classification'        : 1,
+    'multi_classification'  : 2,
+    'ner'                   : 3,
+    'qa'                    : 4
+}
+# Batched model inference, only for FARM models
+batch_types = ['classification', 'multi_classification']
+# Noise for synthetic tickets, to exercise the cleaning steps
+noise = ['john.doe@contoso.com', 'https://support.microsoft.com/help/4028080', '12/05/2020', '14:30',
+        '192.168.0.1', 'KB123456', '+491701234567', '0x80070005', '2500', '$', 'RE:', '<br>']
+
+############################################
+#####   Data
+############################################
+
+def load_sample(n=None):
+    data = pd.read_csv(fn_sample)
+    return data.head(n) if n is not None else data
+
+def get_tickets(n):
+    """Subject & body of the first n sample tickets"""
+    data = load_sample(n)
+    return [dict(subject=s, body=b) for s, b in zip(data.question_title.fillna(''), data.question_text.fillna(''))]
+
+def get_synthetic(n, lengths, seed=42):
+    """n tickets per length (words), from the words of the sample data with some noise"""
+    rng = np.random.RandomState(seed)
+    words = ' '.join(load_sample().question_text.fillna('')).split()
+    tickets = []
+    for length in lengths:
+        for __ in range(n):
+            body = list(rng.choice(words, length))
+            for i in rng.randint(0, length, max(1, length // 20)):
+                body[i] = rng.choice(noise)
+            tickets.append((length, dict(subject=' '.join(rng.choice(words, 6)), body=' '.join(body))))
+    return tickets
+
+def get_labels(data):
+    """Single (first product) & multi labels (all products) of the sample tickets"""
+    products = data.appliesTo.fillna('other').str.split(',')
+    simple = products.map(lambda p: p[0].strip().replace(' ', '_'))
+    multi = products.map(lambda p: ','.join(sorted({x.strip().replace(' ', '_') for x in p})))
+    return simple, multi
+
+############################################
+#####   Tiny Models
+############################################
+
+def get_vocab(texts, size=3000):
+    """WordPiece vocabulary of the most frequent (lower case) words & punctuation"""
+    counts = Counter(t for text in texts for t in re.findall(r'\w+|[^\w\s]', text.lower()))
+    return ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + [w for w, __ in counts.most_common(size)]
+
+def build_classifier(model_dir, vocab, label_list, multilabel, max_seq_len=256):
+    """Tiny, randomly initialized BERT classifier, saved like a trained FARM model"""
+    import torch
+    from transformers import BertConfig, BertModel, BertTokenizer
+    from farm.data_handler.processor import TextClassificationProcessor
+    from farm.modeling.adaptive_model import AdaptiveModel
+    from farm.modeling.language_model import Bert
+    from farm.modeling.prediction_head import TextClassificationHead, MultiLabelTextClassificationHead
+    from farm.utils import set_all_seeds
+
+    set_all_seeds(seed=42)
+    Path(model_dir).mkdir(parents=True, exist_ok=True)
+    fn_vocab = Path(model_dir) / 'vocab.txt'
+    fn_vocab.write_text('\n'.join(vocab), encoding='utf-8')
+    tokenizer = BertTokenizer(str(fn_vocab), do_lower_case=True)
+    language_model = Bert()
+    language_model.name = 'tiny-bert'
+    language_model.language = 'english'
+    language_model.model = BertModel(BertConfig(vocab_size=len(vocab), hidden_size=64, num_hidden_layers=2,
+                                                num_attention_heads=2, intermediate_size=128,
+                                                max_position_embeddings=512))
+    head = MultiLabelTextClassificationHead if multilabel else TextClassificationHead
+    model = AdaptiveModel(language_model=language_model,
+                        prediction_heads=[head(num_labels=len(label_list))],
+                        embeds_dropout_prob=0.1,
+                        lm_output_types=['per_sequence'],
+                        device=torch.device('cpu'))
+    processor = TextClassificationProcessor(tokenizer=tokenizer, max_seq_len=max_seq_len, data_dir=model_dir,
+                                            label_list=label_list, metric='acc', multilabel=multilabel)
+    model.save(model_dir)
+    processor.save(model_dir)
+
+def build_rank(fn_rank, data):
+    """BM25 index of the sample questions, with their answers"""
+    from gensim.summarization import bm25
+    simple, multi = get_labels(data)
+    questions = (data.question_title.fillna('') + ' ' + data.question_text.fillna('')).str.lower()
+    rank_data = pd.DataFrame(dict(question_clean=questions,
+                                answer_text_clean=data.answer_text.fillna('').str.lower(),
+                                label_classification_simple=simple,
+                                label_classification_multi=multi))
+    Path(fn_rank).parent.mkdir(parents=True, exist_ok=True)
+    with open(fn_rank, 'wb') as fh:
+        pickle.dump(bm25.BM25([q.split() for q in questions]), fh)
+        pickle.dump(rank_data, fh)
+
+def build(root, task_types):
+    """Model artifacts of the task types in the data directory root"""
+    import custom as cu
+    import data as dt
+    cu.params['data_dir'] = root
+    data = load_sample()
+    simple, multi = get_labels(data)
+    vocab = get_vocab(data.question_title.fillna('') + ' ' + data.question_text.fillna(''))
+    for task_type in task_types:
+        _dt = dt.Data(task=task_lookup[task_type], inference=True)
+        if task_type == 'classification':
+            build_classifier(_dt.get_path('model_dir'), vocab, sorted(simple.unique()), multilabel=False)
+        elif task_type == 'multi_classification':
+            build_classifier(_dt.get_path('model_dir'), vocab, sorted({l for m in multi for l in m.split(',')}),
+                            multilabel=True)
+        elif task_type == 'qa':
+            build_rank(_dt.get_path('fn_rank', dir='model_dir'), data)
+
+############################################
+#####   Measurement (worker process)
+############################################
+
+class LocalMatcher():
+    """Stand-in for the Text Analytics entity recognition, finds no entities"""
+    name = 'textanalytics'
+
+    def __call__(self, doc):
+        return doc
+
+def patch_services():
+    """Replace external services by local stand-ins"""
+    import spacy
+    import helper as he
+    he.load_spacy_model = lambda language='xx', disable=[]: spacy.blank(language)
+    import ner
+    ner.TextAnalyticsMatcher = LocalMatcher
+
+def get_peak_rss():
+    """Peak resident memory of the process (MB)"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+def get_percentiles(latencies):
+    return {f'p{p}': float(np.percentile(latencies, p)) * 1e3 for p in [50, 95, 99]} if len(latencies) else {}
+
+def time_requests(infer, tickets):
+    """Latency (seconds) of single requests"""
+    latencies = []
+    for t in tickets:
+        start = time.perf_counter()
+        infer.run(json.dumps([t]))
+        latencies.append(time.perf_counter() - start)
+    return np.array(latencies)
+
+def time_batches(infer, tickets, batch_size):
+    """Tickets/sec of batched model inference, on cleaned tickets"""
+    tm = infer.task_models[0]
+    clean = infer.prepare_classes[tm['task']]
+    texts = [clean.transform_by_task(infer.he.validate_concat(t['subject'], t['body'])) for t in tickets]
+    start = time.perf_counter()
+    for i in range(0, len(texts), batch_size):
+        tm['infer'].inference_from_dicts(dicts=[{'text': t} for t in texts[i:i + batch_size]])
+    return len(texts) / (time.perf_counter() - start)
+
+def measure(task_type, root, args):
+    """Cold start, latency, throughput & memory of one task type, in this (fresh) process"""
+    start = time.perf_counter()
+    import custom as cu
+    cu.params['data_dir'] = root
+    cu.params['language'] = args.language or cu.params.get('language')
+    cu.params['deploy'] = dict(backend=args.backend)
+    cu.tasks.clear()
+    cu.tasks[str(task_lookup[task_type])] = dict(type=task_type)
+    patch_services()
+    import infer
+    import_seconds = time.perf_counter() - start
+    infer.init()
+    init_seconds = time.perf_counter() - start
+    init_rss = get_peak_rss()
+
+    tickets = get_tickets(args.tickets)
+    synthetic = get_synthetic(args.synthetic, args.lengths)
+    time_requests(infer, tickets[:args.warmup])
+    latencies = time_requests(infer, tickets)
+    by_length = {}
+    for length in args.lengths:
+        by_length[str(length)] = get_percentiles(time_requests(infer, [t for l, t in synthetic if l == length]))
+    batch = time_batches(infer, tickets, args.batch_size) if task_type in batch_types else None
+    stages = {stage: round(s['p50'], 3) for (stage, task), s in infer.registry.summary().items()}
+
+    return dict(
+        import_seconds = import_seconds,
+        init_seconds = init_seconds,
+        latency_ms = get_percentiles(latencies),
+        latency_ms_by_length = by_length,
+        stage_p50_ms = stages,
+        requests_per_sec = len(latencies) / latencies.sum(),
+        batch_tickets_per_sec = batch,
+        init_peak_rss_mb = init_rss,
+        peak_rss_mb = get_peak_rss()
+    )
+
+############################################
+#####   Report
+############################################
+
+# Key metrics, with the direction of improvement
+key_metrics = [
+    ('init_seconds', 'lower'),
+    ('latency_ms.p50', 'lower'),
+    ('latency_ms.p95', 'lower'),
+    ('requests_per_sec', 'higher'),
+    ('batch_tickets_per_sec', 'higher'),
+    ('peak_rss_mb', 'lower')
+]
+
+def get_metric(result, key):
+    for k in key.split('.'):
+        result = result.get(k) if isinstance(result, dict) else None
+    return result
+
+def compare(baseline, current, tolerance):
+    """Relative change of the key metrics vs. a baseline result, returns the regressions"""
+    regressions = []
+    print(f'\n{"task type":<22}{"metric":<24}{"baseline":>12}{"current":>12}{"change":>9}')
+    for task_type, result in current['results'].items():
+        for key, better in key_metrics:
+            old, new = get_metric(baseline['results'].get(task_type, {}), key), get_metric(result, key)
+            if old is None or new is None or old == 0:
+                continue
+            change = new / old - 1
+            regressed = change > tolerance if better == 'lower' else change < -tolerance
+            if regressed:
+                regressions.append((task_type, key, change))
+            print(f'{task_type:<22}{key:<24}{old:>12.2f}{new:>12.2f}{change:>+9.1%}{"  <- REGRESSION" if regressed else ""}')
+    return regressions
+
+def get_meta(args):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return dict(commit=commit, date=time.strftime('%Y-%m-%dT%H:%M:%S'), python=platform.python_version(),
+                platform=platform.platform(), cpus=os.cpu_count(), tickets=args.tickets,
+                synthetic=args.synthetic, lengths=args.lengths, batch_size=args.batch_size, backend=args.backend)
+
+def run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--task_types", default=['classification', 'multi_classification', 'ner', 'qa'],
+                        nargs='+', choices=list(task_lookup))
+    parser.add_argument("--tickets", default=200, type=int, help="Sample tickets for latency & throughput")
+    parser.add_argument("--synthetic", default=20, type=int, help="Synthetic tickets per length")
+    parser.add_argument("--lengths", default=[8, 32, 128, 512], nargs='+', type=int, help="Synthetic ticket lengths (words)")
+    parser.add_argument("--batch_size", default=32, type=int)
+    parser.add_argument("--warmup", default=5, type=int)
+    parser.add_argument("--backend", default='auto', type=str)
+    parser.add_argument("--language", default=None, type=str, help="Language, default from the project config")
+    parser.add_argument("--output", default='benchmark_infer.json', type=str)
+    parser.add_argument("--compare", default=None, type=str, help="Previous result (JSON) to compare to")
+    parser.add_argument("--tolerance", default=0.2, type=float, help="Max relative change, before a regression is flagged")
+    parser.add_argument("--root", default=None, type=str, help="Data directory with the models, default is a temporary one")
+    parser.add_argument("--worker", default=None, type=str, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        ## Measure one task type, in this process
+        print(marker + json.dumps(measure(args.worker, args.root, args)))
+        return
+
+    root = args.root or tempfile.mkdtemp(prefix='benchmark_infer_')
+    try:
+        build(root, args.task_types)
+        env = {k: v for k, v in os.environ.items() if k != 'AZUREML_MODEL_DIR'}
+        results = {}
+        for task_type in args.task_types:
+            cmd = [sys.executable, __file__, '--worker', task_type, '--root', root] + \
+                    [a for a in sys.argv[1:] if a != '--root' and a != args.root]
+            proc = subprocess.run(cmd, capture_output=True, text=True, env=env)
+            lines = [l for l in proc.stdout.splitlines() if l.startswith(marker)]
+            if proc.returncode != 0 or len(lines) == 0:
+                print(proc.stderr[-3000:])
+                raise Exception(f'BENCHMARK OF {task_type} FAILED')
+            results[task_type] = json.loads(lines[-1][len(marker):])
+    finally:
+        if args.root is None:
+            shutil.rmtree(root, ignore_errors=True)
+
+    output = dict(meta=get_meta(args), results=results)
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2)
+
+    print(f'{"task type":<22}{"init (s)":>10}{"p50 (ms)":>10}{"p95 (ms)":>10}{"p99 (ms)":>10}'
+            f'{"req/s":>9}{"batch/s":>9}{"RSS (MB)":>10}')
+    for task_type, r in results.items():
+        batch = f'{r["batch_tickets_per_sec"]:>9.1f}' if r['batch_tickets_per_sec'] is not None else f'{"-":>9}'
+        print(f'{task_type:<22}{r["init_seconds"]:>10.2f}{r["latency_ms"]["p50"]:>10.1f}{r["latency_ms"]["p95"]:>10.1f}'
+                f'{r["latency_ms"]["p99"]:>10.1f}{r["requests_per_sec"]:>9.1f}{batch}{r["peak_rss_mb"]:>10.0f}')
+    print(f'Results -> {args.output}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), output, args.tolerance)
+        if len(regressions) > 0:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,65 @@
+"""
+Benchmark load times of intermediate files, CSV vs. Parquet
+
+Example (in the command line):
+> cd to root dir
+> python tests/benchmark_io.py --rows 200000
+"""
+import os
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+import sys
+sys.path.append('./src')
+import data as dt
+
+def get_corpus(rows, seed=42):
+    """Generate a synthetic corpus, similar to the cleaned QA data"""
+    rng = np.random.RandomState(seed)
+    words = np.array(['windows', 'surface', 'update', 'error', 'driver', 'screen', 'office',
+                        'install', 'account', 'password', 'network', 'battery', 'printer'])
+    def texts(n_words):
+        return [' '.join(rng.choice(words, rng.randint(5, n_words))) for _ in range(rows)]
+    return pd.DataFrame({
+        'id'                            : np.arange(rows),
+        'question_clean'                : texts(60),
+        'answer_text_clean'             : texts(200),
+        'label_classification_simple'   : rng.choice(words, rows),
+        'label_classification_multi'    : rng.choice(words, rows),
+        'views'                         : rng.randint(0, 10000, rows)
+    })
+
+def timeit(func, repeat=3):
+    """Best of n runs, in seconds"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+def run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", default=100000, type=int)
+    parser.add_argument("--repeat", default=3, type=int)
+    args = parser.parse_args()
+
+    _dt = dt.Data(task=4)
+    data = get_corpus(args.rows)
+    columns = ['question_clean']
+    settings = [('csv', None, 'benchmark.txt')] + \
+        [('parquet', c, f'benchmark-{c}.parquet') for c in ['snappy', 'gzip', 'zstd', None]]
+
+    print(f'{"file type":<10}{"compression":<13}{"size (MB)":>10}{"save (s)":>10}{"load (s)":>10}{"load col (s)":>14}')
+    for file_type, compression, fn in settings:
+        t_save = timeit(lambda: _dt.save(data, fn, dir='data_dir', compression=compression), args.repeat)
+        t_load = timeit(lambda: _dt.load(fn, dir='data_dir'), args.repeat)
+        t_cols = timeit(lambda: _dt.load(fn, dir='data_dir', columns=columns), args.repeat)
+        size = os.path.getsize(_dt.get_path(fn, dir='data_dir')) / 1e6
+        print(f'{file_type:<10}{str(compression):<13}{size:>10.1f}{t_save:>10.3f}{t_load:>10.3f}{t_cols:>14.3f}')
+        os.remove(_dt.get_path(fn, dir='data_dir'))
+
+if __name__ == '__main__':
+    run()
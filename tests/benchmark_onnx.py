@@ -0,0 +1,70 @@
+"""
+Benchmark classification backends (pytorch, quantized, onnx) on a fixed ticket set
+
+The tickets are taken from demo/sample_data.csv. Predictions of each backend are
+compared to the PyTorch model, latency is measured per single request and
+throughput for batches.
+
+Example (in the command line):
+> cd to root dir
+> python src/classification.py --task 1 --export_onnx
+> python tests/benchmark_onnx.py --task 1 --tickets 200
+"""
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+import sys
+sys.path.append('./src')
+import helper as he
+import data as dt
+import prepare as pr
+import export as ex
+
+def get_tickets(n, task, fn='demo/sample_data.csv'):
+    """Cleaned subject & body of the first n tickets"""
+    data = pd.read_csv(fn).head(n)
+    text = he.validate_concat(data.question_title.fillna(''), data.question_text.fillna(''))
+    cl = pr.Clean(task=task, inference=True)
+    return [cl.transform_by_task(t) for t in text]
+
+def get_outputs(inferencer, texts, batch_size):
+    """Labels & probabilities, with the latency of each request"""
+    outputs, latencies = [], []
+    for i in range(0, len(texts), batch_size):
+        start = time.perf_counter()
+        result = inferencer.inference_from_dicts(dicts=[{"text": t} for t in texts[i:i + batch_size]])
+        latencies.append(time.perf_counter() - start)
+        outputs += [(p.get('label'), np.asarray(p.get('probability'))) for r in result for p in r['predictions']]
+    return outputs, np.array(latencies)
+
+def run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--task", default=1, type=int)
+    parser.add_argument("--tickets", default=200, type=int)
+    parser.add_argument("--batch_size", default=32, type=int)
+    args = parser.parse_args()
+
+    model_dir = dt.Data(task=args.task, inference=True).get_path('model_dir')
+    texts = get_tickets(args.tickets, args.task)
+
+    reference = None
+    print(f'{"backend":<12}{"p50 (ms)":>10}{"p95 (ms)":>10}{"tickets/s":>12}{"labels ==":>11}{"max |dp|":>10}')
+    for backend in ex.backends[::-1]:
+        if not ex.has_variant(model_dir, backend):
+            print(f'{backend:<12} not exported')
+            continue
+        inferencer = ex.load(model_dir, backend=backend, batch_size=args.batch_size, num_processes=0)
+        # Warm up
+        get_outputs(inferencer, texts[:2], 1)
+        outputs, latencies = get_outputs(inferencer, texts, 1)
+        __, batch_latencies = get_outputs(inferencer, texts, args.batch_size)
+        reference = reference or outputs
+        same = np.mean([o[0] == r[0] for o, r in zip(outputs, reference)])
+        diff = max(float(np.max(np.abs(o[1] - r[1]))) for o, r in zip(outputs, reference))
+        print(f'{backend:<12}{np.percentile(latencies, 50) * 1e3:>10.1f}{np.percentile(latencies, 95) * 1e3:>10.1f}'
+                f'{len(texts) / batch_latencies.sum():>12.1f}{same:>11.3f}{diff:>10.4f}')
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,83 @@
+"""
+Benchmark tokens per second, fixed padding vs. length bucketing with dynamic padding
+
+A small, randomly initialized BERT model is used, so no model download is needed.
+Sequence lengths are drawn from a long tailed distribution, like forum posts.
+
+Example (in the command line):
+> cd to root dir
+> python tests/benchmark_padding.py --samples 2000 --max_seq_len 256
+"""
+import time
+import argparse
+import numpy as np
+
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+from transformers import BertConfig, BertModel
+
+import sys
+sys.path.append('./src')
+import features as fe
+
+def get_dataset(samples, max_seq_len, seed=42):
+    """Synthetic features, padded to max_seq_len"""
+    rng = np.random.RandomState(seed)
+    lengths = np.clip(rng.lognormal(mean=4, sigma=0.7, size=samples).astype(int), 8, max_seq_len)
+    input_ids = torch.zeros(samples, max_seq_len, dtype=torch.long)
+    padding_mask = torch.zeros(samples, max_seq_len, dtype=torch.long)
+    for i, l in enumerate(lengths):
+        input_ids[i, :l] = torch.from_numpy(rng.randint(1000, 20000, l))
+        padding_mask[i, :l] = 1
+    segment_ids = torch.zeros(samples, max_seq_len, dtype=torch.long)
+    label_ids = torch.from_numpy(rng.randint(0, 10, samples))
+    return TensorDataset(input_ids, padding_mask, segment_ids, label_ids), lengths
+
+def run_model(model, loader):
+    """Forward pass over all batches, returns tokens (without padding) per second"""
+    n_tokens = 0
+    start = time.perf_counter()
+    with torch.no_grad():
+        for batch in loader:
+            model(input_ids=batch['input_ids'], attention_mask=batch['padding_mask'],
+                    token_type_ids=batch['segment_ids'])
+            n_tokens += int(batch['padding_mask'].sum())
+    return n_tokens / (time.perf_counter() - start)
+
+def run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--samples", default=2000, type=int)
+    parser.add_argument("--max_seq_len", default=256, type=int)
+    parser.add_argument("--batch_size", default=32, type=int)
+    parser.add_argument("--threads", default=None, type=int)
+    args = parser.parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    torch.manual_seed(42)
+    np.random.seed(42)
+    model = BertModel(BertConfig(vocab_size=30000, hidden_size=256, num_hidden_layers=4,
+                                    num_attention_heads=4, intermediate_size=1024,
+                                    max_position_embeddings=args.max_seq_len)).eval()
+    dataset, lengths = get_dataset(args.samples, args.max_seq_len)
+    tensor_names = ['input_ids', 'padding_mask', 'segment_ids', 'text_classification_label_ids']
+    fixed_tensor_names = {'text_classification_label_ids'}
+
+    loaders = {
+        'fixed padding'     : DataLoader(dataset, batch_size=args.batch_size, shuffle=True,
+                                collate_fn=lambda b: dict(zip(tensor_names, [torch.stack(t) for t in zip(*b)]))),
+        'dynamic padding'   : DataLoader(dataset, batch_size=args.batch_size, shuffle=True,
+                                collate_fn=lambda b: fe.collate(b, tensor_names, fixed_tensor_names)),
+        'bucketed'          : fe.BucketedDataLoader(dataset, args.batch_size, tensor_names, fixed_tensor_names)
+    }
+    print(f'samples = {args.samples}, max_seq_len = {args.max_seq_len}, '
+            f'mean length = {lengths.mean():.0f}, median length = {np.median(lengths):.0f}')
+    print(f'{"batching":<18}{"tokens/s":>12}{"speedup":>10}')
+    baseline = None
+    for name, loader in loaders.items():
+        tps = run_model(model, loader)
+        baseline = baseline or tps
+        print(f'{name:<18}{tps:>12.0f}{tps / baseline:>9.1f}x')
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,101 @@
+"""
+Local artifact cache (put, get, eviction & garbage collection) and local store
+
+Example (in the command line):
+> cd to root dir
+> python -m pytest tests/test_cache.py
+"""
+import os
+import sys
+import time
+import threading
+from pathlib import Path
+
+sys.path.append('./src')
+import cache
+
+def write(fp, content):
+    os.makedirs(os.path.dirname(fp), exist_ok=True)
+    with open(fp, 'w') as f:
+        f.write(content)
+    return str(fp)
+
+def objects(c):
+    return sorted(f.name for f in Path(c.object_dir).rglob('*') if f.is_file())
+
+def test_put_get(tmp_path):
+    c = cache.ArtifactCache(str(tmp_path / 'cache'))
+    src = tmp_path / 'download'
+    files = [write(src / 'model' / 'a.bin', 'aaa'), write(src / 'model' / 'b.txt', 'bbb')]
+    c.put('model/x', 1, str(src), [str(src / 'model')])
+    # Same content under another key is stored once
+    c.put('model/y', 1, str(src), files[:1])
+    assert len(objects(c)) == 2
+
+    target = tmp_path / 'restore'
+    assert c.get('model/x', 1, str(target))
+    assert (target / 'model' / 'a.bin').read_text() == 'aaa'
+    assert (target / 'model' / 'b.txt').read_text() == 'bbb'
+    assert not c.get('model/x', 2, str(target))
+
+def test_corrupted_object(tmp_path):
+    c = cache.ArtifactCache(str(tmp_path / 'cache'))
+    fn = write(tmp_path / 'src' / 'a.bin', 'aaa')
+    c.put('a', 1, str(tmp_path / 'src'), [fn])
+    write(os.path.join(c.object_dir, objects(c)[0][:2], objects(c)[0]), 'corrupted')
+    assert not c.get('a', 1, str(tmp_path / 'restore'))
+    assert not c.has('a', 1) and objects(c) == []
+
+def test_evict_lru(tmp_path):
+    c = cache.ArtifactCache(str(tmp_path / 'cache'), quota_mb=25e-6)
+    for key in ['a', 'b']:
+        c.put(key, 1, str(tmp_path), [write(tmp_path / f'{key}.bin', key * 10)])
+        time.sleep(0.01)
+    # Recently used, b is evicted first
+    assert c.get('a', 1, str(tmp_path / 'restore'))
+    c.put('c', 1, str(tmp_path), [write(tmp_path / 'c.bin', 'c' * 10)])
+    assert [c.has(k, 1) for k in 'abc'] == [True, False, True]
+    assert c.size() <= c.quota and len(objects(c)) == 2
+
+def test_evict_oversized(tmp_path):
+    c = cache.ArtifactCache(str(tmp_path / 'cache'), quota_mb=5e-6)
+    c.put('big', 1, str(tmp_path), [write(tmp_path / 'big.bin', 'x' * 10)])
+    assert not c.has('big', 1) and objects(c) == []
+    # The last entry is evicted, if the quota is lowered
+    c.quota = 20
+    c.put('small', 1, str(tmp_path), [write(tmp_path / 'small.bin', 'y' * 10)])
+    c.quota = 5
+    c.evict()
+    assert not c.has('small', 1) and objects(c) == []
+
+def test_gc_keeps_referenced(tmp_path):
+    c = cache.ArtifactCache(str(tmp_path / 'cache'), quota_mb=35e-6)
+    write(os.path.join(c.object_dir, 'ab', 'ab' + '0' * 62), 'orphan')
+    c.put('a', 1, str(tmp_path), [write(tmp_path / 'a.bin', 'a' * 10)])
+    c.put('b', 1, str(tmp_path), [write(tmp_path / 'b.bin', 'b' * 10)])
+    c.put('c', 1, str(tmp_path), [write(tmp_path / 'c.bin', 'c' * 10)])
+    referenced = {h for __, m in c._entries() for h in m['files'].values()}
+    assert set(objects(c)) == referenced
+
+def test_concurrent_put(tmp_path):
+    c = cache.ArtifactCache(str(tmp_path / 'cache'), quota_mb=1)
+    files = [write(tmp_path / f'{i}.bin', str(i) * 1000) for i in range(40)]
+    threads = [threading.Thread(target=c.put, args=(f'k{i}', 1, str(tmp_path), [fn])) for i, fn in enumerate(files)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # Every entry still has its objects
+    for i in range(40):
+        if c.has(f'k{i}', 1):
+            assert c.get(f'k{i}', 1, str(tmp_path / 'restore'))
+
+def test_local_store(tmp_path):
+    store = cache.LocalStore(str(tmp_path / 'store'))
+    fn = write(tmp_path / 'model.bin', 'v1')
+    assert store.upload('model', 'x', fn) == 1
+    write(tmp_path / 'model.bin', 'v2')
+    assert store.upload('model', 'x', fn) == 2
+    assert store.get_version('model', 'x') == 2
+    paths = store.download('model', 'x', str(tmp_path / 'target'), version=1)
+    assert [Path(p).read_text() for p in paths] == ['v1']
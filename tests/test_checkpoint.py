@@ -0,0 +1,152 @@
+"""
+Checkpoint & resume of training, on CPU with a tiny model
+
+A training which is interrupted and resumed from its last checkpoint has to end
+with the same weights as an uninterrupted training. Dropout is disabled, so the
+result is deterministic.
+
+Example (in the command line):
+> cd to root dir
+> python -m pytest tests/test_checkpoint.py
+"""
+import sys
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('transformers')
+pytest.importorskip('farm')
+
+from types import SimpleNamespace
+from torch.utils.data import TensorDataset
+from transformers import BertConfig, BertModel
+from farm.modeling.adaptive_model import AdaptiveModel
+from farm.modeling.language_model import Bert
+from farm.modeling.prediction_head import TextClassificationHead
+from farm.modeling.optimization import initialize_optimizer
+from farm.utils import set_all_seeds
+
+sys.path.append('./src')
+import features as fe
+import checkpoint as ck
+
+vocab_size = 50
+max_seq_len = 16
+tensor_names = ['input_ids', 'padding_mask', 'segment_ids', 'text_classification_label_ids']
+tasks = {'text_classification': {
+    'label_list'        : ['a', 'b'],
+    'metric'            : 'acc',
+    'label_tensor_name' : 'text_classification_label_ids',
+    'label_name'        : 'text_classification_label',
+    'task_type'         : 'classification'
+}}
+
+class Preempted(Exception):
+    pass
+
+class TinySilo():
+    """Data silo with a bucketed train loader only"""
+    set_epoch = fe.CachedDataSilo.set_epoch
+
+    def __init__(self, samples=40, batch_size=4):
+        g = torch.Generator().manual_seed(0)
+        lengths = torch.randint(4, max_seq_len + 1, (samples,), generator=g)
+        padding_mask = (torch.arange(max_seq_len)[None, :] < lengths[:, None]).long()
+        input_ids = torch.randint(1, vocab_size, (samples, max_seq_len), generator=g) * padding_mask
+        labels = torch.randint(0, 2, (samples,), generator=g)
+        dataset = TensorDataset(input_ids, padding_mask, torch.zeros_like(input_ids), labels)
+        self.processor = SimpleNamespace(tasks=tasks, tokenizer=list(range(vocab_size)))
+        self.loaders = {'train': fe.BucketedDataLoader(dataset, batch_size, tensor_names,
+                                                        {'text_classification_label_ids'})}
+
+    def get_data_loader(self, name):
+        return self.loaders.get(name)
+
+def build(grad_acc_steps=1):
+    set_all_seeds(seed=0)
+    language_model = Bert()
+    language_model.name = 'tiny-bert'
+    language_model.language = 'english'
+    language_model.model = BertModel(BertConfig(vocab_size=vocab_size, hidden_size=16, num_hidden_layers=1,
+                                                num_attention_heads=2, intermediate_size=32,
+                                                max_position_embeddings=max_seq_len,
+                                                hidden_dropout_prob=0, attention_probs_dropout_prob=0))
+    device = torch.device('cpu')
+    model = AdaptiveModel(language_model=language_model,
+                        prediction_heads=[TextClassificationHead(num_labels=2)],
+                        embeds_dropout_prob=0,
+                        lm_output_types=['per_sequence'],
+                        device=device)
+    silo = TinySilo()
+    model, optimizer, lr_schedule = initialize_optimizer(model=model, n_batches=len(silo.loaders['train']),
+                                                        n_epochs=2, device=device, learning_rate=1e-3,
+                                                        grad_acc_steps=grad_acc_steps)
+    return model, optimizer, lr_schedule, silo
+
+def get_trainer(checkpoint_dir, resume, grad_acc_steps=1):
+    model, optimizer, lr_schedule, silo = build(grad_acc_steps)
+    trainer = ck.CheckpointTrainer.create(data_silo=silo, model=model, optimizer=optimizer,
+                                        checkpoint_root_dir=checkpoint_dir, resume=resume,
+                                        lr_schedule=lr_schedule, epochs=2, n_gpu=0, device=torch.device('cpu'),
+                                        evaluate_every=0, evaluator_test=False, checkpoint_every=3,
+                                        grad_acc_steps=grad_acc_steps, disable_tqdm=True)
+    return trainer, model
+
+@pytest.mark.parametrize('grad_acc_steps, checkpoint', [(1, 'epoch_0_step_3'), (2, 'epoch_0_step_4')])
+def test_resume(tmp_path, monkeypatch, grad_acc_steps, checkpoint):
+    # MLflow logs to the working directory
+    monkeypatch.chdir(tmp_path)
+
+    # Uninterrupted
+    trainer, model = get_trainer(tmp_path / 'reference', resume=False, grad_acc_steps=grad_acc_steps)
+    trainer.train()
+    expected = {k: v.clone() for k, v in model.state_dict().items()}
+
+    # Interrupted in the first epoch, after the first checkpoint (rounded up to an optimizer step)
+    trainer, model = get_trainer(tmp_path / 'run', resume=False, grad_acc_steps=grad_acc_steps)
+    logits_to_loss = model.logits_to_loss
+    calls = []
+    def preempt(**kwargs):
+        calls.append(1)
+        if len(calls) == 7:
+            raise Preempted()
+        return logits_to_loss(**kwargs)
+    model.logits_to_loss = preempt
+    with pytest.raises(Preempted):
+        trainer.train()
+    assert ck.CheckpointTrainer._get_checkpoints(tmp_path / 'run')[0].name == checkpoint
+
+    # Restarted
+    step = int(checkpoint.split('_')[-1]) + 1
+    trainer, model = get_trainer(tmp_path / 'run', resume=True, grad_acc_steps=grad_acc_steps)
+    assert (trainer.from_epoch, trainer.from_step, trainer.global_step) == (0, step, step)
+    trainer.train()
+    for k, v in model.state_dict().items():
+        assert torch.allclose(v, expected[k], atol=1e-6), k
+
+def test_no_resume(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'run' / 'epoch_0_step_3').mkdir(parents=True)
+    trainer, __ = get_trainer(tmp_path / 'run', resume=False)
+    assert trainer.global_step == 0
+    assert ck.CheckpointTrainer._get_checkpoints(tmp_path / 'run') == []
+
+def test_grad_accumulation(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    trainer, model = get_trainer(tmp_path / 'run', resume=False, grad_acc_steps=2)
+    steps = []
+    optimizer_step = trainer.optimizer.step
+    def count(*args, **kwargs):
+        steps.append(1)
+        return optimizer_step(*args, **kwargs)
+    trainer.optimizer.step = count
+    trainer.train()
+    # 10 batches per epoch, an optimizer step every 2nd batch
+    assert len(steps) == 2 * 5
+    assert trainer.throughput['examples'] == 2 * 40
+    assert trainer.throughput['examples_per_sec'] > 0
+
+def test_amp_level():
+    assert ck.get_amp_level(None) is None
+    assert ck.get_amp_level('O1') == 'O1'
+    with pytest.raises(ValueError):
+        ck.get_amp_level('bf16')
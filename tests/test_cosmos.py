@@ -0,0 +1,116 @@
+"""
+Paged & resumable Cosmos DB pulls, with the in-memory LocalCosmosClient
+
+Example (in the command line):
+> cd to root dir
+> python -m pytest tests/test_cosmos.py
+"""
+import os
+import sys
+import types
+import pytest
+
+sys.path.append('./src')
+import custom as cu
+import data as dt
+
+pytest.importorskip('pyarrow')
+
+def get_documents(n, text='text'):
+    return [dict(id=str(i), _ts=i, subject=f'subject {i}', body=f'{text} {i}',
+                    label_classification=[dict(task_type='simple', version=[dict(value=f'cat{i % 2},x')])])
+            for i in range(n)]
+
+class CountingClient(dt.LocalCosmosClient):
+    def __init__(self, documents):
+        super().__init__(documents)
+        self.fetched = 0
+
+    def QueryItems(self, link, query, options=None):
+        self.continuation = (options or {}).get('continuation')
+        results = super().QueryItems(link, query, options)
+        fetch_next_block = results.fetch_next_block
+        def fetch():
+            documents = fetch_next_block()
+            self.fetched += len(documents)
+            return documents
+        results.fetch_next_block = fetch
+        return results
+
+@pytest.fixture
+def cl(tmp_path, monkeypatch):
+    monkeypatch.setitem(cu.params, 'data_dir', str(tmp_path))
+    monkeypatch.setitem(cu.params, 'prepare', {**cu.params.get('prepare', {}), 'file_type': 'parquet'})
+    return types.SimpleNamespace(dt=dt.Data(task=1, inference=True))
+
+def test_prepare_source():
+    data = cu.prepare_source([
+        dict(id='007', created_at='2020-01-01', meta=dict(a=dict(b=1))),
+        dict(id='x8', created_at=None, meta=dict(a=dict(b=2)))
+    ])
+    assert sorted(data.columns) == ['created_at', 'id', 'meta_a_b']
+    # No number or date inference from strings
+    assert data.id.tolist() == ['007', 'x8']
+    assert data.created_at.tolist()[0] == '2020-01-01'
+    assert data.meta_a_b.tolist() == [1, 2]
+
+def test_get_pages():
+    client = dt.LocalCosmosClient(get_documents(5))
+    pages = list(dt.get_pages(client, page_size=2))
+    assert [(len(d), c) for d, c in pages] == [(2, '2'), (2, '4'), (1, None)]
+    pages = list(dt.get_pages(client, page_size=2, continuation='4'))
+    assert [d[0]['id'] for d, __ in pages] == ['4']
+    assert list(dt.get_pages(dt.LocalCosmosClient([]), page_size=2)) == [([], None)]
+
+def test_resume(cl):
+    client = CountingClient(get_documents(5))
+    batches = dt.get_batches(cl, client=client, page_size=2)
+    next(batches), next(batches)
+    # Failed run, after two checkpointed batches
+    batches.close()
+    state = cl.dt.load('fn_cdb_state', file_type='json', dir='raw_dir')
+    assert state['batches'] == 2 and not state['complete']
+
+    client = CountingClient(get_documents(5))
+    batches = list(dt.iter_dataset(cl, client=client, page_size=2, refresh=True))
+    assert client.continuation == '4' and client.fetched == 1
+    assert sum(len(b) for b in batches) == 5
+    assert not os.path.isfile(cl.dt.get_path('fn_cdb_state', dir='raw_dir'))
+    prep = cl.dt.load('fn_prep', dir='data_dir')
+    assert prep.id.tolist() == [str(i) for i in range(5)]
+    assert prep.label_classification_simple.tolist()[:2] == ['cat0', 'cat1']
+    assert prep.label_classification_multi.tolist()[:2] == ['cat0,x', 'cat1,x']
+
+def test_refresh_completed_pull(cl):
+    # Completed pull, failed before the checkpoint was cleared
+    list(dt.get_batches(cl, client=dt.LocalCosmosClient(get_documents(3)), page_size=2))
+    client = CountingClient(get_documents(4))
+    assert len(dt.get_dataset(cl, client=client, page_size=2)) == 3
+    assert client.fetched == 0
+
+    list(dt.get_batches(cl, client=dt.LocalCosmosClient(get_documents(3)), page_size=2))
+    client = CountingClient(get_documents(4))
+    assert len(dt.get_dataset(cl, client=client, page_size=2, refresh=True)) == 4
+    assert client.fetched == 4
+    assert not os.path.isfile(cl.dt.get_path('fn_cdb_state', dir='raw_dir'))
+
+def test_merge_since(cl):
+    dt.get_dataset(cl, client=dt.LocalCosmosClient(get_documents(4)), page_size=2)
+    changed = get_documents(5, text='changed')[2:]
+    delta = dt.get_dataset(cl, client=dt.LocalCosmosClient(changed), page_size=2, since=2)
+    assert delta.id.tolist() == ['2', '3', '4']
+    prep = cl.dt.load('fn_prep', dir='data_dir')
+    assert prep.id.tolist() == ['0', '1', '2', '3', '4']
+    assert prep.body.tolist() == ['text 0', 'text 1', 'changed 2', 'changed 3', 'changed 4']
+
+def test_merge_since_status(cl):
+    documents = [dict(d, status='train') for d in get_documents(4)]
+    dt.get_dataset(cl, client=dt.LocalCosmosClient(documents), page_size=2)
+    # Document 1 is no longer for training
+    client = dt.LocalCosmosClient([dict(documents[1], status='review', _ts=5)])
+    delta = dt.get_dataset(cl, client=client, page_size=2, since=4)
+    assert 'status' not in client.last_query['query'] and '_ts >= 4' in client.last_query['query']
+    assert delta.id.tolist() == ['1']
+    prep = cl.dt.load('fn_prep', dir='data_dir')
+    assert prep.id.tolist() == ['0', '2', '3']
+    assert "status = 'train'" in dt.get_query()[1]['query']
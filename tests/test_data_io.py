@@ -0,0 +1,94 @@
+"""
+Save & load of intermediate files with Data
+
+Example (in the command line):
+> cd to root dir
+> python -m pytest tests/test_data_io.py
+"""
+import os
+import sys
+import pytest
+import pandas as pd
+
+sys.path.append('./src')
+import custom as cu
+import data as dt
+
+pytest.importorskip('pyarrow')
+
+@pytest.fixture
+def data_obj(tmp_path, monkeypatch):
+    monkeypatch.setitem(cu.params, 'data_dir', str(tmp_path))
+    return dt.Data(task=1, inference=True)
+
+def test_parquet_roundtrip(data_obj):
+    data = pd.DataFrame({
+        'id'        : [1, 2, 3],
+        'text'      : ['a', None, 'c'],
+        'label'     : [['x', 'y'], [], None],
+        'meta'      : [{'k': 1}, {'k': [2, 3]}, {}],
+        'mixed'     : ['a', 1, 2.5]
+    })
+    data_obj.save(data, 'roundtrip.parquet')
+    loaded = data_obj.load('roundtrip.parquet')
+    assert loaded.id.tolist() == [1, 2, 3]
+    assert loaded.text.tolist()[::2] == ['a', 'c'] and pd.isna(loaded.text[1])
+    assert loaded.label.tolist()[:2] == [['x', 'y'], []] and pd.isna(loaded.label[2])
+    assert loaded.meta.tolist() == [{'k': 1}, {'k': [2, 3]}, {}]
+    assert loaded.mixed.tolist() == ['a', 1, 2.5]
+
+    chunks = list(data_obj.load('roundtrip.parquet', columns=['id', 'label'], chunksize=2))
+    assert [len(c) for c in chunks] == [2, 1]
+    assert chunks[0].label.tolist() == [['x', 'y'], []]
+
+def test_default_file_type(data_obj):
+    assert data_obj.file_type == cu.params.get('prepare', {}).get('file_type', 'csv')
+    assert dt.get_file_type(data_obj.get_path('fn_prep')) == data_obj.file_type
+
+@pytest.mark.parametrize('fn', ['chunks.txt', 'chunks.parquet'])
+def test_chunk_writer(data_obj, fn):
+    with data_obj.writer(fn) as writer:
+        writer.write(pd.DataFrame({'id': ['1', '2'], 'text': ['a', 'b'], 'label': [None, None]}))
+        writer.write(pd.DataFrame({'text': ['c'], 'id': ['3'], 'label': ['x'], 'extra': [1]}))
+    assert writer.rows == 3
+    loaded = data_obj.load(fn, dtype={'id': str}) if fn.endswith('parquet') else \
+                pd.read_csv(data_obj.get_path(fn), sep='\t', dtype=str)
+    # Late columns are carried over
+    assert loaded.columns.tolist() == ['id', 'text', 'label', 'extra']
+    assert loaded.id.tolist() == ['1', '2', '3'] and loaded.label.tolist()[2] == 'x'
+    assert pd.isna(loaded.extra[0]) and float(loaded.extra[2]) == 1
+
+def test_chunk_writer_types(data_obj):
+    # Without values in the first chunk, nested values in a later one
+    with data_obj.writer('types.parquet') as writer:
+        writer.write(pd.DataFrame({'id': ['1', '2'], 'label': [None, None], 'score': [float('nan')] * 2}))
+        writer.write(pd.DataFrame({'id': ['3'], 'label': [['a', 'b']], 'score': [0.5], 'meta': [{'k': 1}]}))
+    loaded = data_obj.load('types.parquet')
+    assert pd.isna(loaded.label[0]) and loaded.label[2] == ['a', 'b']
+    assert loaded.score.tolist()[2] == 0.5 and loaded.meta.tolist()[2] == {'k': 1}
+    chunks = list(data_obj.load('types.parquet', chunksize=2))
+    assert chunks[1].label.tolist() == [['a', 'b']]
+    # Values of another type in a typed column
+    with pytest.raises(Exception, match='column types'):
+        with data_obj.writer('types.parquet') as writer:
+            writer.write(pd.DataFrame({'text': ['a']}))
+            writer.write(pd.DataFrame({'text': [['b']]}))
+
+@pytest.mark.parametrize('fn', ['empty.txt', 'empty.parquet'])
+def test_chunk_writer_empty(data_obj, fn):
+    data_obj.save(pd.DataFrame({'text': ['stale']}), fn)
+    with data_obj.writer(fn) as writer:
+        writer.write(pd.DataFrame({'text': []}, dtype=object))
+    assert os.path.exists(data_obj.get_path(fn)) and writer.rows == 0
+    # No chunk at all, the previous file is removed
+    with data_obj.writer(fn) as writer:
+        pass
+    assert not os.path.exists(data_obj.get_path(fn))
+
+def test_chunk_writer_abort(data_obj):
+    with pytest.raises(ValueError):
+        with data_obj.writer('aborted.parquet') as writer:
+            writer.write(pd.DataFrame({'text': ['a']}))
+            raise ValueError()
+    fn = data_obj.get_path('aborted.parquet')
+    assert not os.path.exists(fn) and not os.path.exists(fn + '.tmp')
@@ -0,0 +1,90 @@
+"""
+Export of a distilled student, on CPU with a tiny model
+
+The exported variants of the student have to be served like any other model,
+without the soft labels and the distillation model class.
+
+Example (in the command line):
+> cd to root dir
+> python -m pytest tests/test_distillation.py
+"""
+import sys
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('transformers')
+pytest.importorskip('farm')
+pytest.importorskip('sklearn')
+
+from torch.utils.data import TensorDataset
+from transformers import BertConfig, BertModel, BertTokenizer
+from farm.data_handler.processor import TextClassificationProcessor
+from farm.modeling.adaptive_model import AdaptiveModel
+from farm.modeling.language_model import Bert
+from farm.modeling.prediction_head import TextClassificationHead
+from farm.utils import set_all_seeds
+
+sys.path.append('./src')
+import features as fe
+import export as ex
+import distillation as ds
+
+vocab = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + [f'w{i}' for i in range(45)]
+max_seq_len = 16
+tensor_names = ['input_ids', 'padding_mask', 'segment_ids', 'text_classification_label_ids']
+
+def get_processor(tmp_path):
+    fn_vocab = tmp_path / 'vocab.txt'
+    fn_vocab.write_text('\n'.join(vocab))
+    return TextClassificationProcessor(tokenizer=BertTokenizer(str(fn_vocab)),
+                                        max_seq_len=max_seq_len,
+                                        data_dir=str(tmp_path),
+                                        label_list=['a', 'b'],
+                                        metric='acc',
+                                        label_column_name='label',
+                                        train_filename=None,
+                                        test_filename=None,
+                                        dev_split=0)
+
+def get_student(processor):
+    set_all_seeds(seed=0)
+    language_model = Bert()
+    language_model.name = 'tiny-bert'
+    language_model.language = 'english'
+    language_model.model = BertModel(BertConfig(vocab_size=len(vocab), hidden_size=16, num_hidden_layers=1,
+                                                num_attention_heads=2, intermediate_size=32,
+                                                max_position_embeddings=max_seq_len))
+    model = ds.DistillationModel(soft_labels=torch.randn(40, 2),
+                                language_model=language_model,
+                                prediction_heads=[TextClassificationHead(num_labels=2)],
+                                embeds_dropout_prob=0.1,
+                                lm_output_types=['per_sequence'],
+                                device=torch.device('cpu'))
+    model.connect_heads_with_processor(processor.tasks)
+    return model
+
+def get_loader(samples=20):
+    g = torch.Generator().manual_seed(0)
+    lengths = torch.randint(4, max_seq_len + 1, (samples,), generator=g)
+    padding_mask = (torch.arange(max_seq_len)[None, :] < lengths[:, None]).long()
+    input_ids = torch.randint(5, len(vocab), (samples, max_seq_len), generator=g) * padding_mask
+    labels = torch.randint(0, 2, (samples,), generator=g)
+    dataset = TensorDataset(input_ids, padding_mask, torch.zeros_like(input_ids), labels)
+    return fe.BucketedDataLoader(dataset, 4, tensor_names, {'text_classification_label_ids'}, shuffle=False)
+
+def test_export_student(tmp_path):
+    processor = get_processor(tmp_path)
+    student = ds.to_adaptive_model(get_student(processor))
+    assert type(student) is AdaptiveModel and not hasattr(student, 'soft_labels')
+
+    save_dir = tmp_path / 'student'
+    student.save(save_dir)
+    processor.save(save_dir)
+    report = ex.export_quantized(student, processor, get_loader(), save_dir, torch.device('cpu'), max_delta=1.0)
+    assert report['exported']
+
+    # Served like a trained classification model, the quantized variant first
+    model = ex.load(save_dir, backend='auto', max_seq_len=max_seq_len)
+    assert type(model.model) is AdaptiveModel and not hasattr(model.model, 'soft_labels')
+    result = model.inference_from_dicts(dicts=[{'text': 'w1 w2 w3'}])
+    assert result[0]['predictions'][0]['label'] in ['a', 'b']
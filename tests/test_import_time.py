@@ -0,0 +1,59 @@
+"""
+Import time benchmark of the core modules
+
+Heavy dependencies (spacy, flair, Azure SDKs) have to be imported lazily,
+by the functions needing them. The import is profiled via `python -X importtime`.
+
+Example (in the command line):
+> cd to root dir
+> python -m pytest tests/test_import_time.py
+> python tests/test_import_time.py        <- print import times
+"""
+import os
+import sys
+import subprocess
+import pytest
+
+src_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+
+# Modules, which must not be imported at import time
+heavy_modules = ['spacy', 'flair', 'torch', 'transformers', 'yaml', 'azureml',
+                    'azure.cosmos', 'azure.storage', 'azure.keyvault']
+
+# Max cumulative import time (seconds), can be raised via IMPORT_TIME_FACTOR on slow machines
+budgets = {
+    'helper'    : 0.2,
+    'data'      : 2.0
+}
+
+def get_import_times(module):
+    """Import module in a fresh interpreter, returns cumulative import time (s) by module"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                    cwd = src_dir, capture_output = True, text = True)
+    assert result.returncode == 0, result.stderr
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        __, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+@pytest.mark.parametrize('module', list(budgets))
+def test_no_heavy_imports(module):
+    times = get_import_times(module)
+    loaded = [m for m in times if any(m == h or m.startswith(f'{h}.') for h in heavy_modules)]
+    assert loaded == [], f'{module} imports heavy dependencies: {loaded}'
+
+@pytest.mark.parametrize('module', list(budgets))
+def test_import_time(module):
+    budget = budgets[module] * float(os.environ.get('IMPORT_TIME_FACTOR', 1))
+    duration = get_import_times(module)[module]
+    assert duration < budget, f'Import of {module} took {duration:.3f}s, budget is {budget:.3f}s'
+
+if __name__ == '__main__':
+    for module in budgets:
+        times = get_import_times(module)
+        print(f'{module:<10}{times[module]:>8.3f}s')
+        for name, t in sorted(times.items(), key = lambda x: -x[1])[1:6]:
+            print(f'  {name:<30}{t:>8.3f}s')
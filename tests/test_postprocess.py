@@ -0,0 +1,67 @@
+"""
+Multi label post-processing on the probability matrix of a batch
+
+Example (in the command line):
+> cd to root dir
+> python -m pytest tests/test_postprocess.py
+"""
+import sys
+import numpy as np
+from types import SimpleNamespace
+
+sys.path.append('./src')
+import postprocess as pp
+
+labels = np.array(['a', 'b', 'c', 'd'])
+probs = np.array([
+    [0.9, 0.2, 0.6, 0.7],
+    [0.1, 0.3, 0.2, 0.4],
+    [0.5, 0.8, 0.1, 0.2]
+])
+
+def reference(probs, labels, threshold, top_k):
+    """Row by row selection, with a full sort"""
+    result = []
+    for row in probs:
+        order = [i for i in np.argsort(-row, kind='stable') if threshold is None or row[i] >= threshold]
+        order = order[:top_k] if top_k is not None else order
+        result.append(dict(category=[labels[i] for i in order], score=[row[i] for i in order]))
+    return result
+
+def test_threshold():
+    assert pp.multi_label(probs, labels, threshold=0.5) == [
+        dict(category=['a', 'd', 'c'], score=[0.9, 0.7, 0.6]),
+        dict(category=[], score=[]),
+        dict(category=['b', 'a'], score=[0.8, 0.5])
+    ]
+
+def test_top_k():
+    assert pp.multi_label(probs, labels, threshold=None, top_k=1) == [
+        dict(category=['a'], score=[0.9]),
+        dict(category=['d'], score=[0.4]),
+        dict(category=['b'], score=[0.8])
+    ]
+    assert pp.multi_label(probs, labels, threshold=0.5, top_k=2)[0] == dict(category=['a', 'd'], score=[0.9, 0.7])
+
+def test_large_label_space():
+    rng = np.random.RandomState(0)
+    probs = rng.beta(0.5, 5, size=(64, 2000))
+    labels = np.array([f'label_{i}' for i in range(2000)])
+    for threshold, top_k in [(0.5, None), (None, 5), (0.3, 10)]:
+        assert pp.multi_label(probs, labels, threshold, top_k) == reference(probs, labels, threshold, top_k)
+
+def test_probabilities():
+    result = [{'predictions': [{'label': "['a']", 'probability': p} for p in probs]}]
+    np.testing.assert_array_equal(pp.get_probabilities(result), probs)
+    assert pp.multi_label(pp.get_probabilities([]), labels) == []
+
+def test_label_array_by_head():
+    heads = [SimpleNamespace(task_name='text_classification'), SimpleNamespace(task_name='text_classification_t2')]
+    inferencer = SimpleNamespace(
+        model=SimpleNamespace(prediction_heads=heads),
+        processor=SimpleNamespace(tasks={
+            'text_classification': {'label_list': ['a', 'b']},
+            'text_classification_t2': {'label_list': ['x', 'y', 'z']}
+        }))
+    assert pp.get_label_array(inferencer).tolist() == ['a', 'b']
+    assert pp.get_label_array(inferencer, 1).tolist() == ['x', 'y', 'z']
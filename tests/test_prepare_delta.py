@@ -0,0 +1,63 @@
+"""
+Incremental prepare: merge of new & changed documents and label counts
+
+Example (in the command line):
+> cd to root dir
+> python -m pytest tests/test_prepare_delta.py
+"""
+import sys
+import types
+import pytest
+import pandas as pd
+
+pytest.importorskip('spacy')
+pytest.importorskip('sklearn')
+pytest.importorskip('pyarrow')
+
+sys.path.append('./src')
+import custom as cu
+import data as dt
+import prepare as pr
+
+@pytest.fixture
+def cl(tmp_path, monkeypatch):
+    monkeypatch.setitem(cu.params, 'data_dir', str(tmp_path))
+    monkeypatch.setitem(cu.params, 'prepare', {**cu.params.get('prepare', {}), 'file_type': 'parquet'})
+    return types.SimpleNamespace(dt=dt.Data(task=1, inference=True))
+
+@pytest.mark.parametrize('chunksize', [None, 2])
+def test_merge_delta(cl, chunksize):
+    base = pd.DataFrame({'id': ['1', '2', '3', '4'], 'text': ['aaa', 'bbb', 'ccc', 'ddd'], 'label': ['x', 'y', 'x', 'y']})
+    cl.dt.save(base, 'fn_clean_base', dir='data_dir')
+    # Document 2 changed & became too short (filtered), 3 changed, 5 is new, 6 a duplicate
+    delta_ids = ['2', '3', '5', '6']
+    data = pd.DataFrame({'id': ['3', '5', '6'], 'text': ['ccc new', 'eee', 'aaa'], 'label': ['y', 'x', 'x']})
+    removed, added = pr.merge_delta(cl, 'fn_clean_base', data, 'text', delta_ids, chunksize)
+    assert sorted(removed.id) == ['2', '3']
+    assert added.id.tolist() == ['3', '5']
+    merged = cl.dt.load('fn_clean_base', dir='data_dir')
+    assert merged.id.tolist() == ['1', '4', '3', '5']
+    assert merged.text.tolist() == ['aaa', 'ddd', 'ccc new', 'eee']
+
+def test_merge_delta_removed(cl):
+    base = pd.DataFrame({'id': ['1', '2'], 'text': ['aaa', 'bbb'], 'label': ['x', 'y']})
+    cl.dt.save(base, 'fn_clean_base', dir='data_dir')
+    # Document 2 is no longer for training, nothing to add
+    delta = pd.DataFrame({'id': ['2'], 'status': ['review'], '_ts': [5]})
+    assert len(dt.filter_status(delta)) == 0 and pr.get_high_water_mark(delta, 3) == 5
+    removed, added = pr.merge_delta(cl, 'fn_clean_base', pd.DataFrame(columns=['id', 'text', 'label']), 'text', delta.id)
+    assert removed.id.tolist() == ['2'] and len(added) == 0
+    assert pr.get_label_counts(removed, 'classification') == {'y': 1}
+    assert cl.dt.load('fn_clean_base', dir='data_dir').id.tolist() == ['1']
+
+def test_label_counts_keys():
+    # Labels loaded as numbers, label counts (of the delta state) by string
+    data = pd.DataFrame({'label': [1, 1, 2]})
+    label_counts = pr.get_label_counts(data, 'classification')
+    assert label_counts == {'1': 2, '2': 1}
+    assert pr.get_label_set(data, 'classification') == {'1', '2'}
+    assert pr.filter_min_occurance(data, label_counts, 1, 'classification').label.tolist() == [1, 1]
+    assert pr.get_label_counts(pd.DataFrame({'label': ['a', None]}), 'classification') == {'a': 1}
+    data = pd.DataFrame({'label': ['a,b', 'a', 'c']})
+    assert pr.get_label_counts(data, 'multi_classification') == {'a': 2, 'b': 1, 'c': 1}
+    assert pr.filter_min_occurance(data, {'a': 2, 'b': 1, 'c': 1}, 1, 'multi_classification').label.tolist() == ['a', 'a']
@@ -0,0 +1,70 @@
+"""
+Aho-Corasick automaton & combined regex rules of the NER rule layer
+
+Example (in the command line):
+> cd to root dir
+> python -m pytest tests/test_rules.py
+"""
+import sys
+
+sys.path.append('./src')
+import rules
+
+def test_overlapping_literals():
+    ac = rules.AhoCorasick(['he', 'she', 'his', 'hers'])
+    found = sorted((ac.patterns[pid], s, e) for pid, s, e in ac.iter('ushers'))
+    assert found == [('he', 2, 4), ('hers', 2, 6), ('she', 1, 4)]
+
+    matcher = rules.RuleMatcher([
+        dict(value='surface', key='Product'),
+        dict(value='surface pro', key='Product'),
+        dict(value='pro 7', key='Model')
+    ])
+    # Leftmost-longest, non overlapping, on word boundaries
+    assert matcher.match_literals('my surface pro 7 and a surfaceless pro 7') == [
+        ('surface pro', 3, 14, 'Product', 'rule'),
+        ('pro 7', 35, 40, 'Model', 'rule')
+    ]
+
+def test_case_folding():
+    matcher = rules.RuleMatcher([dict(value='Surface Pro', key='Product')])
+    text = 'İİ SURFACE pro'
+    assert matcher.match(text) == [('SURFACE pro', 3, 14, 'Product', 'rule')]
+    matcher = rules.RuleMatcher([dict(value='Surface Pro', key='Product')], ignore_case=False)
+    assert matcher.match('SURFACE pro, Surface Pro') == [('Surface Pro', 13, 24, 'Product', 'rule')]
+
+def test_combined_regex():
+    matcher = rules.RuleMatcher([
+        dict(value=r'\b(((o|0)(x|\*))|(800))\S*', key='ERROR CODE', type='regex'),
+        dict(value='KB[0-9]{6}', key='KB', type='regex')
+    ])
+    assert matcher.separate == [] and matcher.regex_labels == ['ERROR CODE', 'KB']
+    assert matcher.match('error 0x80070005 see kb123456') == [
+        ('0x80070005', 6, 16, 'ERROR CODE', 'regex'),
+        ('kb123456', 21, 29, 'KB', 'regex')
+    ]
+    # At a position, the first rule wins
+    matcher = rules.RuleMatcher([
+        dict(value='KB[0-9]+', key='KB', type='regex'),
+        dict(value='[0-9]{6}', key='NUMBER', type='regex')
+    ])
+    assert matcher.match('KB123456 123456') == [
+        ('KB123456', 0, 8, 'KB', 'regex'),
+        ('123456', 9, 15, 'NUMBER', 'regex')
+    ]
+
+def test_backreference_rule():
+    matcher = rules.RuleMatcher([
+        dict(value=r'(ab)\1', key='REPEAT', type='regex'),
+        dict(value=r'(?P<code>E)[0-9]{3}', key='CODE', type='regex'),
+        dict(value=r'(x)(y)', key='XY', type='regex'),
+        dict(value='(unclosed', key='BAD', type='regex')
+    ])
+    assert [k for __, k in matcher.separate] == ['REPEAT', 'CODE']
+    assert matcher.regex_labels == ['XY']
+    assert [k for __, k, __ in matcher.invalid] == ['BAD']
+    assert sorted(matcher.match('abab E123 xy')) == [
+        ('E123', 5, 9, 'CODE', 'regex'),
+        ('abab', 0, 4, 'REPEAT', 'regex'),
+        ('xy', 10, 12, 'XY', 'regex')
+    ]
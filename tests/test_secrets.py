@@ -0,0 +1,51 @@
+"""
+Secret provider with the LocalVault fake of a KeyVault
+
+Example (in the command line):
+> cd to root dir
+> python -m pytest tests/test_secrets.py
+"""
+import os
+import sys
+import json
+import pytest
+
+sys.path.append('./src')
+import helper as he
+
+def get_provider(vault=None, ttl=3600):
+    provider = he.SecretProvider(ttl=ttl, vault=vault)
+    # No local config.ini
+    provider._config_loaded = True
+    return provider
+
+def test_local_vault(tmp_path):
+    fn = tmp_path / 'secrets.json'
+    fn.write_text(json.dumps({'b': '2'}))
+    vault = he.LocalVault({'a': '1'}, fn=str(fn))
+    assert vault.get_secret('a') == '1' and vault.get_secret('b') == '2'
+    assert vault.get_secret('c') is None and vault.requests == 3
+
+def test_provider_cache(monkeypatch):
+    monkeypatch.setenv('from-env', 'env')
+    vault = he.LocalVault({'a': '1', 'b': '2', 'from-env': 'vault'})
+    provider = get_provider(vault)
+    assert provider.get_secret('a') == '1' and provider.get_secret('a') == '1'
+    assert vault.requests == 1
+    assert provider.get_secrets(['a', 'b', 'from-env']) == {'a': '1', 'b': '2', 'from-env': 'env'}
+    assert vault.requests == 2
+    with pytest.raises(Exception, match='not found'):
+        provider.get_secret('missing')
+    # Expired secrets are fetched again
+    provider = get_provider(vault, ttl=0)
+    provider.get_secret('a'), provider.get_secret('a')
+    assert vault.requests == 5
+
+def test_missing_service_principal(monkeypatch):
+    for name in ['sp-client-id', 'sp-secret', 'keyvault-url']:
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv('sp-tenant-id', 'tenant')
+    provider = get_provider()
+    with pytest.raises(Exception, match='sp-client-id'):
+        provider.get_secret('cosmos-db-key')
+    assert provider.vault is None
@@ -0,0 +1,76 @@
+"""
+Stage latency histograms & Prometheus export of the scoring service
+
+Example (in the command line):
+> cd to root dir
+> python -m pytest tests/test_timing.py
+"""
+import sys
+import urllib.request
+import numpy as np
+
+sys.path.append('./src')
+import timing
+
+def test_quantiles():
+    rng = np.random.RandomState(0)
+    values = rng.lognormal(mean=np.log(0.02), sigma=0.8, size=5000)
+    h = timing.Histogram()
+    for v in values:
+        h.observe(v)
+    assert h.count == len(values)
+    assert abs(h.sum - values.sum()) < 1e-6
+    # Within the resolution of the buckets (factor sqrt(2))
+    for q in timing.quantiles:
+        expected = np.percentile(values, q * 100)
+        assert expected / 1.42 <= h.quantile(q) <= expected * 1.42, q
+    assert h.quantile(1.0) <= values.max()
+
+def test_trace():
+    registry = timing.Registry()
+    for __ in range(3):
+        trace = registry.trace()
+        trace.lap('validate_concat')
+        start = trace.last
+        trace.lap('clean', 1)
+        trace.lap('inference', 1)
+        trace.since('task', start, 1)
+        registry.record(trace)
+    assert set(trace.breakdown(1)) == {'validate_concat', 'clean', 'inference', 'task'}
+    assert set(trace.breakdown(2)) == {'validate_concat'}
+    summary = registry.summary()
+    assert summary[('clean', 1)]['count'] == 3
+    assert set(summary[('task', 1)]) == {'count', 'p50', 'p95', 'p99'}
+
+def test_disabled():
+    registry = timing.Registry(enabled=False)
+    trace = registry.trace()
+    assert trace is timing.null_trace
+    trace.lap('clean', 1)
+    registry.record(trace)
+    assert registry.histograms == {}
+    # Timing breakdown of a single response
+    trace = registry.trace(force=True)
+    trace.lap('clean', 1)
+    registry.record(trace)
+    assert 'clean' in trace.breakdown(1) and registry.histograms == {}
+
+def test_prometheus():
+    registry = timing.Registry()
+    trace = registry.trace()
+    trace.lap('inference', 1)
+    registry.record(trace)
+    text = registry.to_prometheus()
+    assert '# TYPE infer_stage_seconds histogram' in text
+    assert 'infer_stage_seconds_bucket{stage="inference",task="1",le="+Inf"} 1' in text
+    assert 'infer_stage_seconds_count{stage="inference",task="1"} 1' in text
+    assert 'infer_stage_seconds_quantile{stage="inference",task="1",quantile="0.99"}' in text
+    for line in text.splitlines():
+        assert line.startswith('#') or len(line.rsplit(' ', 1)) == 2
+
+    server = timing.serve(registry, 0)
+    try:
+        with urllib.request.urlopen(f'http://127.0.0.1:{server.server_address[1]}/metrics') as r:
+            assert r.read().decode() == text
+    finally:
+        server.shutdown()
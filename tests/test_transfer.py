@@ -0,0 +1,90 @@
+"""
+Parallel, resumable block transfers against the local FakeBlobStore
+
+Example (in the command line):
+> cd to root dir
+> python -m pytest tests/test_transfer.py
+"""
+import os
+import sys
+import json
+
+sys.path.append('./src')
+import transfer
+
+block_size = 1024
+
+def write(fp, data):
+    os.makedirs(os.path.dirname(fp), exist_ok=True)
+    with open(fp, 'wb') as f:
+        f.write(data)
+    return str(fp)
+
+def get_engine(tmp_path):
+    return transfer.TransferEngine(transfer.FakeBlobStore(str(tmp_path / 'store')), max_workers=4, block_size=block_size)
+
+def test_chunked_roundtrip(tmp_path):
+    engine = get_engine(tmp_path)
+    data = os.urandom(block_size * 5 + 17)
+    write(tmp_path / 'src' / 'a.bin', data)
+    write(tmp_path / 'src' / 'sub' / 'b.bin', data[:100])
+    files = transfer.get_blob_files(str(tmp_path / 'src'), 'model')
+    assert [b for __, b in files] == ['model/a.bin', 'model/sub/b.bin']
+
+    stats = engine.upload('c', files)
+    assert stats['files'] == 2 and stats['bytes'] == len(data) + 100
+    stats = engine.download('c', [(b, str(tmp_path / 'dst' / b)) for __, b in files])
+    assert stats['bytes'] == len(data) + 100
+    assert (tmp_path / 'dst' / 'model' / 'a.bin').read_bytes() == data
+    assert (tmp_path / 'dst' / 'model' / 'sub' / 'b.bin').read_bytes() == data[:100]
+    assert sorted(os.listdir(tmp_path / 'dst' / 'model')) == ['a.bin', 'sub']
+
+def test_empty_file(tmp_path):
+    engine = get_engine(tmp_path)
+    fp = write(tmp_path / 'empty.txt', b'')
+    assert engine.upload('c', [(fp, 'empty.txt')])['bytes'] == 0
+    assert engine.download('c', [('empty.txt', str(tmp_path / 'dst' / 'empty.txt'))])['bytes'] == 0
+    assert (tmp_path / 'dst' / 'empty.txt').read_bytes() == b''
+
+def test_resume_upload(tmp_path):
+    engine = get_engine(tmp_path)
+    data = os.urandom(block_size * 4)
+    fp = write(tmp_path / 'a.bin', data)
+    # Blocks staged by an interrupted upload are reused
+    for i in range(2):
+        block = data[i * block_size:(i + 1) * block_size]
+        engine.store.put_block('c', 'a.bin', transfer.get_block_id(i, block), block)
+    assert engine.upload('c', [(fp, 'a.bin')])['bytes'] == block_size * 2
+    assert (tmp_path / 'store' / 'c' / 'a.bin').read_bytes() == data
+
+def test_resume_download(tmp_path):
+    engine = get_engine(tmp_path)
+    data = os.urandom(block_size * 4 + 10)
+    engine.upload('c', [(write(tmp_path / 'a.bin', data), 'a.bin')])
+    size, etag = engine.store.get_properties('c', 'a.bin')
+
+    # Interrupted download, with blocks 0 & 2 done
+    fp = str(tmp_path / 'dst' / 'a.bin')
+    part = f'{fp}.part'
+    write(part, data[:block_size] + bytes(block_size) + data[2 * block_size:3 * block_size] + bytes(size - 3 * block_size))
+    transfer.write_state(part, dict(etag=etag, block_size=block_size, done=[0, 2]))
+    assert engine.download('c', [('a.bin', fp)])['bytes'] == size - 2 * block_size
+    assert open(fp, 'rb').read() == data
+    assert not os.path.exists(part) and not os.path.exists(f'{part}.json')
+
+def test_changed_blob_restarts(tmp_path):
+    engine = get_engine(tmp_path)
+    data = os.urandom(block_size * 2)
+    engine.upload('c', [(write(tmp_path / 'a.bin', data), 'a.bin')])
+    fp = str(tmp_path / 'dst' / 'a.bin')
+    write(f'{fp}.part', bytes(len(data)))
+    transfer.write_state(f'{fp}.part', dict(etag='outdated', block_size=block_size, done=[0, 1]))
+    assert engine.download('c', [('a.bin', fp)])['bytes'] == len(data)
+    assert open(fp, 'rb').read() == data
+
+def test_state_written_atomically(tmp_path):
+    part = str(tmp_path / 'a.bin.part')
+    transfer.write_state(part, dict(etag='e', block_size=block_size, done=[1]))
+    with open(f'{part}.json') as f:
+        assert json.load(f)['done'] == [1]
+    assert not os.path.exists(f'{part}.json.tmp')